@@ -0,0 +1,103 @@
+"""
+CHUNKER_BENCHMARK:
+Compares the native streaming chunker of ChunkRawData (src/lambda/step3/text_chunker.py)
+with LangChain's RecursiveCharacterTextSplitter on synthetic documents.
+
+For every input size it reports the wall time, the peak traced memory and the number of
+chunks of both splitters, and checks that the chunks are identical.
+
+Usage (from source/cdk, with requirements-dev.txt installed):
+    python benchmarks/chunker_benchmark.py --sizes 10 50 100
+    python benchmarks/chunker_benchmark.py --sizes 10 --chunk-size 1000 --overlap 200 --skip-langchain
+Sizes are in MB.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'lambda', 'step3'))
+
+from text_chunker import iter_chunks  # noqa: E402
+
+WORDS = ['invoice', 'total', 'amount', 'customer', 'address', 'the', 'of', 'and', 'a', 'to',
+         'semantic', 'search', 'document', 'página', 'número', 'data', '2024', 'N/A', '$1,250.00']
+
+
+def synthetic_document(size_mb, seed=7):
+    """Text shaped like the consolidated Textract output: paragraphs, short lines and long runs"""
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    parts = []
+    length = 0
+    while length < target:
+        kind = rng.random()
+        if kind < 0.7:
+            block = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 400)))
+        elif kind < 0.95:
+            block = '\n'.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+                              for _ in range(rng.randint(2, 30)))
+        else:
+            # tables flattened without spaces force the character level split
+            block = ''.join(rng.choice(WORDS) for _ in range(rng.randint(200, 600)))
+        parts.append(block)
+        length += len(block) + 2
+    return '\n\n'.join(parts)
+
+
+def measure(function):
+    """Wall time of an untraced run, then the peak memory of a traced one (tracing slows Python code down)"""
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    del result
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_native(document, chunk_size, overlap):
+    # consume the generator like the manifest writer does, keeping only the count
+    count = 0
+    for _ in iter_chunks(document, chunk_size, overlap):
+        count += 1
+    return count
+
+
+def run_langchain(document, chunk_size, overlap):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap,
+                                              length_function=len, add_start_index=True)
+    return splitter.create_documents([document])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100], help='document sizes in MB')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--overlap', type=int, default=200)
+    parser.add_argument('--skip-langchain', action='store_true', help='only time the native chunker')
+    args = parser.parse_args()
+
+    print(f"{'MB':>5} {'splitter':>10} {'seconds':>9} {'peak MB':>9} {'chunks':>9}")
+    for size_mb in args.sizes:
+        document = synthetic_document(size_mb)
+        count, elapsed, peak = measure(lambda: run_native(document, args.chunk_size, args.overlap))
+        print(f"{size_mb:>5} {'native':>10} {elapsed:>9.2f} {peak / 2**20:>9.1f} {count:>9}")
+        if args.skip_langchain:
+            continue
+        docs, elapsed, peak = measure(lambda: run_langchain(document, args.chunk_size, args.overlap))
+        print(f"{size_mb:>5} {'langchain':>10} {elapsed:>9.2f} {peak / 2**20:>9.1f} {len(docs):>9}")
+        native = iter_chunks(document, args.chunk_size, args.overlap)
+        identical = len(docs) == count and all(doc.page_content == text for doc, (_, _, text) in zip(docs, native))
+        print(f"{size_mb:>5} {'identical':>10} {str(identical):>9}")
+        del docs
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,520 @@
+"""
+INGESTION_BENCHMARK:
+Runs the ingestion pipeline end to end in process, without deploying:
+ReadDocs -> (SNSProcess) -> StoreRawDocs -> ChunkRawData -> StoreChunkDynamo for the Textract
+route and ReadDocs -> PagesProcess -> RawDataJoiner -> ChunkRawData -> StoreChunkDynamo for the
+LLM route, chained the way the state machines chain them.
+
+S3 and DynamoDB are moto in memory backends. Textract and Bedrock are deterministic stubs
+with a configurable latency and throttle rate: Bedrock throttles go through the retry policy of
+the shared client (common/bedrock_client.py), Textract throttles are absorbed with a backoff
+like the botocore retries do. Step Functions executions are recorded and run by the harness.
+
+The corpus is generated: PDFs with a text layer, a share of scanned pages (no text layer, read
+by the Textract and Bedrock stubs) and optionally template pages repeated in every document.
+
+For the whole run it reports documents/min, the wall time and calls of every stage, the AWS
+requests per operation, the Bedrock calls, throttles and retries, and the peak memory: the
+peak traced memory of every stage (when documents run one at a time) and the peak RSS of the
+process. Tracing memory slows Python code down, use --no-trace-memory for the wall times.
+
+Usage (from source/cdk, with requirements-dev.txt installed):
+    python benchmarks/ingestion_benchmark.py --documents 20 --pages 10
+    python benchmarks/ingestion_benchmark.py --documents 50 --pages 30 --scanned 0.3 --route llm \\
+        --concurrency 4 --bedrock-latency 0.5 --throttle-rate 0.1
+The environment variables of the functions (SPLIT_MODE, CHUNK_PROFILES, LLM_MAX_PAGES_PER_BATCH,
+...) are read as usual, set them in the shell to compare configurations.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'lambda')
+FUNCTION_DIRS = ['common', 'step1', 'step2', 'step2sns', 'step2split', 'step3joiner', 'step3', 'step4', 'delete']
+sys.path[:0] = [os.path.join(LAMBDA_DIR, name) for name in FUNCTION_DIRS]
+
+import boto3  # noqa: E402
+import pypdf  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+BUCKET = 'benchmark-documents'
+GROUP = 'benchmark'
+WORDS = ['invoice', 'total', 'amount', 'customer', 'address', 'the', 'of', 'and', 'a', 'to',
+         'semantic', 'search', 'document', 'policy', 'section', 'data', '2024', 'N/A', '$1,250.00',
+         'employee', 'handbook', 'benefits', 'leave', 'request', 'approval', 'manager', 'report']
+TABLES = {
+    'documents': 'benchmark-documents',
+    'small': 'benchmark-chunks-small',
+    'big': 'benchmark-chunks-big',
+    'embedding_cache': 'benchmark-embedding-cache',
+    'signatures': 'benchmark-chunk-signatures',
+}
+
+
+def configure_environment(args):
+    """Environment of the functions, values already set in the shell win"""
+    defaults = {
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'BUCKET_NAME': BUCKET,
+        'DOCUMENTS_BUCKET_NAME': BUCKET,
+        'DOCUMENT_TABLE': TABLES['documents'],
+        'DOCUMENTS_TABLE_NAME': TABLES['documents'],
+        'DYNAMO_TABLE_TEXTRACT': TABLES['small'],
+        'DYNAMO_TABLE_LLM': TABLES['big'],
+        'EMBEDDING_CACHE_TABLE': TABLES['embedding_cache'],
+        'NEAR_DUP_TABLE': TABLES['signatures'],
+        'EXTRACTION_ROUTING': json.dumps({'default': args.route}),
+        'SATE_MACHINE': 'arn:aws:states:us-east-1:123456789012:stateMachine:benchmark-textract',
+        'TEXTRACT_STATE_MACHINE': 'arn:aws:states:us-east-1:123456789012:stateMachine:benchmark-textract',
+        'SNS_TOPIC': 'arn:aws:sns:us-east-1:123456789012:benchmark',
+        'TEXTRACT_ROLE': 'arn:aws:iam::123456789012:role/benchmark',
+        'DEFAULT_TMP': tempfile.mkdtemp(prefix='ingestion-benchmark-'),
+        'BEDROCK_BACKOFF_BASE': '0.05',
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+# --- corpus -------------------------------------------------------------------------------
+
+def pdf_string(text):
+    return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+
+def build_pdf(pages):
+    """
+    Minimal PDF, one page per entry of `pages`: a list of text lines drawn with Helvetica, or
+    None for a scanned page, drawn as a shape without text layer (marked so it is unique).
+    """
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>']
+    page_ids = []
+    for number, lines in enumerate(pages):
+        if lines is None:
+            offset = int(hashlib.sha256(f"{id(pages)}-{number}".encode()).hexdigest()[:4], 16) % 400
+            stream = f"0.5 g {50 + offset} 300 120 80 re f".encode()
+        else:
+            stream = ("BT /F1 9 Tf 11 TL 40 800 Td " + ' '.join(f"{pdf_string(line)} '" for line in lines) + " ET").encode('latin-1')
+        objects.append(b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream')
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                       f"/Contents {content_id} 0 R >>".encode())
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>".encode()
+    out = io.BytesIO()
+    out.write(b'%PDF-1.7\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b'\nendobj\n')
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def text_page(rng, lines=60):
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))) for _ in range(lines)]
+
+
+def generate_corpus(documents, pages, scanned, template_pages, seed):
+    """{file name: PDF bytes}, template pages are identical in every document"""
+    template = [text_page(random.Random(f"template-{page}")) for page in range(template_pages)]
+    corpus = {}
+    for document in range(documents):
+        rng = random.Random(f"{seed}-{document}")
+        content = list(template)
+        for _ in range(max(0, pages - template_pages)):
+            content.append(None if rng.random() < scanned else text_page(rng))
+        corpus[f"document_{document:04d}.pdf"] = build_pdf(content)
+    return corpus
+
+
+def page_text(page, seed):
+    """Text of a page: its text layer, or a deterministic transcription of a scanned page"""
+    text = page.extract_text() or ''
+    if text.strip():
+        return text
+    rng = random.Random(hashlib.sha256(page.get_contents().get_data() + seed.encode()).hexdigest())
+    return '\n'.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))) for _ in range(60))
+
+
+# --- service stand-ins ------------------------------------------------------------------------
+
+class ThrottledService:
+    def __init__(self, latency, throttle_rate, seed):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def throttled(self):
+        with self.lock:
+            return self.rng.random() < self.throttle_rate
+
+
+class StubTextract(ThrottledService):
+    """Asynchronous text detection, the job reads the PDF from (moto) S3 when its results are fetched"""
+
+    def __init__(self, s3, latency, throttle_rate, seed):
+        super().__init__(latency, throttle_rate, seed)
+        self.s3 = s3
+        self.jobs = {}
+
+    def call(self, name):
+        attempt = 0
+        while self.throttled():
+            # botocore retries the throttled call with a backoff
+            self.count('throttles')
+            time.sleep(min(2.0, 0.05 * (2 ** attempt)))
+            attempt += 1
+        self.count(name)
+        time.sleep(self.latency)
+
+    def start_document_text_detection(self, DocumentLocation, **kwargs):
+        self.call('StartDocumentTextDetection')
+        job_id = hashlib.sha256(json.dumps([DocumentLocation, kwargs.get('ClientRequestToken')], sort_keys=True,
+                                           default=str).encode()).hexdigest()[:32]
+        self.jobs[job_id] = DocumentLocation['S3Object']
+        return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        self.call('GetDocumentTextDetection')
+        location = self.jobs[JobId]
+        body = self.s3.get_object(Bucket=location['Bucket'], Key=location['Name'])['Body'].read()
+        reader = pypdf.PdfReader(io.BytesIO(body))
+        blocks = []
+        for number, page in enumerate(reader.pages, 1):
+            blocks.append({'BlockType': 'PAGE', 'Page': number, 'Id': f"page-{number}"})
+            for index, line in enumerate(page_text(page, 'textract').splitlines()):
+                if line.strip():
+                    blocks.append({'BlockType': 'LINE', 'Page': number, 'Id': f"line-{number}-{index}",
+                                   'Text': line, 'Confidence': 99.0})
+        start = int(NextToken or 0)
+        response = {
+            'JobStatus': 'SUCCEEDED',
+            'DocumentMetadata': {'Pages': len(reader.pages)},
+            'Blocks': blocks[start:start + MaxResults]
+        }
+        if start + MaxResults < len(blocks):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+
+class StubBedrock(ThrottledService):
+    """bedrock-runtime converse (page extraction) and invoke_model (embeddings), behind the shared client"""
+
+    def __init__(self, converse_latency, embedding_latency, throttle_rate, dimensions, seed):
+        super().__init__(converse_latency, throttle_rate, seed)
+        self.embedding_latency = embedding_latency
+        self.dimensions = dimensions
+
+    def throttle(self, name):
+        if self.throttled():
+            self.count(f"{name}Throttled")
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, name)
+        self.count(name)
+
+    def converse(self, modelId, messages, **kwargs):
+        self.throttle('Converse')
+        time.sleep(self.latency)
+        content = messages[0]['content']
+        reader = pypdf.PdfReader(io.BytesIO(content[0]['document']['source']['bytes']))
+        texts = [page_text(page, 'llm') for page in reader.pages]
+        if len(texts) == 1:
+            text = texts[0]
+        else:
+            text = ''.join(f'<page number="{number}">{page}</page>\n' for number, page in enumerate(texts, 1))
+        if len(messages) > 1:
+            # continuation of a prefilled answer
+            text = text[len(messages[1]['content'][0]['text']):]
+        return {
+            'output': {'message': {'content': [{'text': text}]}},
+            'usage': {'inputTokens': 1500 * len(texts), 'outputTokens': len(text) // 4,
+                      'totalTokens': 1500 * len(texts) + len(text) // 4},
+            'stopReason': 'end_turn'
+        }
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self.throttle('InvokeModel')
+        time.sleep(self.embedding_latency)
+        text = json.loads(body)['inputText']
+        rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+        embedding = [round(rng.uniform(-1, 1), 6) for _ in range(self.dimensions)]
+        return {'body': io.BytesIO(json.dumps({'embedding': embedding}).encode())}
+
+
+class StubStepFunctions:
+    """Records the executions a function starts, the harness runs them in the same thread"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def start_execution(self, stateMachineArn, input, **kwargs):
+        self.executions().append(json.loads(input))
+        return {'executionArn': f"{stateMachineArn}:benchmark"}
+
+    def executions(self):
+        if not hasattr(self.local, 'executions'):
+            self.local.executions = []
+        return self.local.executions
+
+    def take(self):
+        executions, self.local.executions = self.executions(), []
+        return executions
+
+
+# --- measurements ------------------------------------------------------------------------------
+
+class RequestCounter:
+    """Counts the AWS requests of every boto3 client created after it is registered"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def __call__(self, event_name, **kwargs):
+        _, service, operation = event_name.split('.', 2)
+        with self.lock:
+            self.counts[f"{service}.{operation}"] += 1
+
+    def register(self):
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register('before-call', self)
+
+
+class StageTimer:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.lock = threading.Lock()
+        self.wall = defaultdict(float)
+        self.calls = Counter()
+        self.peak = defaultdict(int)
+
+    def run(self, stage, function, *args):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.wall[stage] += elapsed
+            self.calls[stage] += 1
+            if self.trace_memory:
+                self.peak[stage] = max(self.peak[stage], tracemalloc.get_traced_memory()[1])
+        return result
+
+
+# --- pipeline ------------------------------------------------------------------------------
+
+def create_resources(s3, dynamodb):
+    s3.create_bucket(Bucket=BUCKET)
+    string = lambda *names: [{'AttributeName': name, 'AttributeType': 'S'} for name in names]
+    key = lambda partition, sort=None: [{'AttributeName': partition, 'KeyType': 'HASH'}] + \
+        ([{'AttributeName': sort, 'KeyType': 'RANGE'}] if sort else [])
+    dynamodb.create_table(
+        TableName=TABLES['documents'], BillingMode='PAY_PER_REQUEST',
+        KeySchema=key('group', 'filename'), AttributeDefinitions=string('group', 'filename', 'content_sha256'),
+        GlobalSecondaryIndexes=[{'IndexName': 'content_sha256', 'KeySchema': key('content_sha256', 'group'),
+                                 'Projection': {'ProjectionType': 'INCLUDE',
+                                                'NonKeyAttributes': ['uuid', 'extraction', 'duplicate_of']}}])
+    for table in (TABLES['small'], TABLES['big']):
+        dynamodb.create_table(
+            TableName=table, BillingMode='PAY_PER_REQUEST',
+            KeySchema=key('id', 'filename'),
+            AttributeDefinitions=string('id', 'filename', 'group', 'canonical_id', 'canonical_filename'),
+            GlobalSecondaryIndexes=[
+                {'IndexName': 'group', 'KeySchema': key('group', 'filename'), 'Projection': {'ProjectionType': 'ALL'}},
+                {'IndexName': 'canonical', 'KeySchema': key('canonical_id', 'canonical_filename'),
+                 'Projection': {'ProjectionType': 'KEYS_ONLY'}}])
+    dynamodb.create_table(TableName=TABLES['embedding_cache'], BillingMode='PAY_PER_REQUEST',
+                          KeySchema=key('content_hash'), AttributeDefinitions=string('content_hash'))
+    dynamodb.create_table(TableName=TABLES['signatures'], BillingMode='PAY_PER_REQUEST',
+                          KeySchema=key('band'), AttributeDefinitions=string('band'))
+
+
+class Pipeline:
+    def __init__(self, functions, sfn, timer, pages_per_batch, map_concurrency):
+        self.f = functions
+        self.sfn = sfn
+        self.timer = timer
+        self.pages_per_batch = pages_per_batch
+        self.map_concurrency = map_concurrency
+
+    def store(self, output):
+        chunked = self.timer.run('ChunkRawData', self.f['chunk_raw_data'].handler, {'Payload': output}, None)
+        return self.timer.run('StoreChunkDynamo', self.f['store_chunk_dynamo'].handler, {'Payload': chunked}, None)
+
+    def textract_branch(self, read_output, key):
+        if read_output.get('JobID') and not read_output.get('Output') and 'textract job' not in str(read_output['JobID']):
+            message = {'JobId': read_output['JobID'], 'Status': 'SUCCEEDED',
+                       'DocumentLocation': {'S3Bucket': BUCKET, 'S3ObjectName': key}}
+            self.timer.run('SNSProcess', self.f['sns'].handler, {'Records': [{'Sns': {'Message': json.dumps(message)}}]}, None)
+        for execution in self.sfn.take():
+            raw = self.timer.run('StoreRawDocs', self.f['store_raw_docs'].handler, execution, None)
+            self.store(raw)
+
+    def llm_branch(self, read_output):
+        prefix = read_output['pages_prefix']
+        s3 = self.f['llm_extractor'].boto3.client('s3')
+        keys = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=f"{prefix}_"):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        batches = [keys[i:i + self.pages_per_batch] for i in range(0, len(keys), self.pages_per_batch)]
+        run = lambda batch: self.timer.run('PagesProcess', self.f['llm_extractor'].handler,
+                                           {'Items': [{'Key': key} for key in batch], 'BatchInput': {'Bucket': BUCKET}}, None)
+        with ThreadPoolExecutor(max_workers=self.map_concurrency) as executor:
+            list(executor.map(run, batches))
+        joined = self.timer.run('RawDataJoiner', self.f['consolidator'].handler, {'Prefix': prefix}, None)
+        self.store({'Output': f"s3://{BUCKET}/{joined['output_key']}"})
+
+    def ingest(self, key):
+        event = {'detail': {'bucket': {'name': BUCKET}, 'object': {'key': key}}}
+        output = self.timer.run('ReadDocs', self.f['read_docs'].handler, event, None)
+        if output.get('route') in ('textract', 'both') and not output.get('duplicate_of'):
+            self.textract_branch(output, key)
+        if output.get('run_llm'):
+            self.llm_branch(output)
+
+
+def report(args, elapsed, timer, requests, textract, bedrock_client, documents, pages):
+    print(f"\n{documents} documents, {pages} pages, route {args.route}, concurrency {args.concurrency}")
+    print(f"wall time {elapsed:.2f}s, {documents / elapsed * 60:.1f} documents/min, {pages / elapsed * 60:.1f} pages/min")
+    print(f"\n{'stage':<18}{'calls':>8}{'wall s':>10}{'avg ms':>10}{'peak MB':>10}")
+    for stage in ('ReadDocs', 'SNSProcess', 'StoreRawDocs', 'PagesProcess', 'RawDataJoiner', 'ChunkRawData', 'StoreChunkDynamo'):
+        if timer.calls[stage]:
+            peak = f"{timer.peak[stage] / 1024 / 1024:.1f}" if timer.trace_memory else '-'
+            print(f"{stage:<18}{timer.calls[stage]:>8}{timer.wall[stage]:>10.2f}"
+                  f"{timer.wall[stage] / timer.calls[stage] * 1000:>10.1f}{peak:>10}")
+    print("\nAWS requests")
+    for operation, count in sorted(requests.counts.items()):
+        print(f"  {operation:<45}{count:>8}")
+    print("\nTextract stub")
+    for operation, count in sorted(textract.counts.items()):
+        print(f"  {operation:<45}{count:>8}")
+    print("\nBedrock (shared client)")
+    for model_id, values in bedrock_client.get_metrics().items():
+        print(f"  {model_id}: calls {values['calls']}, throttles {values['throttles']}, retries {values['retries']}, "
+              f"errors {values['errors']}, concurrency limit {values['concurrency_limit']}")
+    # ru_maxrss is in KB on Linux
+    print(f"\npeak RSS of the process {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def add_arguments(parser):
+    """Corpus and stand-in options, shared with state_machine_runner.py"""
+    parser.add_argument('--documents', type=int, default=10)
+    parser.add_argument('--pages', type=int, default=10, help='pages per document')
+    parser.add_argument('--scanned', type=float, default=0.2, help='share of scanned pages (no text layer)')
+    parser.add_argument('--template-pages', type=int, default=0, help='leading pages identical in every document')
+    parser.add_argument('--route', choices=['textract', 'llm', 'both', 'auto'], default='both')
+    parser.add_argument('--textract-latency', type=float, default=0.0, help='seconds per Textract call')
+    parser.add_argument('--textract-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--bedrock-latency', type=float, default=0.0, help='seconds per converse call')
+    parser.add_argument('--embedding-latency', type=float, default=0.0, help='seconds per embedding call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of throttled Bedrock calls')
+    parser.add_argument('--embedding-dimensions', type=int, default=1024)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--verbose', action='store_true', help='keep the INFO logs of the functions')
+
+
+@contextmanager
+def local_services(args):
+    """
+    moto S3/DynamoDB with the benchmark resources and the generated corpus uploaded, the
+    functions imported with their Textract, Bedrock and Step Functions clients replaced by stubs
+    """
+    configure_environment(args)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    corpus = generate_corpus(args.documents, args.pages, args.scanned, args.template_pages, args.seed)
+    with mock_aws():
+        # mock_aws resets the default session, the counter is registered on the new one
+        requests = RequestCounter()
+        requests.register()
+        s3 = boto3.client('s3')
+        create_resources(s3, boto3.client('dynamodb'))
+        # the functions create their clients at import time, inside the mock
+        import bedrock_client
+        import bulk_delete
+        import chunk_raw_data
+        import consolidator
+        import llm_extractor
+        import read_docs
+        import sns
+        import store_chunk_dynamo
+        import store_raw_docs
+        textract = StubTextract(s3, args.textract_latency, args.textract_throttle_rate, args.seed)
+        bedrock = StubBedrock(args.bedrock_latency, args.embedding_latency, args.throttle_rate,
+                              args.embedding_dimensions, args.seed)
+        shared_client = bedrock_client.get_bedrock_client()
+        shared_client.client = bedrock
+        sfn = StubStepFunctions()
+        read_docs.textract = sns.textract = textract
+        read_docs.sfn = sns.sfn = sfn
+        functions = {
+            'read_docs': read_docs, 'sns': sns, 'store_raw_docs': store_raw_docs, 'llm_extractor': llm_extractor,
+            'consolidator': consolidator, 'chunk_raw_data': chunk_raw_data, 'store_chunk_dynamo': store_chunk_dynamo,
+            'bulk_delete': bulk_delete,
+        }
+        keys = []
+        for name, body in corpus.items():
+            key = f"raw_docs/{GROUP}/{name}"
+            s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+            keys.append(key)
+        requests.counts.clear()
+        yield SimpleNamespace(s3=s3, functions=functions, textract=textract, bedrock=shared_client, sfn=sfn,
+                              requests=requests, keys=keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--concurrency', type=int, default=1, help='documents ingested in parallel')
+    parser.add_argument('--pages-per-batch', type=int, default=4, help='page objects per PagesProcess invocation')
+    parser.add_argument('--map-concurrency', type=int, default=10, help='concurrent PagesProcess invocations per document')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false')
+    args = parser.parse_args()
+
+    with local_services(args) as services:
+        trace_memory = args.trace_memory and args.concurrency == 1
+        timer = StageTimer(trace_memory)
+        pipeline = Pipeline(services.functions, services.sfn, timer, args.pages_per_batch, args.map_concurrency)
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(pipeline.ingest, services.keys))
+        elapsed = time.perf_counter() - started
+        if trace_memory:
+            tracemalloc.stop()
+        report(args, elapsed, timer, services.requests, services.textract, services.bedrock,
+               len(services.keys), args.documents * args.pages)
+
+
+if __name__ == '__main__':
+    main()
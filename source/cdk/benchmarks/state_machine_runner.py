@@ -0,0 +1,805 @@
+"""
+STATE_MACHINE_RUNNER:
+Runs the state machines of the stack locally, to profile executions without deploying:
+- AIbotSMLLMParser (chatbot/llmparser-stepfunction.json), started for every upload
+- AIbotSM, the Textract chain built by ChatbotStack.create_state_machine (textract_definition)
+- AIbotSMDeletion (chatbot/delete-stepfunction.json), started by the documents API
+
+StateMachineRunner interprets the subset of the Amazon States Language these definitions use:
+Task (lambda:invoke, the dynamodb optimized integrations and aws-sdk:s3 / aws-sdk:dynamodb),
+Map (inline, or distributed with ItemReader s3:listObjectsV2 and ItemBatcher), Parallel, Choice,
+Pass, Wait, Succeed and Fail, InputPath / Parameters / ItemSelector / ResultSelector /
+ResultPath / OutputPath, Retry and Catch, and the intrinsic functions States.Format,
+States.Array, States.ArrayLength, States.JsonToString, States.StringToJson, States.MathAdd and
+States.UUID. Lambda tasks call the handlers in process, service tasks call boto3 clients.
+Not supported: TimeoutSeconds / HeartbeatSeconds, .sync and .waitForTaskToken integrations,
+ResultWriter and JSONata.
+
+Every state run is recorded in a timing trace (execution, state path, type, start offset,
+duration, attempts, retry wait, output size, error). The report gives per state the runs, total
+and maximum duration and retries, the effective concurrency of the Map states and the time
+each execution spends outside its states (the interpreter and --transition-latency, which adds
+a delay per state transition to approximate the service).
+
+The command line runs the pipelines on the generated corpus and local stand-ins of
+ingestion_benchmark.py (moto S3/DynamoDB, Textract and Bedrock stubs): the LLM parser
+execution of every document, the Textract executions it triggers, and with --delete the deletion
+of every document.
+
+Usage (from source/cdk, with requirements-dev.txt installed):
+    python benchmarks/state_machine_runner.py --documents 5 --pages 12
+    python benchmarks/state_machine_runner.py --documents 5 --pages 40 --scanned 0.5 --route llm \\
+        --page-fan-out '{"maxConcurrency": 4, "pagesPerBatch": 2}' --bedrock-latency 0.5 --trace trace.jsonl
+Retry waits and Wait states sleep for their ASL duration times --retry-scale.
+"""
+
+import argparse
+import ast
+import copy
+import fnmatch
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+
+CHATBOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chatbot')
+MAX_STATE_SIZE = 256 * 1024
+LAMBDA_RETRY_ERRORS = [
+    "Lambda.ClientExecutionTimeoutException",
+    "Lambda.ServiceException",
+    "Lambda.AWSLambdaException",
+    "Lambda.SdkClientException"
+]
+SERVICE_ERROR_PREFIX = {'dynamodb': 'DynamoDb', 's3': 'S3'}
+PATH_TOKEN = re.compile(r"\.([^.\[\]]+)|\[(\d+)\]|\['([^']*)'\]")
+NUMBER = re.compile(r"-?\d+(\.\d+)?([eE][-+]?\d+)?")
+
+
+class StatesError(Exception):
+    """Error of a state, matched by ErrorEquals of the Retry and Catch fields"""
+
+    def __init__(self, error, cause=''):
+        super().__init__(f"{error}: {cause}")
+        self.error = error
+        self.cause = cause
+
+
+# --- definitions ----------------------------------------------------------------------------
+
+def load_definition(file_name):
+    with open(os.path.join(CHATBOT_DIR, file_name), 'r') as file:
+        return json.load(file)
+
+
+def llm_parser_definition(page_fan_out=None):
+    """llmparser-stepfunction.json with the page fan-out applied like build_parser_document_state_machine"""
+    definition = load_definition('llmparser-stepfunction.json')
+    page_fan_out = {"maxConcurrency": 10, "pagesPerBatch": 4, **(page_fan_out or {})}
+    map_pages = definition["States"]["Map_pages"]
+    map_pages["MaxConcurrency"] = int(page_fan_out["maxConcurrency"])
+    map_pages["ItemBatcher"]["MaxItemsPerBatch"] = int(page_fan_out["pagesPerBatch"])
+    return definition
+
+
+def delete_definition():
+    return load_definition('delete-stepfunction.json')
+
+
+def stack_method(name):
+    """AST of a method of ChatbotStack, read from chatbot_stack.py without importing aws_cdk"""
+    with open(os.path.join(CHATBOT_DIR, 'chatbot_stack.py'), 'r') as file:
+        tree = ast.parse(file.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            return node
+    raise ValueError(f"ChatbotStack.{name} not found in chatbot_stack.py")
+
+
+def lambda_invoke_chain(method):
+    """
+    (state name, lambda attribute of the stack) of the tasks.LambdaInvoke chained in the
+    DefinitionBody.from_chainable call of `method`, in order. Only the LambdaInvoke defaults are
+    modelled, any other argument or chained construct is an error.
+    """
+    invokes = {}
+    chain = None
+    for node in ast.walk(method):
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) \
+                and ast.unparse(node.value.func) == 'tasks.LambdaInvoke':
+            call = node.value
+            keywords = {keyword.arg: keyword.value for keyword in call.keywords}
+            if set(keywords) != {'lambda_function'}:
+                raise ValueError(f"Unsupported LambdaInvoke arguments in {method.name}: {ast.unparse(call)}")
+            invokes[node.targets[0].id] = (call.args[1].value, ast.unparse(keywords['lambda_function']))
+        if isinstance(node, ast.Call) and ast.unparse(node.func).endswith('DefinitionBody.from_chainable'):
+            chain = node.args[0]
+    if chain is None:
+        raise ValueError(f"No DefinitionBody.from_chainable call in {method.name}")
+    states = []
+    while isinstance(chain, ast.Call) and isinstance(chain.func, ast.Attribute) and chain.func.attr == 'next':
+        states.insert(0, chain.args[0])
+        chain = chain.func.value
+    states.insert(0, chain)
+    if not all(isinstance(state, ast.Name) and state.id in invokes for state in states):
+        raise ValueError(f"Unsupported chain in {method.name}: {ast.unparse(method)}")
+    return [invokes[state.id] for state in states]
+
+
+def textract_definition():
+    """
+    AIbotSM as ChatbotStack.create_state_machine builds it: the LambdaInvoke states of its chain
+    in order, named like the stack, with the LambdaInvoke defaults (the whole input as payload,
+    the invocation result (Payload, StatusCode) as output and the retry on Lambda service
+    errors). FunctionName is the stack attribute of the lambda, e.g. self.step2.
+    """
+    def invoke(function_name, next_state=None):
+        state = {
+            "Type": "Task",
+            "Resource": "arn:aws:states:::lambda:invoke",
+            "Parameters": {"FunctionName": function_name, "Payload.$": "$"},
+            "Retry": [{
+                "ErrorEquals": LAMBDA_RETRY_ERRORS + ["Lambda.TooManyRequestsException"],
+                "IntervalSeconds": 2,
+                "MaxAttempts": 6,
+                "BackoffRate": 2
+            }]
+        }
+        if next_state:
+            state["Next"] = next_state
+        else:
+            state["End"] = True
+        return state
+
+    chain = lambda_invoke_chain(stack_method('create_state_machine'))
+    next_states = [name for name, _ in chain[1:]] + [None]
+    return {
+        "StartAt": chain[0][0],
+        "States": {name: invoke(function, next_state) for (name, function), next_state in zip(chain, next_states)}
+    }
+
+
+# --- paths and intrinsic functions -----------------------------------------------------------
+
+def read_path(path, data, context):
+    """Value of a JSONPath reference ($.a.b, $.a[0], $$.Map.Item.Value)"""
+    if path.startswith('$$'):
+        data, rest = context, path[2:]
+    elif path.startswith('$'):
+        rest = path[1:]
+    else:
+        raise StatesError('States.Runtime', f"Invalid path {path}")
+    value = data
+    position = 0
+    while position < len(rest):
+        match = PATH_TOKEN.match(rest, position)
+        if not match:
+            raise StatesError('States.Runtime', f"Unsupported path {path}")
+        name, index, quoted = match.groups()
+        if index is not None:
+            if not isinstance(value, list) or int(index) >= len(value):
+                raise StatesError('States.Runtime', f"The JSONPath {path} could not be found in the input")
+            value = value[int(index)]
+        else:
+            key = name if name is not None else quoted
+            if not isinstance(value, dict) or key not in value:
+                raise StatesError('States.Runtime', f"The JSONPath {path} could not be found in the input")
+            value = value[key]
+        position = match.end()
+    return value
+
+
+def write_path(data, path, value):
+    """Copy of `data` with `value` at the ResultPath `path` ($ replaces the input)"""
+    if path == '$':
+        return value
+    keys = [name if name is not None else quoted for name, index, quoted in PATH_TOKEN.findall(path[1:])]
+    output = copy.deepcopy(data) if isinstance(data, dict) else {}
+    target = output
+    for key in keys[:-1]:
+        if not isinstance(target.get(key), dict):
+            target[key] = {}
+        target = target[key]
+    target[keys[-1]] = value
+    return output
+
+
+def unescape(text):
+    return re.sub(r'\\(.)', r'\1', text)
+
+
+def parse_argument(expression, position, data, context):
+    """(value, next position) of one argument of an intrinsic function"""
+    while expression[position] == ' ':
+        position += 1
+    if expression[position] == "'":
+        end = position + 1
+        while expression[end] != "'":
+            end += 2 if expression[end] == '\\' else 1
+        # escapes are kept, States.Format tells \{ from {}
+        return ('string', expression[position + 1:end]), end + 1
+    if expression.startswith('States.', position):
+        value, position = parse_call(expression, position, data, context)
+        return ('value', value), position
+    match = NUMBER.match(expression, position)
+    if match:
+        text = match.group(0)
+        return ('value', float(text) if match.group(1) or match.group(2) else int(text)), match.end()
+    for literal, value in (('true', True), ('false', False), ('null', None)):
+        if expression.startswith(literal, position):
+            return ('value', value), position + len(literal)
+    end = position
+    while expression[end] not in ',)':
+        end += 1
+    return ('value', read_path(expression[position:end].strip(), data, context)), end
+
+
+def parse_call(expression, position, data, context):
+    """(result, next position) of the intrinsic function call at `position`"""
+    open_paren = expression.index('(', position)
+    name = expression[position:open_paren].strip()
+    position = open_paren + 1
+    arguments = []
+    while expression[position] == ' ':
+        position += 1
+    while expression[position] != ')':
+        argument, position = parse_argument(expression, position, data, context)
+        arguments.append(argument)
+        while expression[position] == ' ':
+            position += 1
+        if expression[position] == ',':
+            position += 1
+    return call_intrinsic(name, arguments), position + 1
+
+
+def call_intrinsic(name, arguments):
+    values = [unescape(value) if kind == 'string' else value for kind, value in arguments]
+    if name == 'States.Format':
+        kind, template = arguments[0]
+        parts = re.split(r'(\\.|\{\})', template)
+        fields = iter(values[1:])
+        output = []
+        try:
+            for part in parts:
+                if part == '{}':
+                    value = next(fields)
+                    output.append(value if isinstance(value, str) else json.dumps(value, separators=(',', ':')))
+                else:
+                    output.append(unescape(part))
+        except StopIteration:
+            raise StatesError('States.IntrinsicFailure', f"Not enough arguments for {template}")
+        return ''.join(output)
+    if name == 'States.Array':
+        return values
+    if name == 'States.ArrayLength':
+        return len(values[0])
+    if name == 'States.JsonToString':
+        return json.dumps(values[0], separators=(',', ':'))
+    if name == 'States.StringToJson':
+        return json.loads(values[0])
+    if name == 'States.MathAdd':
+        return values[0] + values[1]
+    if name == 'States.UUID':
+        return str(uuid.uuid4())
+    raise StatesError('States.IntrinsicFailure', f"Unsupported intrinsic function {name}")
+
+
+def evaluate(expression, data, context):
+    if expression.startswith('States.'):
+        return parse_call(expression, 0, data, context)[0]
+    return read_path(expression, data, context)
+
+
+def render(template, data, context):
+    """Payload template: the values of the fields ending with .$ are paths or intrinsic functions"""
+    if isinstance(template, dict):
+        return {
+            (key[:-2] if key.endswith('.$') else key):
+                (evaluate(value, data, context) if key.endswith('.$') else render(value, data, context))
+            for key, value in template.items()
+        }
+    if isinstance(template, list):
+        return [render(value, data, context) for value in template]
+    return template
+
+
+def to_json(value):
+    """JSON copy of a function or service result, as Step Functions serializes it"""
+    def default(obj):
+        if isinstance(obj, Decimal):
+            return int(obj) if obj == obj.to_integral_value() else float(obj)
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        if isinstance(obj, bytes):
+            return obj.decode('utf-8', errors='replace')
+        raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+    return json.loads(json.dumps(value, default=default))
+
+
+# --- choice rules ---------------------------------------------------------------------------
+
+COMPARISONS = {
+    'Equals': lambda a, b: a == b,
+    'LessThan': lambda a, b: a < b,
+    'GreaterThan': lambda a, b: a > b,
+    'LessThanEquals': lambda a, b: a <= b,
+    'GreaterThanEquals': lambda a, b: a >= b,
+}
+TYPE_CHECKS = {
+    'String': lambda value: isinstance(value, str),
+    'Numeric': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'Boolean': lambda value: isinstance(value, bool),
+    'Timestamp': lambda value: isinstance(value, str),
+}
+
+
+def choice_matches(rule, data, context):
+    if 'And' in rule:
+        return all(choice_matches(child, data, context) for child in rule['And'])
+    if 'Or' in rule:
+        return any(choice_matches(child, data, context) for child in rule['Or'])
+    if 'Not' in rule:
+        return not choice_matches(rule['Not'], data, context)
+    try:
+        value = read_path(rule['Variable'], data, context)
+        present = True
+    except StatesError:
+        value, present = None, False
+    if 'IsPresent' in rule:
+        return present == rule['IsPresent']
+    if not present:
+        raise StatesError('States.Runtime', f"Invalid path {rule['Variable']}: the choice state's condition path references an invalid value")
+    if 'IsNull' in rule:
+        return (value is None) == rule['IsNull']
+    for kind, check in TYPE_CHECKS.items():
+        if f"Is{kind}" in rule:
+            return check(value) == rule[f"Is{kind}"]
+    if 'StringMatches' in rule:
+        return isinstance(value, str) and fnmatch.fnmatchcase(value, rule['StringMatches'])
+    for field, expected in rule.items():
+        if field.endswith('Path') and field != 'Variable':
+            field, expected = field[:-4], read_path(expected, data, context)
+        for kind, check in TYPE_CHECKS.items():
+            if field.startswith(kind) and field[len(kind):] in COMPARISONS:
+                return check(value) and check(expected) and COMPARISONS[field[len(kind):]](value, expected)
+    raise StatesError('States.Runtime', f"Unsupported choice rule {json.dumps(rule)}")
+
+
+def error_matches(error_equals, error):
+    return error in error_equals or 'States.ALL' in error_equals or \
+        ('States.TaskFailed' in error_equals and error != 'States.Timeout')
+
+
+# --- interpreter ----------------------------------------------------------------------------
+
+class StateMachineRunner:
+    """
+    Runs state machine definitions in process. `functions` maps the FunctionName of the lambda
+    tasks (the placeholders of the definitions, qualifiers are ignored) to handlers, `client`
+    creates the boto3 clients of the service tasks.
+    """
+
+    def __init__(self, functions, client=boto3.client, retry_scale=1.0, transition_latency=0.0, max_threads=64):
+        self.functions = functions
+        self.create_client = client
+        self.clients = {}
+        self.retry_scale = retry_scale
+        self.transition_latency = transition_latency
+        self.max_threads = max_threads
+        self.trace = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def client(self, service):
+        with self.lock:
+            if service not in self.clients:
+                self.clients[service] = self.create_client(service)
+            return self.clients[service]
+
+    def record(self, **event):
+        with self.lock:
+            self.trace.append(event)
+
+    def execute(self, definition, execution_input, name=None, state_machine='local'):
+        """
+        Runs one execution.
+
+        Returns:
+            dict: name, status (SUCCEEDED or FAILED), output, error, cause, duration
+        """
+        name = name or str(uuid.uuid4())
+        context = {
+            'Execution': {'Id': f"local:{state_machine}:{name}", 'Name': name, 'Input': execution_input,
+                          'StartTime': datetime.now(timezone.utc).isoformat()},
+            'StateMachine': {'Id': f"local:{state_machine}", 'Name': state_machine}
+        }
+        started = time.perf_counter()
+        result = {'name': name, 'state_machine': state_machine, 'status': 'SUCCEEDED',
+                  'output': None, 'error': None, 'cause': None}
+        try:
+            result['output'] = self.run_states(definition, execution_input, context, '', name)
+        except StatesError as e:
+            result.update(status='FAILED', error=e.error, cause=e.cause)
+        result['duration'] = time.perf_counter() - started
+        self.record(execution=name, state_machine=state_machine, state=None, type='Execution',
+                    start=started - self.origin, duration=result['duration'], status=result['status'],
+                    error=result['error'])
+        return result
+
+    def run_states(self, machine, data, context, path, execution):
+        name = machine['StartAt']
+        while True:
+            state = machine['States'][name]
+            if self.transition_latency:
+                time.sleep(self.transition_latency)
+            started = time.perf_counter()
+            event = {'execution': execution, 'state': path + name, 'type': state['Type'], 'start': started - self.origin,
+                     'iteration': context.get('Map', {}).get('Item', {}).get('Index'), 'attempts': 1, 'retry_wait': 0.0}
+            state_context = {**context, 'State': {'Name': name, 'EnteredTime': datetime.now(timezone.utc).isoformat(),
+                                                  'RetryCount': 0}}
+            try:
+                data, next_name = self.run_state(name, state, data, state_context, path, execution, event)
+                size = len(json.dumps(data))
+                if size > MAX_STATE_SIZE:
+                    raise StatesError('States.DataLimitExceeded', f"The state/task {name} returned a result of {size} bytes")
+            except StatesError as e:
+                self.record(**event, duration=time.perf_counter() - started, status='FAILED', error=e.error,
+                            output_bytes=None)
+                raise
+            self.record(**event, duration=time.perf_counter() - started, status='SUCCEEDED', error=None,
+                        output_bytes=size)
+            if next_name is None:
+                return data
+            name = next_name
+
+    def run_state(self, name, state, data, context, path, execution, event):
+        """(output, next state name or None) of one state"""
+        kind = state['Type']
+        if kind == 'Fail':
+            raise StatesError(state.get('Error', 'States.Fail'), state.get('Cause', ''))
+        effective = self.input_path(state, data, context)
+        if kind == 'Choice':
+            for rule in state['Choices']:
+                if choice_matches(rule, effective, context):
+                    return self.output_path(state, effective, context), rule['Next']
+            if 'Default' not in state:
+                raise StatesError('States.NoChoiceMatched', f"No choice of {name} matched")
+            return self.output_path(state, effective, context), state['Default']
+        if kind == 'Succeed':
+            return self.output_path(state, effective, context), None
+        if kind == 'Wait':
+            seconds = read_path(state['SecondsPath'], effective, context) if 'SecondsPath' in state else state.get('Seconds', 0)
+            time.sleep(seconds * self.retry_scale)
+            return self.output_path(state, effective, context), self.next_state(state)
+        if kind == 'Pass':
+            result = render(state['Parameters'], effective, context) if 'Parameters' in state else state.get('Result', effective)
+            return self.finish(state, data, result, context), self.next_state(state)
+        if kind not in ('Task', 'Map', 'Parallel'):
+            raise StatesError('States.Runtime', f"Unsupported state type {kind}")
+        try:
+            result = self.with_retry(state, event, lambda: self.run_work(name, state, effective, context, path, execution))
+        except StatesError as e:
+            for catcher in state.get('Catch', []):
+                if error_matches(catcher['ErrorEquals'], e.error):
+                    error_output = {'Error': e.error, 'Cause': e.cause}
+                    result_path = catcher.get('ResultPath', '$')
+                    output = data if result_path is None else write_path(data, result_path, error_output)
+                    return output, catcher['Next']
+            raise
+        if 'ResultSelector' in state:
+            result = render(state['ResultSelector'], result, context)
+        return self.finish(state, data, result, context), self.next_state(state)
+
+    def input_path(self, state, data, context):
+        if 'InputPath' not in state:
+            return data
+        return {} if state['InputPath'] is None else read_path(state['InputPath'], data, context)
+
+    def output_path(self, state, data, context):
+        if 'OutputPath' not in state:
+            return data
+        return {} if state['OutputPath'] is None else read_path(state['OutputPath'], data, context)
+
+    def finish(self, state, data, result, context):
+        result_path = state.get('ResultPath', '$')
+        output = data if result_path is None else write_path(data, result_path, result)
+        return self.output_path(state, output, context)
+
+    @staticmethod
+    def next_state(state):
+        return None if state.get('End') else state['Next']
+
+    def with_retry(self, state, event, work):
+        """Runs `work` under the Retry field: the first retrier matching the error applies"""
+        retriers = state.get('Retry', [])
+        retries = [0] * len(retriers)
+        while True:
+            try:
+                return work()
+            except StatesError as e:
+                for number, retrier in enumerate(retriers):
+                    if error_matches(retrier['ErrorEquals'], e.error):
+                        if retries[number] >= retrier.get('MaxAttempts', 3):
+                            raise
+                        delay = retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** retries[number]
+                        delay = min(delay, retrier.get('MaxDelaySeconds', delay))
+                        if retrier.get('JitterStrategy') == 'FULL':
+                            delay = random.uniform(0, delay)
+                        retries[number] += 1
+                        event['attempts'] += 1
+                        event['retry_wait'] += delay
+                        time.sleep(delay * self.retry_scale)
+                        break
+                else:
+                    raise
+
+    def run_work(self, name, state, data, context, path, execution):
+        if state['Type'] == 'Task':
+            return self.run_task(state, render(state.get('Parameters'), data, context) if 'Parameters' in state else data)
+        if state['Type'] == 'Parallel':
+            return self.run_parallel(name, state, data, context, path, execution)
+        return self.run_map(name, state, data, context, path, execution)
+
+    # --- tasks -------------------------------------------------------------------------------
+
+    def run_task(self, state, parameters):
+        resource = state['Resource']
+        if resource == 'arn:aws:states:::lambda:invoke':
+            payload = self.invoke(parameters['FunctionName'], parameters.get('Payload', {}))
+            return {'ExecutedVersion': '$LATEST', 'Payload': payload, 'StatusCode': 200}
+        if resource in self.functions:
+            # lambda arn as resource, the output is the payload
+            return self.invoke(resource, parameters)
+        if resource.startswith('arn:aws:states:::dynamodb:'):
+            return self.call_service('dynamodb', resource.split(':')[-1], parameters, 'DynamoDB')
+        if resource.startswith('arn:aws:states:::aws-sdk:'):
+            service, action = resource.split(':')[-2:]
+            return self.call_service(service, action, parameters,
+                                     SERVICE_ERROR_PREFIX.get(service, service.capitalize()), suffix='Exception')
+        raise StatesError('States.Runtime', f"Unsupported resource {resource}")
+
+    def invoke(self, function_name, payload):
+        handler = self.functions.get(function_name) or self.functions.get(function_name.split(':')[0])
+        if handler is None:
+            raise StatesError('Lambda.ResourceNotFoundException', f"Function not found: {function_name}")
+        try:
+            # the handler gets its own copy, as a serialized invocation payload
+            return to_json(handler(to_json(payload), None))
+        except Exception as e:
+            # the error name of a function error is its errorType
+            raise StatesError(type(e).__name__, json.dumps({'errorMessage': str(e), 'errorType': type(e).__name__}))
+
+    def call_service(self, service, action, parameters, error_prefix, suffix=''):
+        method = getattr(self.client(service), re.sub(r'(?<!^)(?=[A-Z])', '_', action).lower())
+        try:
+            response = method(**parameters)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            raise StatesError(f"{error_prefix}.{code}{'' if code.endswith('Exception') else suffix}",
+                              e.response['Error'].get('Message', ''))
+        response.pop('ResponseMetadata', None)
+        return to_json(response)
+
+    # --- map and parallel --------------------------------------------------------------------
+
+    def read_items(self, reader, data, context):
+        parameters = render(reader.get('Parameters', {}), data, context)
+        max_items = reader.get('ReaderConfig', {}).get('MaxItems')
+        if reader['Resource'] == 'arn:aws:states:::s3:listObjectsV2':
+            items = []
+            for page in self.client('s3').get_paginator('list_objects_v2').paginate(**parameters):
+                # the item shape of the service reader, which spells Etag unlike the S3 API
+                items.extend({'Key': obj['Key'], 'Size': obj['Size'], 'Etag': obj['ETag'],
+                              'LastModified': obj['LastModified'], 'StorageClass': obj.get('StorageClass', 'STANDARD')}
+                             for obj in page.get('Contents', []))
+            items = to_json(items)
+        elif reader['Resource'] == 'arn:aws:states:::s3:getObject':
+            body = self.client('s3').get_object(**parameters)['Body'].read()
+            items = json.loads(body)
+        else:
+            raise StatesError('States.Runtime', f"Unsupported item reader {reader['Resource']}")
+        return items[:max_items] if max_items else items
+
+    def run_map(self, name, state, data, context, path, execution):
+        if 'ItemReader' in state:
+            items = self.read_items(state['ItemReader'], data, context)
+        else:
+            items = read_path(state.get('ItemsPath', '$'), data, context)
+        if not isinstance(items, list):
+            raise StatesError('States.Runtime', f"The items of {name} are not an array")
+        selector = state.get('ItemSelector', state.get('Parameters'))
+        if selector is not None:
+            items = [render(selector, data, {**context, 'Map': {'Item': {'Index': index, 'Value': item}}})
+                     for index, item in enumerate(items)]
+        batcher = state.get('ItemBatcher')
+        if batcher:
+            size = batcher.get('MaxItemsPerBatch') or len(items) or 1
+            batch_input = render(batcher['BatchInput'], data, context) if 'BatchInput' in batcher else None
+            items = [{**({'BatchInput': batch_input} if batch_input is not None else {}), 'Items': items[i:i + size]}
+                     for i in range(0, len(items), size)]
+        processor = state.get('ItemProcessor', state.get('Iterator'))
+        concurrency = min(state.get('MaxConcurrency') or self.max_threads, self.max_threads)
+
+        def run_item(index):
+            item_context = {**context, 'Map': {'Item': {'Index': index, 'Value': items[index]}}}
+            return self.run_states(processor, items[index], item_context, f"{path}{name}/", execution)
+
+        results, failures = self.fan_out(run_item, len(items), concurrency)
+        tolerated = 'ToleratedFailurePercentage' in state or 'ToleratedFailureCount' in state
+        if failures and not tolerated:
+            raise next(iter(failures.values()))
+        if failures:
+            allowed = max(state.get('ToleratedFailureCount', 0),
+                          len(items) * state.get('ToleratedFailurePercentage', 0) / 100)
+            if len(failures) > allowed:
+                raise StatesError('States.ExceedToleratedFailureThreshold',
+                                  f"{len(failures)} of {len(items)} items of {name} failed")
+            for index, error in failures.items():
+                results[index] = {'Error': error.error, 'Cause': error.cause}
+        return results
+
+    def run_parallel(self, name, state, data, context, path, execution):
+        branches = state['Branches']
+
+        def run_branch(index):
+            return self.run_states(branches[index], data, context, f"{path}{name}/{index}/", execution)
+
+        results, failures = self.fan_out(run_branch, len(branches), len(branches))
+        if failures:
+            raise failures[min(failures)]
+        return results
+
+    def fan_out(self, work, count, concurrency):
+        """Results of work(0..count-1) on `concurrency` threads and the errors by index"""
+        results = [None] * count
+        failures = {}
+
+        def run(index):
+            try:
+                results[index] = work(index)
+            except StatesError as e:
+                failures[index] = e
+
+        if count:
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, count))) as executor:
+                list(executor.map(run, range(count)))
+        return results, failures
+
+
+# --- report -----------------------------------------------------------------------------------
+
+def summarize(trace):
+    """Per state path: runs, failures, total, max and retries; per execution: time outside the states"""
+    states = defaultdict(lambda: {'runs': 0, 'failed': 0, 'total': 0.0, 'max': 0.0, 'retries': 0, 'retry_wait': 0.0,
+                                  'type': None, 'first': None, 'last': None})
+    top_level = defaultdict(float)
+    executions = {}
+    for event in trace:
+        if event['type'] == 'Execution':
+            executions[event['execution']] = event
+            continue
+        row = states[event['state']]
+        row['type'] = event['type']
+        row['runs'] += 1
+        row['failed'] += event['status'] == 'FAILED'
+        row['total'] += event['duration']
+        row['max'] = max(row['max'], event['duration'])
+        row['retries'] += event['attempts'] - 1
+        row['retry_wait'] += event['retry_wait']
+        end = event['start'] + event['duration']
+        row['first'] = event['start'] if row['first'] is None else min(row['first'], event['start'])
+        row['last'] = end if row['last'] is None else max(row['last'], end)
+        if '/' not in event['state']:
+            top_level[event['execution']] += event['duration']
+    overhead = {name: event['duration'] - top_level[name] for name, event in executions.items()}
+    return states, executions, overhead
+
+
+def print_report(trace):
+    states, executions, overhead = summarize(trace)
+    by_machine = defaultdict(list)
+    for event in executions.values():
+        by_machine[event['state_machine']].append(event)
+    print(f"\n{'state machine':<22}{'executions':>11}{'failed':>8}{'total s':>10}{'avg s':>9}{'outside states ms':>19}")
+    for machine, events in by_machine.items():
+        total = sum(event['duration'] for event in events)
+        outside = sum(overhead[event['execution']] for event in events)
+        failed = sum(event['status'] == 'FAILED' for event in events)
+        print(f"{machine:<22}{len(events):>11}{failed:>8}{total:>10.2f}{total / len(events):>9.2f}"
+              f"{outside / len(events) * 1000:>19.2f}")
+    print(f"\n{'state':<38}{'type':<9}{'runs':>6}{'failed':>7}{'total s':>9}{'avg ms':>9}{'max ms':>9}{'retries':>8}")
+    for state, row in states.items():
+        print(f"{state:<38}{row['type']:<9}{row['runs']:>6}{row['failed']:>7}{row['total']:>9.2f}"
+              f"{row['total'] / row['runs'] * 1000:>9.1f}{row['max'] * 1000:>9.1f}{row['retries']:>8}")
+    for state, row in states.items():
+        children = [child for name, child in states.items() if name.startswith(f"{state}/") and name.count('/') == state.count('/') + 1]
+        if row['type'] == 'Map' and children and row['total']:
+            # child states of an item run one after the other, their sum is the time of the items
+            busy = sum(child['total'] for child in children)
+            print(f"{state}: {busy:.2f}s of item work in {row['total']:.2f}s, effective concurrency {busy / row['total']:.1f}")
+
+
+def main():
+    from ingestion_benchmark import BUCKET, GROUP, TABLES, add_arguments, local_services
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--concurrency', type=int, default=1, help='documents ingested in parallel')
+    parser.add_argument('--page-fan-out', type=json.loads, default=None,
+                        help='JSON maxConcurrency / pagesPerBatch of Map_pages, as the stack context pageFanOut')
+    parser.add_argument('--delete', action='store_true', help='run the deletion state machine for every document')
+    parser.add_argument('--retry-scale', type=float, default=1.0, help='factor applied to retry and Wait durations')
+    parser.add_argument('--transition-latency', type=float, default=0.0, help='seconds added per state transition')
+    parser.add_argument('--max-threads', type=int, default=64, help='threads per Map or Parallel state')
+    parser.add_argument('--trace', help='write the trace events to this JSON lines file')
+    args = parser.parse_args()
+
+    with local_services(args) as services:
+        f = services.functions
+        runner = StateMachineRunner({
+            '__READDOCS__': f['read_docs'].handler,
+            '__PAGEPROCESS__': f['llm_extractor'].handler,
+            '__RAWDATAJOINER__': f['consolidator'].handler,
+            '__CHUNKRAWDATA__': f['chunk_raw_data'].handler,
+            '__STORECHUNKDYNAMO__': f['store_chunk_dynamo'].handler,
+            # AIbotSM names its lambdas by their stack attribute (textract_definition)
+            'self.step2': f['store_raw_docs'].handler,
+            'self.step3': f['chunk_raw_data'].handler,
+            'self.step4': f['store_chunk_dynamo'].handler,
+            '__BULKDELETE__': f['bulk_delete'].handler,
+        }, retry_scale=args.retry_scale, transition_latency=args.transition_latency, max_threads=args.max_threads)
+        llm_parser, textract, deletion = llm_parser_definition(args.page_fan_out), textract_definition(), delete_definition()
+        notified = set()
+        notified_lock = threading.Lock()
+
+        def ingest(key):
+            name = key.split('/')[-1]
+            event = {'detail': {'bucket': {'name': BUCKET}, 'object': {'key': key}}}
+            runner.execute(llm_parser, event, name=f"{name}-llm", state_machine='AIbotSMLLMParser')
+            # the Textract job completion is delivered to SNSProcess, which starts AIbotSM
+            with notified_lock:
+                jobs = [job_id for job_id, location in services.textract.jobs.items()
+                        if location['Name'] == key and job_id not in notified]
+                notified.update(jobs)
+            for job_id in jobs:
+                message = {'JobId': job_id, 'Status': 'SUCCEEDED', 'DocumentLocation': {'S3Bucket': BUCKET, 'S3ObjectName': key}}
+                f['sns'].handler({'Records': [{'Sns': {'Message': json.dumps(message)}}]}, None)
+            for number, execution_input in enumerate(services.sfn.take()):
+                runner.execute(textract, execution_input, name=f"{name}-textract-{number}", state_machine='AIbotSM')
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(ingest, services.keys))
+        if args.delete:
+            for key in services.keys:
+                runner.execute(deletion, {
+                    'documentTable': TABLES['documents'], 'bigTable': TABLES['big'], 'smallTable': TABLES['small'],
+                    'fileStoreBucketName': BUCKET, 'group': GROUP, 'filename': key.split('/')[-1]
+                }, name=f"{key.split('/')[-1]}-delete", state_machine='AIbotSMDeletion')
+        elapsed = time.perf_counter() - started
+
+        failed = [event for event in runner.trace if event['type'] == 'Execution' and event['status'] == 'FAILED']
+        print(f"\n{len(services.keys)} documents, {elapsed:.2f}s, {len(failed)} failed executions")
+        for event in failed:
+            print(f"  {event['execution']}: {event['error']}")
+        print_report(runner.trace)
+        if args.trace:
+            with open(args.trace, 'w') as file:
+                for event in sorted(runner.trace, key=lambda event: event['start']):
+                    file.write(json.dumps(event) + '\n')
+            print(f"\n{len(runner.trace)} trace events written to {args.trace}")
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -203,10 +203,13 @@ class ChatbotStack(Stack):
             environment={
                 "DOCUMENTS_BUCKET_NAME": self.s3_file_bucket.bucket_name,
                 "DOCUMENTS_TABLE_NAME": self.table_documents.table_name,
-                "SATE_MACHINE": self.state_machine_textract.state_machine_arn
+                "SATE_MACHINE": self.state_machine_textract.state_machine_arn,
+                "TEXTRACT_OUTPUT_COMPRESS": "true",
+                "TEXTRACT_KEEP_GEOMETRY": "false"
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
+            layers=[self.common_layer]
         )
         self.step2sns.add_to_role_policy(
             iam.PolicyStatement(
@@ -318,7 +321,11 @@ class ChatbotStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_12,
             environment={
                     "BUCKET": self.s3_file_bucket.bucket_name,
-                    "UPLOAD_PREFIX": "raw_docs/"
+                    "UPLOAD_PREFIX": "raw_docs/",
+                    "MAX_FILE_SIZE_MB": "500",
+                    "MULTIPART_MIN_PART_SIZE_MB": "8",
+                    "TABLE_NAME_DOCUMENTS": self.table_documents.table_name,
+                    "CONTENT_INDEX": "content_sha256"
                 },
             timeout=Duration.seconds(20),
         )
@@ -376,6 +383,28 @@ class ChatbotStack(Stack):
             )
         )
         self.s3_file_bucket.grant_put(self.api_back_signed_url)
+        # resuming a multipart upload lists the parts already uploaded
+        self.api_back_signed_url.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["s3:ListMultipartUploadParts"],
+                resources=[self.s3_file_bucket.arn_for_objects("raw_docs/*")]
+            )
+        )
+        # uploads declaring their sha256 are checked against the content index
+        self.api_back_signed_url.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["dynamodb:Query"],
+                resources=[f"{self.table_documents.table_arn}/index/content_sha256"]
+            )
+        )
+        # a document only counts as a duplicate once its chunks were written under rag/
+        self.api_back_signed_url.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["s3:ListBucket"],
+                resources=[self.s3_file_bucket.bucket_arn],
+                conditions={"StringLike": {"s3:prefix": ["rag/*"]}}
+            )
+        )
 
     def create_api_gw(self):
         cloudfront_domain =  "https://"+self.cloudfront_website.distribution_domain_name
@@ -483,6 +512,34 @@ class ChatbotStack(Stack):
             }
         )
 
+        # multipart uploads, the same lambda dispatches on the resource path
+        self.api_backend_resource_multipart = self.api_backend_resource_presing.add_resource("multipart")
+        self.api_backend_resource_multipart.add_method(
+            "POST", api_back_signed_url_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=self.autorizer
+        )
+        self.api_backend_resource_multipart.add_method(
+            "GET", api_back_signed_url_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=self.autorizer,
+            request_parameters={
+                "method.request.querystring.file_name": True,
+                "method.request.querystring.upload_id": True,
+                "method.request.querystring.parts_total": True
+            },
+            request_validator_options={
+                "validate_request_parameters": True,
+                "request_validator_name": "validate-multipart_get"
+            }
+        )
+        for action in ("complete", "abort"):
+            self.api_backend_resource_multipart.add_resource(action).add_method(
+                "POST", api_back_signed_url_integration,
+                authorization_type=apigateway.AuthorizationType.COGNITO,
+                authorizer=self.autorizer
+            )
+
         # api_back_configure
         api_back_configure_integration = apigateway.LambdaIntegration(self.api_back_configure,
                 request_templates={"application/json": '{ "statusCode": "200" }'})
@@ -615,7 +672,9 @@ class ChatbotStack(Stack):
             # allow_origins=[cloudfront_domain],
             allowed_origins=['*'],
             allowed_methods=[s3.HttpMethods.PUT],
-            allowed_headers=['*']
+            allowed_headers=['*'],
+            # the browser needs the ETag of every part to complete a multipart upload
+            exposed_headers=['ETag']
             )
         self.client = self.user_pool.add_client("AIBot-client",
             o_auth=_cognito.OAuthSettings(
@@ -637,14 +696,14 @@ class ChatbotStack(Stack):
     def build_del_document_state_machine(self):
         with open('chatbot/delete-stepfunction.json', 'r') as file:
             state_machine_def = file.read()
-            
-            
+            state_machine_def = state_machine_def.replace("__BULKDELETE__", self.bulk_delete.function_arn)
 
         # Create the state machine
         self.state_machine_delete = sfn.StateMachine(
             self, "AIbotSMDeletion",
             definition_body=sfn.DefinitionBody.from_string(state_machine_def)
         )
+        self.bulk_delete.grant_invoke(self.state_machine_delete)
         # Grant the state machine permissions to access the DynamoDB table
         self.table_documents.grant_read_write_data(self.state_machine_delete.role)
         self.table_chunk_small.grant_read_write_data(self.state_machine_delete.role)
@@ -664,10 +723,22 @@ class ChatbotStack(Stack):
             for key, value in replace_arn.items():
                 state_machine_def = state_machine_def.replace(key, value)
 
+        # page fan-out of the distributed map, can be overridden with -c pageFanOut='{...}'
+        # every PagesProcess invocation makes one Bedrock request at a time, so maxConcurrency is
+        # the number of concurrent LLM extraction requests the ingestion takes from the model quota
+        page_fan_out = self.node.try_get_context("pageFanOut") or {}
+        if isinstance(page_fan_out, str):
+            page_fan_out = json.loads(page_fan_out)
+        page_fan_out = {"maxConcurrency": 10, "pagesPerBatch": 4, **page_fan_out}
+        definition = json.loads(state_machine_def)
+        map_pages = definition["States"]["Map_pages"]
+        map_pages["MaxConcurrency"] = int(page_fan_out["maxConcurrency"])
+        map_pages["ItemBatcher"]["MaxItemsPerBatch"] = int(page_fan_out["pagesPerBatch"])
+
         # Create the state machine
         self.state_machine_llm_parser = sfn.StateMachine(
             self, "AIbotSMLLMParser",
-            definition_body=sfn.DefinitionBody.from_string(state_machine_def)
+            definition_body=sfn.DefinitionBody.from_string(json.dumps(definition))
         )
         # Grant the state machine permissions to access the DynamoDB table
         self.table_documents.grant_read_write_data(self.state_machine_llm_parser.role)
@@ -693,6 +764,24 @@ class ChatbotStack(Stack):
             )
         
         )
+        # the distributed map runs its batches as child executions of the state machine, its own
+        # arn would be a circular reference, the generated name starts with the construct id
+        self.state_machine_llm_parser.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["states:StartExecution"],
+                resources=[self.format_arn(service="states", resource="stateMachine",
+                                           resource_name="AIbotSMLLMParser*",
+                                           arn_format=cdk.ArnFormat.COLON_RESOURCE_NAME)]
+            )
+        )
+        self.state_machine_llm_parser.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["states:DescribeExecution", "states:StopExecution"],
+                resources=[self.format_arn(service="states", resource="execution",
+                                           resource_name="AIbotSMLLMParser*",
+                                           arn_format=cdk.ArnFormat.COLON_RESOURCE_NAME)]
+            )
+        )
         role = iam.Role(self, "documentUploadedRole",
             assumed_by=iam.ServicePrincipal("events.amazonaws.com")
         )
@@ -728,6 +817,9 @@ class ChatbotStack(Stack):
                 ]
             )
         )
+        # documents whose pages all have a text layer skip Textract, ReadDocs starts AIbotSM itself
+        self.step1.add_environment("TEXTRACT_STATE_MACHINE", self.state_machine_textract.state_machine_arn)
+        self.state_machine_textract.grant_start_execution(self.step1)
 
     def create_event_rules(self):
         self.upload_rule = events.Rule(self, "documentUploadedRule",
@@ -764,6 +856,15 @@ class ChatbotStack(Stack):
                         )
                     ],
                     # expiration=Duration.days(365)
+                ),
+                # parts of multipart uploads the browser never completed or aborted
+                s3.LifecycleRule(
+                    abort_incomplete_multipart_upload_after=Duration.days(2)
+                ),
+                # the page extraction cache is rebuilt on demand, entries of deleted documents age out
+                s3.LifecycleRule(
+                    prefix="cache/",
+                    expiration=Duration.days(90)
                 )
             ]
         )
@@ -811,6 +912,24 @@ class ChatbotStack(Stack):
             sort_key=dynamodb.Attribute(name="filename", type=dynamodb.AttributeType.STRING),
             # projection_type=dynamodb.ProjectionType.KEYS_ONLY if the index was inverted we could just project the keys
             )
+        ## near duplicate references of every canonical chunk
+        for table in (self.table_chunk_small, self.table_chunk_big):
+            table.add_global_secondary_index(
+                index_name="canonical",
+                partition_key=dynamodb.Attribute(name="canonical_id", type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name="canonical_filename", type=dynamodb.AttributeType.STRING),
+                projection_type=dynamodb.ProjectionType.KEYS_ONLY
+                )
+        # LSH bands of the canonical chunks, per chunk table and group (common/near_duplicates.py)
+        self.table_chunk_signatures = dynamodb.TableV2(
+            self, "AIbotChunkSignatures",
+            partition_key=dynamodb.Attribute(
+                name="band",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
 
 
         self.table_conversation = dynamodb.TableV2(
@@ -828,6 +947,18 @@ class ChatbotStack(Stack):
             time_to_live_attribute="expiration_time",  # TTL attribute
         )
 
+        # content addressed embeddings, sha256(model id + dimensions + chunk text) -> vector
+        self.table_embedding_cache = dynamodb.TableV2(
+            self, "AIbotEmbeddingCache",
+            partition_key=dynamodb.Attribute(
+                name="content_hash",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY,
+            time_to_live_attribute="expiration_time",
+        )
+
         self.table_documents = dynamodb.TableV2(
             self, "AIbotDocuments",
             partition_key=dynamodb.Attribute(
@@ -841,8 +972,35 @@ class ChatbotStack(Stack):
             billing=dynamodb.Billing.on_demand(),
             removal_policy=RemovalPolicy.DESTROY
         )
+        # documents of a group holding the same content, used to deduplicate uploads
+        self.table_documents.add_global_secondary_index(
+            index_name="content_sha256",
+            partition_key=dynamodb.Attribute(name="content_sha256", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="group", type=dynamodb.AttributeType.STRING),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["uuid", "extraction", "duplicate_of"]
+            )
 
     def build_functions(self):
+        # modules shared by the ingestion lambdas (bedrock client wrapper, ...)
+        self.common_layer = python.PythonLayerVersion(self, "Common_layer",
+            entry="src/lambda/common",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
+        )
+        # client side Bedrock pacing for the bulk ingestion, keeps quota free for the interactive chat
+        bedrock_rate_limits = json.dumps({
+            "amazon.titan-embed-text-v2:0": 20,
+            "anthropic.claude-3-haiku-20240307-v1:0": 4
+        })
+        # chunk size each chunk table consumes, chunk_raw_data only computes the subscribed ones
+        chunk_profiles = json.dumps([
+            {"table": "DYNAMO_TABLE_TEXTRACT", "source": "textract", "size": 1000, "overlap": 200},
+            {"table": "DYNAMO_TABLE_LLM", "source": "llm", "size": 1000, "overlap": 200}
+        ])
+        # pipeline(s) each upload goes through, can be overridden with -c extractionRouting='{...}'
+        extraction_routing = self.node.try_get_context("extractionRouting") or {"default": "both"}
+        if not isinstance(extraction_routing, str):
+            extraction_routing = json.dumps(extraction_routing)
         self.step1 = python.PythonFunction(self, "ReadDocs",
             entry="src/lambda/step1",
             index="read_docs.py",
@@ -852,7 +1010,24 @@ class ChatbotStack(Stack):
                 "BUCKET_NAME": self.s3_file_bucket.bucket_name,
                 "DOCUMENT_TABLE": self.table_documents.table_name,
                 "SNS_TOPIC": self.sns_topic.topic_arn,
-                "TEXTRACT_ROLE": self.sns_role.role_arn
+                "TEXTRACT_ROLE": self.sns_role.role_arn,
+                "INGESTION_MODE": "incremental",
+                "EXTRACTION_ROUTING": extraction_routing,
+                "SPLIT_MODE": "memory",
+                "PAGES_PER_OBJECT": "1",
+                "SPLIT_WORKERS": "8",
+                "TEXT_LAYER_FAST_PATH": "true",
+                "MIN_TEXT_CHARS": "200",
+                "MIN_GLYPH_COVERAGE": "0.95",
+                "MIN_TEXT_CHARS_WITH_IMAGES": "800",
+                "DEDUP_UPLOADS": "true",
+                "CONTENT_INDEX": "content_sha256",
+                "TEXTRACT_OUTPUT_COMPRESS": "true",
+                # a revision routed away from a pipeline removes the chunks that pipeline stored
+                "DYNAMO_TABLE_TEXTRACT": self.table_chunk_small.table_name,
+                "DYNAMO_TABLE_LLM": self.table_chunk_big.table_name,
+                "CHUNK_PROFILES": chunk_profiles,
+                "NEAR_DUP_TABLE": self.table_chunk_signatures.table_name
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
@@ -860,7 +1035,8 @@ class ChatbotStack(Stack):
                 python.PythonLayerVersion(self, "ReadDocs_layer",
                     entry="src/lambda/step1",
                     compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
-                )
+                ),
+                self.common_layer
             ]
         )
         self.step2 = python.PythonFunction(self, "StoreRawDocs",
@@ -873,6 +1049,7 @@ class ChatbotStack(Stack):
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
+            layers=[self.common_layer]
         )
 
         self.step2split = python.PythonFunction(self, "PagesProcess",
@@ -882,10 +1059,18 @@ class ChatbotStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_12,
             environment={
                 "DOCUMENTS_BUCKET_NAME": self.s3_file_bucket.bucket_name,
-                "DOCUMENTS_TABLE_NAME": self.table_documents.table_name
+                "DOCUMENTS_TABLE_NAME": self.table_documents.table_name,
+                "BEDROCK_RATE_LIMITS": bedrock_rate_limits,
+                "LLM_MAX_TOKENS": "4096",
+                "LLM_BATCH_OUTPUT_TOKENS": "2500",
+                "LLM_MAX_PAGES_PER_BATCH": "8",
+                "LLM_MAX_CONTINUATIONS": "4",
+                "EXTRACTION_CACHE": "true",
+                "EXTRACTION_CACHE_PREFIX": "cache/pages"
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
+            layers=[self.common_layer]
         )
         self.step3 = python.PythonFunction(self, "ChunkRawData",
             entry="src/lambda/step3",
@@ -894,7 +1079,9 @@ class ChatbotStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_12,
             environment={
                 "BUCKET_NAME": self.s3_file_bucket.bucket_name,
-                "DEFAULT_TMP": "/tmp"
+                "DEFAULT_TMP": "/tmp",
+                "CHUNK_LAYOUT": "manifest",
+                "CHUNK_PROFILES": chunk_profiles
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
@@ -902,7 +1089,8 @@ class ChatbotStack(Stack):
                 python.PythonLayerVersion(self, "ChunkRawData_layer",
                     entry="src/lambda/step3",
                     compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
-                )
+                ),
+                self.common_layer
             ]
         )
         self.step3joiner = python.PythonFunction(self, "RawDataJoiner",
@@ -911,10 +1099,12 @@ class ChatbotStack(Stack):
             handler="handler",
             runtime=_lambda.Runtime.PYTHON_3_12,
             environment={
-                "BUCKET_NAME": self.s3_file_bucket.bucket_name
+                "BUCKET_NAME": self.s3_file_bucket.bucket_name,
+                "CONSOLIDATE_WORKERS": "16"
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
+            layers=[self.common_layer]
         )
         self.step4 = python.PythonFunction(self, "StoreChunkDynamo",
             entry="src/lambda/step4",
@@ -925,15 +1115,29 @@ class ChatbotStack(Stack):
                 "BUCKET_NAME": self.s3_file_bucket.bucket_name,
                 "DYNAMO_TABLE_TEXTRACT": self.table_chunk_small.table_name,
                 "DYNAMO_TABLE_LLM": self.table_chunk_big.table_name,
+                "BEDROCK_RATE_LIMITS": bedrock_rate_limits,
+                "MAX_WORKERS": "16",
+                "CHUNK_PROFILES": chunk_profiles,
+                "EMBEDDING_CACHE_TABLE": self.table_embedding_cache.table_name,
+                "NEAR_DUP_TABLE": self.table_chunk_signatures.table_name,
+                "NEAR_DUP_THRESHOLD": "0.9"
                 },
             timeout=Duration.seconds(900),
             memory_size=1024,
-            # layers=[
-            #     python.PythonLayerVersion(self, "StoreChunkDynamo_layer",
-            #         entry="src/lambda/step4",
-            #         compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
-            #     )
-            # ]
+            layers=[self.common_layer]
+        )
+        self.bulk_delete = python.PythonFunction(self, "BulkDelete",
+            entry="src/lambda/delete",
+            index="bulk_delete.py",
+            handler="handler",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            environment={
+                "MAX_WORKERS": "8",
+                "NEAR_DUP_TABLE": self.table_chunk_signatures.table_name
+                },
+            timeout=Duration.seconds(900),
+            memory_size=512,
+            layers=[self.common_layer]
         )
 
         # Permisions
@@ -951,7 +1155,17 @@ class ChatbotStack(Stack):
 
         self.table_chunk_small.grant_read_write_data(self.step4)
         self.table_chunk_big.grant_read_write_data(self.step4)
+        self.table_embedding_cache.grant_read_write_data(self.step4)
+        self.table_chunk_signatures.grant_read_write_data(self.step4)
         self.table_documents.grant_read_write_data(self.step1)
+        self.table_chunk_small.grant_read_write_data(self.step1)
+        self.table_chunk_big.grant_read_write_data(self.step1)
+        self.table_chunk_signatures.grant_read_write_data(self.step1)
+        self.s3_file_bucket.grant_read_write(self.bulk_delete)
+        self.table_chunk_small.grant_read_write_data(self.bulk_delete)
+        self.table_chunk_big.grant_read_write_data(self.bulk_delete)
+        self.table_chunk_signatures.grant_read_write_data(self.bulk_delete)
+        self.table_documents.grant_read_data(self.bulk_delete)
 
         self.step4.add_to_role_policy(
             iam.PolicyStatement(
@@ -1011,8 +1225,11 @@ class ChatbotStack(Stack):
         ecr_repo_image = os.environ.get("CommitId", None)
         ecr_repo = os.environ.get("RepositoryUri", "cdk-hnb659fds-container-assets-XXXXXXXXXX-us-east-1")
         if ecr_repo_image is None:
+            # src/ is the build context so the image copies the shared modules of src/lambda/common,
+            # src/.dockerignore keeps the context to the files the Dockerfile uses
             lambda_image = _lambda.DockerImageCode.from_image_asset(
-                directory="src/docker"
+                directory="src",
+                file="docker/Dockerfile"
             )
         else:
             ecr_repo = ecr.Repository.from_repository_name(self, "AIBotEcr", ecr_repo)
@@ -1,6 +1,9 @@
 import boto3
 import json
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from langchain_aws import ChatBedrock
 from langchain_core.messages import (
     HumanMessage,
@@ -50,6 +53,22 @@ from dynamodb_retriever import DynamoDBRetriever as ddb
 #     return vectorstore.as_retriever()
 
 table_config = None
+# interactive requests: let botocore pace and retry throttles (adaptive mode) instead of failing the chat
+bedrock_chat_client = boto3.client('bedrock-runtime', config=Config(
+    retries={'max_attempts': int(os.environ.get("BEDROCK_MAX_RETRIES", 4)), 'mode': 'adaptive'}))
+
+# conversation history layout: "packed" keeps the turns of a session in one item (head) that is
+# appended with a single UpdateItem and read with a single GetItem, "items" is one item per message
+HISTORY_LAYOUT = os.environ.get("HISTORY_LAYOUT", "packed")
+# roll the head into an archived block before it reaches the 400KB DynamoDB item limit
+HISTORY_BLOCK_BYTES = int(os.environ.get("HISTORY_BLOCK_BYTES", 350000))
+# turns copied into a fresh head on roll over, so the model keeps the recent context
+HISTORY_CARRY_TURNS = int(os.environ.get("HISTORY_CARRY_TURNS", 4))
+HISTORY_TTL_SECONDS = 1209600
+PACKED_HEAD_KEY = "packed#head"
+PACKED_BLOCK_KEY = "packed#block#{:06d}"
+# attribute names and list bookkeeping per turn, on top of the message bytes
+TURN_OVERHEAD_BYTES = 48
 
 def history_aware_retriever(llm, table_config, group_id):
     #retriever = merge_data_loaders()
@@ -96,26 +115,58 @@ def get_history(session_id):
     return response
 # Document what this function does its imputs and possible responses
 
+def get_packed_history(session_id):
+    """
+    Read the turns of a session stored with the packed layout.
+
+    Returns:
+        list: the turns ({'s': sender, 'm': message, 't': timestamp}) in the head item,
+        or None when the session has no head item yet
+    """
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(os.environ.get("DYNAMO_TABLE", "aibot_conversation_history"))
+    response = table.get_item(Key={'session_id': session_id, 'timestamp': PACKED_HEAD_KEY})
+    item = response.get('Item')
+    if item is None:
+        return None
+    return item.get('turns', [])
+
+def get_item_history(session_id):
+    """
+    Read the turns of a session stored with the items layout, one item per message.
+
+    Returns:
+        list: the turns ({'s': sender, 'm': message, 't': timestamp}) in timestamp order
+    """
+    history = get_history(session_id)
+    history = history.get('Items', [])
+    return [{'s': item['sender'], 'm': item['message'], 't': item['timestamp']}
+            for item in history if not item['timestamp'].startswith('packed#')]
+
+def get_history_turns(session_id):
+    """
+    Read the turns of a session.
+
+    Returns:
+        tuple: (turns, packed) where packed is False when the session has no packed head
+        yet and the turns come from per message items
+    """
+    if HISTORY_LAYOUT == "packed":
+        turns = get_packed_history(session_id)
+        if turns is not None:
+            return turns, True
+        # sessions started before the packed layout are still one item per message,
+        # the first store_turn moves them into the head
+    return get_item_history(session_id), False
+
+def to_messages(turns):
+    return [HumanMessage(content=turn['m']) if turn['s'] == 'user' else AIMessage(content=turn['m'])
+            for turn in turns]
+
 def get_conversation_history(session_id):
     # Implement logic to retrieve conversation history from a database or cache
     # based on the session_id
-    history = get_history(session_id)
-    history = history.get('Items', [])
-    messages = []
-    #valid_history = 0
-    if history:
-        for item in history:
-            if item['sender'] == 'user':
-                #valid_history += 1
-                messages.append(HumanMessage(content=item['message']))
-            else:
-                #valid_history -= 1
-                messages.append(AIMessage(content=item['message']))
-            #if valid_history < 0:
-                ## user conversation is not stored correctly 
-                # TODO delete items to prevent further user bad experience
-            #    return []
-    return messages
+    return to_messages(get_history_turns(session_id)[0])
 
 def store_item(session_id, item, role):
     dynamodb = boto3.resource('dynamodb')
@@ -135,15 +186,161 @@ def store_item(session_id, item, role):
     table.put_item(Item=item)
     return
 
+def turns_size(turns):
+    return sum(len(turn['m'].encode('utf-8')) + TURN_OVERHEAD_BYTES for turn in turns)
+
+def truncate_message(message, max_bytes):
+    """Cut a message to at most max_bytes of utf-8, marking the cut"""
+    if len(message.encode('utf-8')) <= max_bytes:
+        return message
+    marker = " [truncated]"
+    kept = message.encode('utf-8')[:max(0, max_bytes - len(marker))]
+    return kept.decode('utf-8', 'ignore') + marker
+
+def latest_turns(turns, max_bytes):
+    """The most recent turns that fit in max_bytes"""
+    start, size = len(turns), 0
+    while start > 0 and size + turns_size(turns[start - 1:start]) <= max_bytes:
+        start -= 1
+        size += turns_size(turns[start:start + 1])
+    return turns[start:]
+
+def store_turn(session_id, query, answer, previous_turns=None):
+    """
+    Append the user query and the AI answer to the packed session head with a single
+    conditional UpdateItem. When the head would grow past HISTORY_BLOCK_BYTES the
+    condition fails and the head is rolled over into an archived block.
+
+    A turn larger than a block is truncated so it always fits in the head. previous_turns
+    are the per message turns of a session that has no head yet, the most recent ones
+    seed the head so they stay in the history.
+    """
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(os.environ.get("DYNAMO_TABLE", "aibot_conversation_history"))
+    timestamp = time.time()
+    timestamp_str = f"{int(timestamp)}.{int(timestamp * 1000000) % 1000000}"
+    expiration_time = int(timestamp + HISTORY_TTL_SECONDS)
+    turns = [
+        {'s': 'user', 'm': query, 't': timestamp_str},
+        {'s': 'ai', 'm': answer, 't': timestamp_str}
+    ]
+    size = turns_size(turns)
+    if size > HISTORY_BLOCK_BYTES:
+        # a single turn that does not fit in a block, keep the start of each message
+        max_bytes = HISTORY_BLOCK_BYTES // 2 - TURN_OVERHEAD_BYTES
+        for turn in turns:
+            turn['m'] = truncate_message(turn['m'], max_bytes)
+        size = turns_size(turns)
+    if previous_turns and seed_head(table, session_id, previous_turns, turns, expiration_time):
+        return
+    while True:
+        try:
+            table.update_item(
+                Key={'session_id': session_id, 'timestamp': PACKED_HEAD_KEY},
+                UpdateExpression="SET #turns = list_append(if_not_exists(#turns, :empty), :turns), "
+                                 "#bytes = if_not_exists(#bytes, :zero) + :size, "
+                                 "#block = if_not_exists(#block, :zero), "
+                                 "#exp = :exp",
+                ConditionExpression="attribute_not_exists(#bytes) OR #bytes <= :max_bytes",
+                ExpressionAttributeNames={
+                    '#turns': 'turns', '#bytes': 'block_bytes', '#block': 'block_number', '#exp': 'expiration_time'
+                },
+                ExpressionAttributeValues={
+                    ':empty': [], ':turns': turns, ':zero': 0, ':size': size,
+                    ':exp': expiration_time, ':max_bytes': HISTORY_BLOCK_BYTES - size
+                },
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            item = e.response.get('Item')
+        if item is None:
+            # the head was deleted since the update was rejected, start a new one
+            if seed_head(table, session_id, [], turns, expiration_time):
+                return
+            continue
+        head = {k: TypeDeserializer().deserialize(v) for k, v in item.items()}
+        if roll_over_head(table, session_id, head, turns, expiration_time):
+            return
+
+def seed_head(table, session_id, previous_turns, turns, expiration_time):
+    """
+    Create the head with the latest previous turns followed by the new turns. Returns
+    False if the head already exists, in that case the caller appends to it.
+    """
+    new_turns = latest_turns(previous_turns, HISTORY_BLOCK_BYTES - turns_size(turns)) + turns
+    try:
+        table.put_item(
+            Item={
+                'session_id': session_id,
+                'timestamp': PACKED_HEAD_KEY,
+                'turns': new_turns,
+                'block_bytes': turns_size(new_turns),
+                'block_number': 0,
+                'expiration_time': expiration_time
+            },
+            ConditionExpression="attribute_not_exists(session_id)"
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+def roll_over_head(table, session_id, head, turns, expiration_time):
+    """
+    Archive the full head as block N and start block N+1 with the last turns of the
+    previous block plus the new turns. Returns False if another writer rolled the
+    head first, in that case the caller retries the append.
+    """
+    block_number = int(head.get('block_number', 0))
+    table.put_item(Item={
+        'session_id': session_id,
+        'timestamp': PACKED_BLOCK_KEY.format(block_number),
+        'turns': head.get('turns', []),
+        'block_bytes': head.get('block_bytes', 0),
+        'expiration_time': expiration_time
+    })
+    carried = head.get('turns', [])[-HISTORY_CARRY_TURNS:] if HISTORY_CARRY_TURNS > 0 else []
+    while carried and turns_size(carried + turns) > HISTORY_BLOCK_BYTES // 2:
+        carried = carried[1:]
+    new_turns = carried + turns
+    try:
+        table.put_item(
+            Item={
+                'session_id': session_id,
+                'timestamp': PACKED_HEAD_KEY,
+                'turns': new_turns,
+                'block_bytes': turns_size(new_turns),
+                'block_number': block_number + 1,
+                'expiration_time': expiration_time
+            },
+            ConditionExpression="#block = :block",
+            ExpressionAttributeNames={'#block': 'block_number'},
+            ExpressionAttributeValues={':block': block_number}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
 def get_response(query, session_id, table_config, group_id = "default"):
     llm = ChatBedrock(model_id=os.environ.get("MODEL_ID","anthropic.claude-instant-v1"),
+                      client=bedrock_chat_client,
                       model_kwargs={"temperature": os.environ.get("TEMPERATURE", 0.3)})
-    chat_history = get_conversation_history(session_id)
+    turns, packed = get_history_turns(session_id)
+    chat_history = to_messages(turns)
     rag_chain = create_aware_chain(llm, table_config, group_id)
     #print(rag_chain.get_verbose())
     response = rag_chain.invoke({"input": query, "chat_history": chat_history})
-    store_item(session_id, query, "user")
-    store_item(session_id, response["answer"], "ai")
+    if HISTORY_LAYOUT == "packed":
+        store_turn(session_id, query, response["answer"], previous_turns=None if packed else turns)
+    else:
+        store_item(session_id, query, "user")
+        store_item(session_id, response["answer"], "ai")
     return response
 
 def lex_response_builder(session_id, llm_result, intent_fulfilled=False):
@@ -9,6 +9,7 @@ from scipy.spatial.distance import cosine
 import boto3
 import os
 import json
+from bedrock_client import get_bedrock_client
 
 class DynamoDBRetriever(BaseRetriever):
     #documents: List[Document]
@@ -55,6 +56,9 @@ class DynamoDBRetriever(BaseRetriever):
         similarities = []
         for page in response_iterator:
             for item in page['Items']:
+                # near duplicate references have no vector, their canonical chunk is scored instead
+                if 'vector' not in item:
+                    continue
                 similarity = self.calculate_similarity(query_embedding, item['vector']['S'])
                 if similarity >= tolerance:
                     similarities.append((similarity, item['text']['S']))
@@ -70,7 +74,7 @@ class DynamoDBRetriever(BaseRetriever):
         return 1 - cosine(query_embedding, json.loads(document_embedding))
     
     def query_to_embedding(self, query: str) -> List[float]:
-        bedrock = boto3.client('bedrock-runtime')
+        bedrock = get_bedrock_client()
         model_id = os.environ.get('EMBEDDING_MODEL_ID', "amazon.titan-embed-text-v2:0")
         # get the embedding for the query
         response = bedrock.invoke_model(
@@ -1,7 +1,11 @@
+import base64
 import boto3
 import os
 import json
 import utils
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
 
 
 # "STATE_MACHINE_DELETE": 
@@ -14,6 +18,13 @@ STATE_MACHINE_DELETE = os.environ.get('STATE_MACHINE_DELETE', 'state_machine_del
 BUCKET_DOCUMENTS = os.environ.get('BUCKET_DOCUMENTS', 'ai-bot-document-finder')
 TABLE_NAME_BIG = os.environ.get('TABLE_NAME_BIG', 'ai_bot_document_finder_big')
 TABLE_NAME_SMALL = os.environ.get('TABLE_NAME_SMALL', 'ai_bot_document_finder_small')
+LIST_WORKERS = int(os.environ.get('LIST_WORKERS', 8))
+MAX_PAGE_SIZE = 1000
+# attributes the document screen shows, group and size are reserved words
+DOCUMENT_PROJECTION = {
+    'ProjectionExpression': '#group, filename, #size, extraction, updated_at',
+    'ExpressionAttributeNames': {'#group': 'group', '#size': 'size'}
+}
 
 
 dynamodb = boto3.resource('dynamodb')
@@ -42,16 +53,83 @@ def delete(event):
         'executionArn': respone['executionArn']
         }))
 
+def to_json(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def query_group(group, start_key=None, limit=None):
+    """
+    One page of the documents of `group`, projected to the listed attributes.
+
+    Returns:
+        tuple: (documents, LastEvaluatedKey or None)
+    """
+    query = {'KeyConditionExpression': Key('group').eq(group), **DOCUMENT_PROJECTION}
+    if start_key:
+        query['ExclusiveStartKey'] = start_key
+    if limit:
+        query['Limit'] = limit
+    response = table.query(**query)
+    return response['Items'], response.get('LastEvaluatedKey')
+
+def query_all(group):
+    """Every document of `group`, following the 1 MB pages of the query"""
+    documents, start_key = query_group(group)
+    while start_key:
+        page, start_key = query_group(group, start_key)
+        documents.extend(page)
+    return documents
+
+def list_all_documents(groups):
+    """Documents of all the groups, queried concurrently"""
+    groups = sorted(set(groups))
+    with ThreadPoolExecutor(max_workers=max(1, min(LIST_WORKERS, len(groups)))) as executor:
+        return [document for page in executor.map(query_all, groups) for document in page]
+
+def encode_cursor(groups, start_key):
+    cursor = json.dumps({'groups': groups, 'key': start_key}, default=to_json)
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+def list_documents_page(groups, limit, cursor=None):
+    """
+    Up to `limit` documents, group after group, and the cursor of the next page (None at the end).
+    The cursor holds the groups still to list and the key to resume the first one from.
+    """
+    if cursor:
+        state = decode_cursor(cursor)
+        remaining, start_key = state['groups'], state['key']
+        if not set(remaining) <= set(groups) or (start_key and start_key.get('group') != remaining[0]):
+            raise PermissionError("Cursor lists groups the user is not a member of")
+    else:
+        remaining, start_key = sorted(set(groups)), None
+    documents = []
+    while remaining and len(documents) < limit:
+        page, start_key = query_group(remaining[0], start_key, limit - len(documents))
+        documents.extend(page)
+        if not start_key:
+            remaining = remaining[1:]
+    next_cursor = encode_cursor(remaining, start_key) if remaining else None
+    return documents, next_cursor
+
 def list_documents(event):
     # query the table for all the documents with the primary key of the name of
     groups = event['requestContext']['authorizer']['claims']['cognito:groups'].split(',')
-    documents = []
-    for group in groups:
-        response = table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('group').eq(group))
-        documents.extend(response['Items'])
-
-    return utils.response(json.dumps(documents))
+    params = event.get('queryStringParameters') or {}
+    if 'limit' not in params and 'cursor' not in params:
+        # the whole listing, the array the document screen expects
+        return utils.response(json.dumps(list_all_documents(groups), default=to_json))
+    try:
+        limit = max(1, min(MAX_PAGE_SIZE, int(params.get('limit', 100))))
+        documents, cursor = list_documents_page(groups, limit, params.get('cursor'))
+    except PermissionError:
+        return utils.response(json.dumps({'message': 'Unauthorized'}), 401)
+    except (ValueError, KeyError, TypeError):
+        return utils.response(json.dumps({'error': 'Invalid limit or cursor'}), code=400)
+    return utils.response(json.dumps({'items': documents, 'cursor': cursor}, default=to_json))
 
 
 def handler(event, context):
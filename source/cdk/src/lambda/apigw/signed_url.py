@@ -1,12 +1,194 @@
 # a lambda function that receives a file name and returns a signed url from s3 to upload the file
+#
+# Multipart mode, for large documents uploaded in parallel and resumable parts:
+# POST /presign/multipart           {"file_name", "file_size", "sha256", "force"} -> upload id, part size and the part urls
+# GET  /presign/multipart           ?file_name&upload_id&parts_total -> parts already uploaded and urls for the missing ones
+# POST /presign/multipart/complete  {"file_name", "upload_id", "parts": [{"part_number", "etag"}]}
+# POST /presign/multipart/abort     {"file_name", "upload_id"}
+# At most MULTIPART_URLS_PER_RESPONSE part urls are returned at once, the client asks for the
+# next ones with the GET, which is also how an interrupted upload is resumed.
+#
+# Content deduplication: GET /presign and POST /presign/multipart accept the optional sha256 (hex)
+# of the file. When an ingested document of the group already holds that content (content index
+# of the documents table, chunks written under rag/), no url is returned, {"duplicate": true,
+# "filename": ...} tells the client the upload is not needed, force=true uploads anyway. A
+# document whose ingestion failed or is still running is not a duplicate. Otherwise the single
+# PUT url is signed with the checksum, the client sends it as x-amz-checksum-sha256, S3 verifies
+# the content and read_docs reuses the stored checksum instead of hashing the document again
+# (multipart uploads only store a checksum of the parts, read_docs hashes them).
+import base64
 import boto3
+import math
 import os
 import json
 import utils
+from boto3.dynamodb.conditions import Key
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
 config = Config(signature_version='s3v4')
 s3 = boto3.client('s3', config=config)
+dynamodb = boto3.resource('dynamodb')
+
+URL_EXPIRATION = int(os.environ.get('URL_EXPIRATION', 3600))
+MULTIPART_MIN_PART_SIZE = int(os.environ.get('MULTIPART_MIN_PART_SIZE_MB', 8)) * 1024 * 1024
+MULTIPART_URLS_PER_RESPONSE = int(os.environ.get('MULTIPART_URLS_PER_RESPONSE', 100))
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE_MB', 500)) * 1024 * 1024
+S3_MAX_PARTS = 10000
+CONTENT_INDEX = os.environ.get('CONTENT_INDEX', 'content_sha256')
+
+
+def object_key_for(group, file_name):
+    upload_prefix = os.environ.get('UPLOAD_PREFIX', "")
+    return f'{upload_prefix}{group}/{file_name}'
+
+
+def is_ingested(bucket_name, group, _uuid):
+    """True when the chunks of the uuid were written, its ingestion went through (as read_docs checks)"""
+    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"rag/{group}/{_uuid}_", MaxKeys=1)
+    return response.get('KeyCount', 0) > 0
+
+
+def existing_document(bucket_name, group, content_hash):
+    """File name of an ingested document of the group holding the content `content_hash`, None when there is none"""
+    table_name = os.environ.get('TABLE_NAME_DOCUMENTS', None)
+    if not table_name:
+        return None
+    query = {
+        'IndexName': CONTENT_INDEX,
+        'KeyConditionExpression': Key('content_sha256').eq(content_hash) & Key('group').eq(group)
+    }
+    while True:
+        response = dynamodb.Table(table_name).query(**query)
+        for item in response['Items']:
+            if is_ingested(bucket_name, group, item['uuid']):
+                return item['filename']
+        if 'LastEvaluatedKey' not in response:
+            return None
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def check_content(bucket_name, group, request):
+    """
+    Validate the declared sha256 of the request and look for a document holding the content.
+
+    Returns:
+        tuple: (hex sha256 or None, error or duplicate response or None)
+    """
+    if not request.get('sha256'):
+        return None, None
+    content_hash = str(request['sha256']).lower()
+    try:
+        bytes.fromhex(content_hash)
+    except ValueError:
+        content_hash = ''
+    if len(content_hash) != 64:
+        return None, utils.response(json.dumps({'error': 'sha256 must be the hex digest of the file'}), code=400)
+    if str(request.get('force', 'false')).lower() != 'true':
+        duplicate = existing_document(bucket_name, group, content_hash)
+        if duplicate:
+            return content_hash, utils.response(json.dumps({'duplicate': True, 'filename': duplicate}))
+    return content_hash, None
+
+
+def part_size_for(file_size):
+    """Smallest whole MiB part size, at least MULTIPART_MIN_PART_SIZE, that fits the file in 10000 parts"""
+    mib = 1024 * 1024
+    return max(MULTIPART_MIN_PART_SIZE, math.ceil(file_size / S3_MAX_PARTS / mib) * mib)
+
+
+def part_urls(bucket_name, object_key, upload_id, part_numbers):
+    return [{
+        'part_number': part_number,
+        'url': s3.generate_presigned_url(ClientMethod='upload_part', Params={
+            'Bucket': bucket_name, 'Key': object_key, 'UploadId': upload_id, 'PartNumber': part_number
+        }, ExpiresIn=URL_EXPIRATION)
+    } for part_number in part_numbers[:MULTIPART_URLS_PER_RESPONSE]]
+
+
+def uploaded_parts(bucket_name, object_key, upload_id):
+    """{part number: etag} of the parts S3 already has"""
+    parts = {}
+    paginator = s3.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket_name, Key=object_key, UploadId=upload_id):
+        parts.update({part['PartNumber']: part['ETag'] for part in page.get('Parts', [])})
+    return parts
+
+
+def create_multipart(bucket_name, object_key, body, group):
+    file_size = int(body.get('file_size', 0))
+    if file_size <= 0 or file_size > MAX_FILE_SIZE:
+        return utils.response(json.dumps({'error': f'file_size must be between 1 and {MAX_FILE_SIZE} bytes'}), code=400)
+    _, early_response = check_content(bucket_name, group, body)
+    if early_response:
+        return early_response
+    part_size = part_size_for(file_size)
+    parts_total = math.ceil(file_size / part_size)
+    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=object_key,
+                                           ContentType='application/pdf')['UploadId']
+    return utils.response(json.dumps({
+        'upload_id': upload_id,
+        'part_size': part_size,
+        'parts_total': parts_total,
+        'urls': part_urls(bucket_name, object_key, upload_id, list(range(1, parts_total + 1)))
+    }))
+
+
+def resume_multipart(bucket_name, object_key, params):
+    upload_id = params['upload_id']
+    parts_total = int(params['parts_total'])
+    if parts_total <= 0 or parts_total > S3_MAX_PARTS:
+        return utils.response(json.dumps({'error': f'parts_total must be between 1 and {S3_MAX_PARTS}'}), code=400)
+    parts = uploaded_parts(bucket_name, object_key, upload_id)
+    missing = [part_number for part_number in range(1, parts_total + 1) if part_number not in parts]
+    return utils.response(json.dumps({
+        'upload_id': upload_id,
+        'uploaded': [{'part_number': number, 'etag': etag} for number, etag in sorted(parts.items())],
+        'urls': part_urls(bucket_name, object_key, upload_id, missing)
+    }))
+
+
+def complete_multipart(bucket_name, object_key, body):
+    parts = sorted(({'PartNumber': int(part['part_number']), 'ETag': part['etag']} for part in body['parts']),
+                   key=lambda part: part['PartNumber'])
+    s3.complete_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=body['upload_id'],
+                                 MultipartUpload={'Parts': parts})
+    return utils.response(json.dumps({'key': object_key, 'parts': len(parts)}))
+
+
+def abort_multipart(bucket_name, object_key, body):
+    s3.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=body['upload_id'])
+    return utils.response(json.dumps({'aborted': body['upload_id']}))
+
+
+def multipart(event, group, bucket_name):
+    if event['httpMethod'] == 'GET':
+        request = event.get('queryStringParameters') or {}
+    else:
+        try:
+            request = json.loads(event.get('body') or '{}')
+        except ValueError:
+            return utils.response(json.dumps({'error': 'The request body is not valid JSON'}), code=400)
+    if not isinstance(request, dict) or 'file_name' not in request:
+        return utils.response(json.dumps({'error': 'No file name found in the request'}), code=400)
+    # the key is always rebuilt from the caller group, an upload id only works for its own key
+    object_key = object_key_for(group, request['file_name'])
+    resource = event.get('resource', '')
+    try:
+        if resource.endswith('/complete'):
+            return complete_multipart(bucket_name, object_key, request)
+        if resource.endswith('/abort'):
+            return abort_multipart(bucket_name, object_key, request)
+        if event['httpMethod'] == 'GET':
+            return resume_multipart(bucket_name, object_key, request)
+        return create_multipart(bucket_name, object_key, request, group)
+    except KeyError as e:
+        return utils.response(json.dumps({'error': f'Missing parameter {e}'}), code=400)
+    except (TypeError, ValueError) as e:
+        # file_size, parts_total or part_number that is not a number, parts that is not a list
+        return utils.response(json.dumps({'error': f'Invalid parameter: {e}'}), code=400)
+    except ClientError as e:
+        return utils.response(json.dumps({'error': e.response['Error']['Message']}), code=400)
 
 
 def handler(event, context):
@@ -19,15 +201,25 @@ def handler(event, context):
     ## TODO let the user decide for what group they want to upload he document if in multiple groups
     ## if not in multiple groups, use the first group
     group = groups[0]
-    
+    bucket_name = os.environ.get('BUCKET', None)
+    if '/multipart' in event.get('resource', ''):
+        return multipart(event, group, bucket_name)
+
     #print(event)
     body =  event['queryStringParameters']
     #body = json.loads(body)
     if 'file_name' not in body:
         return utils.response(json.dumps({'error': 'No file name found in the request'}), code=400)
     file_name = body['file_name']
-    bucket_name = os.environ.get('BUCKET', None)
-    upload_prefix = os.environ.get('UPLOAD_PREFIX', "")
-    object_key = f'{upload_prefix}{group}/{file_name}'
-    presigned_url = s3.generate_presigned_url(ClientMethod='put_object', Params={'Bucket': bucket_name, 'Key': object_key}, ExpiresIn=3600)
-    return utils.response(json.dumps({'url': presigned_url}))
\ No newline at end of file
+    object_key = object_key_for(group, file_name)
+    params = {'Bucket': bucket_name, 'Key': object_key}
+    response = {}
+    content_hash, early_response = check_content(bucket_name, group, body)
+    if early_response:
+        return early_response
+    if content_hash:
+        checksum = base64.b64encode(bytes.fromhex(content_hash)).decode()
+        params['ChecksumSHA256'] = checksum
+        response['checksum_sha256'] = checksum
+    response['url'] = s3.generate_presigned_url(ClientMethod='put_object', Params=params, ExpiresIn=URL_EXPIRATION)
+    return utils.response(json.dumps(response))
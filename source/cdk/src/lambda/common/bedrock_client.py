@@ -0,0 +1,265 @@
+"""
+BEDROCK_CLIENT module:
+Shared wrapper around the bedrock-runtime client used by the ingestion Lambdas
+(store_chunk_dynamo, llm_extractor) and by the prediction Lambda.
+
+It replaces the default botocore retry behaviour with:
+- Client side rate limiting, one token bucket per model id
+- Adaptive concurrency (AIMD) for callers that invoke Bedrock from several threads
+- Throttle aware retries with full jitter backoff, also of connection errors and read timeouts
+- Per model metrics, that can be emitted as CloudWatch embedded metrics (each emit reports the
+  counts since the previous one, so warm invocations do not re-report earlier ones)
+
+Configuration (environment variables):
+BEDROCK_RATE_LIMITS: JSON object of model id to requests per second, e.g.
+    {"amazon.titan-embed-text-v2:0": 20, "anthropic.claude-3-haiku-20240307-v1:0": 4}
+    Models that are not listed are not rate limited
+BEDROCK_MAX_CONCURRENCY: Upper limit of concurrent calls per model (default 16)
+BEDROCK_MIN_CONCURRENCY: Lower limit the AIMD controller backs off to (default 1)
+BEDROCK_MAX_RETRIES: Retries of throttled or transient errors (default 8)
+BEDROCK_BACKOFF_BASE: Base of the exponential backoff in seconds (default 0.5)
+BEDROCK_BACKOFF_CAP: Maximum backoff in seconds (default 20)
+
+Usage:
+    bedrock = get_bedrock_client()
+    response = bedrock.invoke_model(modelId=..., body=...)
+    response = bedrock.converse(modelId=..., messages=[...])
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectionError, EndpointConnectionError, ReadTimeoutError
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+    'InternalServerException',
+}
+THROTTLE_ERRORS = {'ThrottlingException', 'TooManyRequestsException'}
+# network errors botocore would retry itself, its retries are disabled on the inner client
+RETRYABLE_EXCEPTIONS = (ConnectionError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError)
+COUNTERS = ('calls', 'throttles', 'retries', 'errors', 'rate_wait_seconds', 'latency_seconds')
+
+
+class TokenBucket:
+    """Thread safe token bucket that paces calls to `rate` per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1.0):
+        """Block until `tokens` are available, returns the seconds spent waiting"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limiter with additive increase / multiplicative decrease.
+    Every successful call grows the limit by 1/limit (one slot per "window"),
+    every throttle halves it, never going outside [minimum, maximum].
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum if maximum is not None else initial))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class BedrockClient:
+    """
+    Drop-in wrapper for the bedrock-runtime operations the solution uses.
+    botocore retries are disabled on the inner client, this class owns the retry policy.
+    """
+
+    def __init__(self, client=None, rate_limits=None, max_concurrency=None,
+                 min_concurrency=None, max_retries=None, backoff_base=None, backoff_cap=None):
+        self.max_concurrency = int(max_concurrency or os.environ.get('BEDROCK_MAX_CONCURRENCY', 16))
+        self.client = client or boto3.client(
+            'bedrock-runtime',
+            config=Config(retries={'total_max_attempts': 1, 'mode': 'standard'},
+                          max_pool_connections=self.max_concurrency)
+        )
+        if rate_limits is None:
+            rate_limits = json.loads(os.environ.get('BEDROCK_RATE_LIMITS', '{}'))
+        self.rate_limits = {model_id: float(rate) for model_id, rate in rate_limits.items()}
+        self.min_concurrency = int(min_concurrency or os.environ.get('BEDROCK_MIN_CONCURRENCY', 1))
+        self.max_retries = int(max_retries if max_retries is not None else os.environ.get('BEDROCK_MAX_RETRIES', 8))
+        self.backoff_base = float(backoff_base or os.environ.get('BEDROCK_BACKOFF_BASE', 0.5))
+        self.backoff_cap = float(backoff_cap or os.environ.get('BEDROCK_BACKOFF_CAP', 20))
+        self.buckets = {}
+        self.limiters = {}
+        self.metrics = {}
+        self.emitted = {}
+        self.lock = threading.Lock()
+
+    def _model_state(self, model_id):
+        with self.lock:
+            if model_id not in self.limiters:
+                rate = self.rate_limits.get(model_id)
+                self.buckets[model_id] = TokenBucket(rate) if rate else None
+                self.limiters[model_id] = AdaptiveConcurrency(
+                    self.max_concurrency, self.min_concurrency, self.max_concurrency)
+                self.metrics[model_id] = {name: 0 for name in COUNTERS}
+            return self.buckets[model_id], self.limiters[model_id], self.metrics[model_id]
+
+    def _record(self, metrics, **values):
+        with self.lock:
+            for name, value in values.items():
+                metrics[name] += value
+
+    def _backoff(self, attempt):
+        # Full jitter, spreads retries of concurrent callers over the whole window
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def call(self, operation, model_id, **kwargs):
+        """Invoke `operation` of the bedrock-runtime client honouring the rate, concurrency and retry policy"""
+        bucket, limiter, metrics = self._model_state(model_id)
+        method = getattr(self.client, operation)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                self._record(metrics, rate_wait_seconds=bucket.acquire())
+            limiter.acquire()
+            throttled = False
+            started = time.monotonic()
+            try:
+                response = method(modelId=model_id, **kwargs)
+                self._record(metrics, calls=1, latency_seconds=time.monotonic() - started)
+                return response
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                throttled = code in THROTTLE_ERRORS
+                self._record(metrics, calls=1, throttles=int(throttled),
+                             latency_seconds=time.monotonic() - started)
+                if code not in RETRYABLE_ERRORS or attempt >= self.max_retries:
+                    self._record(metrics, errors=1)
+                    raise
+            except RETRYABLE_EXCEPTIONS as e:
+                code = type(e).__name__
+                self._record(metrics, calls=1, latency_seconds=time.monotonic() - started)
+                if attempt >= self.max_retries:
+                    self._record(metrics, errors=1)
+                    raise
+            finally:
+                limiter.release(throttled=throttled)
+            delay = self._backoff(attempt)
+            attempt += 1
+            self._record(metrics, retries=1)
+            logger.warning(f"Bedrock {operation} on {model_id} failed with {code}, retry {attempt} in {delay:.2f}s")
+            time.sleep(delay)
+
+    def invoke_model(self, modelId, **kwargs):
+        return self.call('invoke_model', modelId, **kwargs)
+
+    def converse(self, modelId, **kwargs):
+        return self.call('converse', modelId, **kwargs)
+
+    def get_metrics(self):
+        """Snapshot of the metrics per model id, including the current concurrency limit"""
+        with self.lock:
+            snapshot = {model_id: dict(values) for model_id, values in self.metrics.items()}
+            for model_id, limiter in self.limiters.items():
+                snapshot[model_id]['concurrency_limit'] = round(limiter.limit, 2)
+        return snapshot
+
+    def metrics_since_last_emit(self):
+        """Counts per model id since the previous call, models without activity are left out"""
+        with self.lock:
+            deltas = {}
+            for model_id, values in self.metrics.items():
+                previous = self.emitted.get(model_id, {})
+                delta = {name: values[name] - previous.get(name, 0) for name in COUNTERS}
+                self.emitted[model_id] = dict(values)
+                if any(delta.values()):
+                    deltas[model_id] = delta
+        return deltas
+
+    def emit_metrics(self, namespace='AIbot/Bedrock'):
+        """
+        Print the metrics in CloudWatch embedded metric format, one record per model. Each record
+        holds the counts since the previous emit, the client outlives the invocations of a warm
+        container and CloudWatch sums the records.
+        """
+        for model_id, values in self.metrics_since_last_emit().items():
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['ModelId']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Throttles', 'Unit': 'Count'},
+                            {'Name': 'Retries', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'RateWaitSeconds', 'Unit': 'Seconds'},
+                        ]
+                    }]
+                },
+                'ModelId': model_id,
+                'Calls': values['calls'],
+                'Throttles': values['throttles'],
+                'Retries': values['retries'],
+                'Errors': values['errors'],
+                'RateWaitSeconds': round(values['rate_wait_seconds'], 3),
+            }
+            print(json.dumps(record))
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_bedrock_client():
+    """Container wide BedrockClient, so warm invocations share the limiter state"""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = BedrockClient()
+        return _default_client
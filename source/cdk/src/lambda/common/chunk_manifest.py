@@ -0,0 +1,88 @@
+"""
+CHUNK_MANIFEST module:
+Single object layout for the chunks of a document, shared by chunk_raw_data (writer)
+and store_chunk_dynamo (reader). Instead of one S3 object per chunk
+(rag/{group}/{file}/chunks{size}/chunk{n}) every chunk size is stored as one
+JSON Lines object, gzip compressed by default:
+
+    rag/{group}/{file}/chunks{size}.jsonl.gz
+
+Each line holds one chunk:
+    {"ord": 1, "start": 0, "end": 987, "text": "..."}
+ord is 1 based (same numbering as the chunk{n} objects), start/end are character
+offsets of the chunk in the source text.
+
+Both sides stream: the writer compresses into a spooled temporary file that is
+uploaded with the managed (multipart) transfer, the reader decompresses the
+response body line by line.
+"""
+
+import gzip
+import io
+import json
+import tempfile
+
+from botocore.exceptions import ClientError
+
+MANIFEST_SPOOL_BYTES = 8 * 1024 * 1024
+
+
+def manifest_key(key_prefix, chunk_size, compress=True):
+    """S3 key of the manifest of `chunk_size` under `key_prefix` (no trailing slash)"""
+    suffix = '.jsonl.gz' if compress else '.jsonl'
+    return f"{key_prefix.rstrip('/')}/chunks{chunk_size}{suffix}"
+
+
+def write_manifest(s3, bucket, key, chunks):
+    """
+    Stream chunks into a JSON Lines manifest and upload it.
+
+    Args:
+        s3: boto3 S3 client
+        bucket (str): target bucket
+        key (str): manifest key, compressed when it ends with .gz
+        chunks (iterable): (start, end, text) tuples in document order
+
+    Returns:
+        int: number of chunks written
+    """
+    count = 0
+    with tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_BYTES) as spool:
+        stream = gzip.GzipFile(fileobj=spool, mode='wb') if key.endswith('.gz') else spool
+        for start, end, text in chunks:
+            count += 1
+            line = json.dumps({'ord': count, 'start': start, 'end': end, 'text': text}, ensure_ascii=False)
+            stream.write(line.encode('utf-8') + b'\n')
+        if stream is not spool:
+            stream.close()
+        spool.seek(0)
+        s3.upload_fileobj(spool, bucket, key, ExtraArgs={'ContentType': 'application/x-ndjson'})
+    return count
+
+
+def read_manifest(s3, bucket, key):
+    """Yield the chunk records of a manifest, decompressing the body as it streams"""
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        if key.endswith('.gz'):
+            lines = io.TextIOWrapper(gzip.GzipFile(fileobj=body, mode='rb'), encoding='utf-8')
+        else:
+            lines = (line.decode('utf-8') for line in body.iter_lines())
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        body.close()
+
+
+def find_manifest(s3, bucket, key_prefix, chunk_size):
+    """Key of the manifest of `chunk_size` if one exists, compressed first, otherwise None"""
+    for compress in (True, False):
+        key = manifest_key(key_prefix, chunk_size, compress)
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            return key
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+    return None
@@ -0,0 +1,80 @@
+"""
+CHUNK_PROFILES module:
+Declares which chunking profile every chunk table consumes, shared by chunk_raw_data
+(which only computes the profiles that are subscribed) and store_chunk_dynamo
+(which reads the chunks of its profiles and writes them to the subscribed tables).
+
+Configuration (environment variable CHUNK_PROFILES), a JSON list of subscriptions:
+[
+    {"table": "DYNAMO_TABLE_TEXTRACT", "source": "textract", "size": 1000, "overlap": 200},
+    {"table": "DYNAMO_TABLE_LLM", "source": "llm", "size": 512, "overlap": 64, "unit": "tokens"}
+]
+table: name of the environment variable that holds the DynamoDB table name
+source: extraction pipeline that feeds the table, "textract" (raw_text/..._raw.txt)
+    or "llm" (raw_text/..._raw_llm.txt)
+size / overlap: chunk size and overlap of the splitter
+unit: "chars" (default) or "tokens", the length unit of size and overlap
+
+Without CHUNK_PROFILES both tables consume CHUNK_SIZE (default 1000) with CHUNK_OVERLAP (default 200)
+measured in CHUNK_UNIT (default chars).
+"""
+
+import json
+import os
+from collections import namedtuple
+
+DEFAULT_OVERLAP = 200
+SOURCES = ('textract', 'llm')
+UNITS = ('chars', 'tokens')
+
+
+def split_label(size, overlap, unit='chars'):
+    """Name of the chunks of a split, chunks{label}.jsonl.gz and the chunks{label}/ items"""
+    label = str(size) if overlap == DEFAULT_OVERLAP else f"{size}o{overlap}"
+    return label + 't' if unit == 'tokens' else label
+
+
+class ChunkProfile(namedtuple('ChunkProfile', ['table', 'source', 'size', 'overlap', 'unit'],
+                              defaults=['chars'])):
+
+    @property
+    def label(self):
+        return split_label(self.size, self.overlap, self.unit)
+
+
+def load_profiles():
+    """Parse the CHUNK_PROFILES environment variable, or build the default subscriptions"""
+    raw = os.environ.get('CHUNK_PROFILES')
+    if not raw:
+        size = int(os.environ.get('CHUNK_SIZE', 1000))
+        overlap = int(os.environ.get('CHUNK_OVERLAP', DEFAULT_OVERLAP))
+        unit = os.environ.get('CHUNK_UNIT', 'chars')
+        return [
+            ChunkProfile('DYNAMO_TABLE_TEXTRACT', 'textract', size, overlap, unit),
+            ChunkProfile('DYNAMO_TABLE_LLM', 'llm', size, overlap, unit),
+        ]
+    profiles = []
+    for entry in json.loads(raw):
+        if entry['source'] not in SOURCES:
+            raise ValueError(f"Unknown chunk profile source {entry['source']}, expected one of {SOURCES}")
+        if entry.get('unit', 'chars') not in UNITS:
+            raise ValueError(f"Unknown chunk profile unit {entry['unit']}, expected one of {UNITS}")
+        profiles.append(ChunkProfile(
+            entry['table'], entry['source'], int(entry['size']), int(entry.get('overlap', DEFAULT_OVERLAP)),
+            entry.get('unit', 'chars')))
+    return profiles
+
+
+def document_source(file_name):
+    """Extraction pipeline of a raw text file, from its name without extension"""
+    return 'llm' if file_name.endswith('_llm') else 'textract'
+
+
+def profiles_for_source(source, profiles=None):
+    """Subscriptions fed by `source`"""
+    return [profile for profile in (profiles or load_profiles()) if profile.source == source]
+
+
+def distinct_splits(profiles):
+    """(size, overlap, unit) splits that have to be computed for `profiles`, each only once"""
+    return sorted({(profile.size, profile.overlap, profile.unit) for profile in profiles})
@@ -0,0 +1,308 @@
+"""
+NEAR_DUPLICATES module:
+Near duplicate chunk detection with MinHash and LSH, shared by store_chunk_dynamo (which keeps
+one canonical chunk per group of near duplicates) and bulk_delete (which releases the
+references of a deleted document).
+
+A chunk is reduced to the set of its word shingles (NEAR_DUP_SHINGLE words) and to a MinHash
+signature of NEAR_DUP_PERMUTATIONS 32 bit values, position i being the minimum over the
+shingles of their i-th hash (read from the SHAKE-128 stream of the shingle). The share of equal
+positions of two signatures estimates the Jaccard similarity of the chunks.
+
+The signatures are split in bands, chosen so that two chunks with a similarity of
+NEAR_DUP_THRESHOLD (default 0.9) share at least one band with a high probability. Every
+canonical chunk stores one item per band in the signature table:
+    band: {chunk table}#{group}#{band}#{hash of the band values}  (partition key)
+    canonical_id / canonical_filename: key of the canonical chunk item
+    signature: the full signature, so candidates are verified against the threshold
+so the lookup is scoped per group and per chunk table, and costs one BatchGetItem key per band.
+
+Near duplicates are stored as reference items in the chunk table: the key of the chunk,
+canonical_id and canonical_filename, no vector and no group, so the group index used by the
+retrieval never returns them. The canonical item counts its references in ref_count, and the
+canonical index of the chunk tables lists them. A reference to a chunk of another document is
+written in the same transaction as its count, so the count matches the reference items. Releasing a canonical chunk promotes one of its
+references to a full item, releasing a reference decrements the count.
+
+Configuration (environment variables):
+NEAR_DUP_THRESHOLD: estimated Jaccard similarity from which a chunk is a near duplicate (default 0.9)
+NEAR_DUP_PERMUTATIONS: signature length (default 128)
+NEAR_DUP_SHINGLE: words per shingle (default 5)
+"""
+
+import hashlib
+import os
+import random
+import re
+import time
+from array import array
+
+from botocore.exceptions import ClientError
+
+NEAR_DUP_THRESHOLD = float(os.environ.get('NEAR_DUP_THRESHOLD', 0.9))
+NEAR_DUP_PERMUTATIONS = int(os.environ.get('NEAR_DUP_PERMUTATIONS', 128))
+NEAR_DUP_SHINGLE = max(1, int(os.environ.get('NEAR_DUP_SHINGLE', 5)))
+CANONICAL_INDEX = 'canonical'
+WORD_PATTERN = re.compile(r'\w+')
+DYNAMO_BATCH_SIZE = 25
+DYNAMO_BATCH_GET_SIZE = 100
+DYNAMO_MAX_ATTEMPTS = 8
+
+
+def shingles(text, size=NEAR_DUP_SHINGLE):
+    """Set of the `size` word shingles of the text, lower cased"""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(text, permutations=NEAR_DUP_PERMUTATIONS):
+    """MinHash signature of the text, an array of `permutations` unsigned 32 bit values"""
+    hashes = [array('I', hashlib.shake_128(shingle.encode('utf-8')).digest(4 * permutations))
+              for shingle in shingles(text)]
+    return array('I', map(min, zip(*hashes)))
+
+
+def signature_from_bytes(data):
+    signature = array('I')
+    signature.frombytes(bytes(data))
+    return signature
+
+
+def similarity(signature, other):
+    """Estimated Jaccard similarity of two signatures"""
+    return sum(1 for a, b in zip(signature, other) if a == b) / len(signature)
+
+
+def lsh_bands(threshold=NEAR_DUP_THRESHOLD, permutations=NEAR_DUP_PERMUTATIONS):
+    """(bands, rows) whose candidate threshold (1/bands)^(1/rows) is the closest to `threshold`"""
+    options = [(bands, permutations // bands) for bands in range(1, permutations + 1) if permutations % bands == 0]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+
+def retry_batch(call, request_items, unprocessed):
+    """Run a batch request until DynamoDB processed every key, jittered exponential backoff"""
+    responses = []
+    attempt = 0
+    while request_items:
+        response = call(RequestItems=request_items)
+        responses.append(response)
+        request_items = response.get(unprocessed) or {}
+        if request_items:
+            attempt += 1
+            if attempt >= DYNAMO_MAX_ATTEMPTS:
+                raise RuntimeError(f"Batch request left unprocessed keys after {attempt} attempts")
+            time.sleep(random.uniform(0, min(10, 0.1 * (2 ** attempt))))
+    return responses
+
+
+class NearDuplicateIndex:
+    """
+    LSH index of the canonical chunks of one group in one chunk table.
+    `match` looks a signature up in the stored bands and in the chunks registered since the
+    index was created, `register` records a new canonical chunk and `flush` writes its bands.
+    """
+
+    def __init__(self, dynamodb, signature_table, chunk_table, group,
+                 threshold=NEAR_DUP_THRESHOLD, permutations=NEAR_DUP_PERMUTATIONS):
+        self.dynamodb = dynamodb
+        self.signature_table = signature_table
+        self.scope = f"{chunk_table}#{group}"
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(threshold, permutations)
+        self.stored = {}
+        self.local = {}
+        self.pending = {}
+
+    def band_keys(self, signature):
+        data = signature.tobytes()
+        width = self.rows * signature.itemsize
+        return [f"{self.scope}#{band}#{hashlib.blake2b(data[band * width:(band + 1) * width], digest_size=12).hexdigest()}"
+                for band in range(self.bands)]
+
+    def prefetch(self, signatures):
+        """Read the stored band items of all the signatures, 100 keys per BatchGetItem"""
+        keys = sorted({key for signature in signatures for key in self.band_keys(signature)} - set(self.stored))
+        for i in range(0, len(keys), DYNAMO_BATCH_GET_SIZE):
+            request_items = {self.signature_table: {
+                'Keys': [{'band': key} for key in keys[i:i + DYNAMO_BATCH_GET_SIZE]]
+            }}
+            for response in retry_batch(self.dynamodb.batch_get_item, request_items, 'UnprocessedKeys'):
+                for item in response['Responses'].get(self.signature_table, []):
+                    self.stored[item['band']] = (
+                        {'id': item['canonical_id'], 'filename': item['canonical_filename']},
+                        signature_from_bytes(item['signature'].value)
+                    )
+
+    def match(self, signature):
+        """
+        The most similar canonical chunk sharing a band with the signature, above the threshold.
+
+        Returns:
+            tuple: (canonical key, similarity, stored) or None
+        """
+        candidates = {}
+        for key in self.band_keys(signature):
+            for source, is_stored in ((self.local, False), (self.stored, True)):
+                if key in source:
+                    canonical, other = source[key]
+                    candidates.setdefault((canonical['id'], canonical['filename']), (canonical, other, is_stored))
+        best = None
+        for canonical, other, is_stored in candidates.values():
+            score = similarity(signature, other)
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (canonical, score, is_stored)
+        return best
+
+    def forget(self, canonical):
+        """Drop the stored bands of a canonical chunk that no longer exists, the next chunk registered takes them over"""
+        key = (canonical['id'], canonical['filename'])
+        self.stored = {band: entry for band, entry in self.stored.items()
+                       if (entry[0]['id'], entry[0]['filename']) != key}
+
+    def register(self, signature, canonical):
+        """Record a canonical chunk, its band items are written by flush for the bands that are free"""
+        for key in self.band_keys(signature):
+            self.local.setdefault(key, (canonical, signature))
+            if key not in self.stored and key not in self.pending:
+                self.pending[key] = {
+                    'band': key,
+                    'canonical_id': canonical['id'],
+                    'canonical_filename': canonical['filename'],
+                    'signature': signature.tobytes()
+                }
+
+    def claim(self, signature, canonical):
+        """Point every band of the signature to `canonical`, written by flush whatever they held"""
+        for key in self.band_keys(signature):
+            self.pending[key] = {
+                'band': key,
+                'canonical_id': canonical['id'],
+                'canonical_filename': canonical['filename'],
+                'signature': signature.tobytes()
+            }
+
+    def flush(self):
+        """Write the band items of the registered chunks, once their chunk items exist"""
+        items = list(self.pending.values())
+        for i in range(0, len(items), DYNAMO_BATCH_SIZE):
+            request_items = {self.signature_table: [{'PutRequest': {'Item': item}} for item in items[i:i + DYNAMO_BATCH_SIZE]]}
+            retry_batch(self.dynamodb.batch_write_item, request_items, 'UnprocessedItems')
+        self.pending = {}
+        return len(items)
+
+
+def add_reference(dynamodb, table_name, canonical, reference):
+    """
+    Write the reference item to a stored canonical chunk and count it, in one transaction:
+    the count only goes up when the reference item is new, so a retried invocation does not
+    count the references it already wrote.
+
+    Returns:
+        bool: False when the canonical chunk is gone, nothing is written then
+    """
+    try:
+        # the client of the resource serializes the attribute values like the Table methods
+        dynamodb.meta.client.transact_write_items(TransactItems=[
+            {'Update': {
+                'TableName': table_name,
+                'Key': canonical,
+                'UpdateExpression': 'ADD ref_count :one',
+                'ConditionExpression': 'attribute_exists(vector)',
+                'ExpressionAttributeValues': {':one': 1}
+            }},
+            {'Put': {
+                'TableName': table_name,
+                'Item': reference,
+                'ConditionExpression': 'attribute_not_exists(filename)'
+            }}
+        ])
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+        if not reasons or reasons[0] == 'ConditionalCheckFailed':
+            return False
+        if reasons[1:] == ['ConditionalCheckFailed']:
+            # written and counted by an earlier attempt
+            return True
+        raise
+
+
+def reference_item(item_id, filename, canonical):
+    """Chunk item of a near duplicate: no vector and no group, the group index skips it"""
+    return {
+        'id': item_id,
+        'filename': filename,
+        'canonical_id': canonical['id'],
+        'canonical_filename': canonical['filename']
+    }
+
+
+def list_references(table, canonical):
+    """Keys of the reference items of a canonical chunk, from the canonical index"""
+    query = {
+        'IndexName': CANONICAL_INDEX,
+        'KeyConditionExpression': 'canonical_id = :id AND canonical_filename = :filename',
+        'ExpressionAttributeValues': {':id': canonical['id'], ':filename': canonical['filename']}
+    }
+    keys = []
+    while True:
+        response = table.query(**query)
+        keys.extend({'id': item['id'], 'filename': item['filename']} for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return keys
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def release_chunks(dynamodb, table_name, items, deleted=lambda key: False, signature_table=None):
+    """
+    Keep the references consistent before chunk items are deleted. `items` are the stored
+    items (id, filename, canonical_id, canonical_filename, ref_count) about to be deleted and
+    `deleted` tells whether another chunk key is deleted with them.
+    - a reference decrements the count of its canonical chunk
+    - a canonical chunk with references left is copied to its first surviving reference, the
+      other references are pointed to it, and so are its bands when `signature_table` is set
+
+    Returns:
+        int: references promoted to canonical chunks
+    """
+    table = dynamodb.Table(table_name)
+    promoted = 0
+    for item in items:
+        if 'canonical_id' in item:
+            canonical = {'id': item['canonical_id'], 'filename': item['canonical_filename']}
+            if not deleted(canonical):
+                try:
+                    table.update_item(Key=canonical, UpdateExpression='ADD ref_count :minus',
+                                      ConditionExpression='attribute_exists(vector)',
+                                      ExpressionAttributeValues={':minus': -1})
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+        elif item.get('ref_count', 0) > 0:
+            key = {'id': item['id'], 'filename': item['filename']}
+            references = [reference for reference in list_references(table, key) if not deleted(reference)]
+            if not references:
+                continue
+            full = table.get_item(Key=key).get('Item')
+            if not full:
+                continue
+            successor = references[0]
+            table.put_item(Item={
+                **{name: value for name, value in full.items() if name not in ('id', 'filename', 'ref_count')},
+                **successor,
+                'ref_count': len(references) - 1
+            })
+            for reference in references[1:]:
+                table.update_item(Key=reference,
+                                  UpdateExpression='SET canonical_id = :id, canonical_filename = :filename',
+                                  ExpressionAttributeValues={':id': successor['id'], ':filename': successor['filename']})
+            if signature_table:
+                index = NearDuplicateIndex(dynamodb, signature_table, table_name, full['group'])
+                index.claim(minhash(full['text']), successor)
+                index.flush()
+            promoted += 1
+    return promoted
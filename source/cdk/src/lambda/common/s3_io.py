@@ -0,0 +1,350 @@
+"""
+S3_IO module:
+Bounded memory reads and writes of large S3 objects (PDFs, raw text, consolidated documents).
+
+S3MultipartWriter is a write only file object: data is buffered up to one part and uploaded
+with UploadPart as soon as the part is full, so memory stays at one part whatever the object
+size. Objects smaller than one part are written with a single PutObject on close.
+
+Usage:
+    with S3MultipartWriter(s3, bucket, key, content_type='text/plain') as writer:
+        for line in lines:
+            writer.write(line.encode('utf-8'))
+On an exception inside the block the multipart upload is aborted, no partial object is left.
+
+S3RangeReader is a read only, seekable file object over an S3 object that fetches fixed size
+blocks with ranged GETs on demand and keeps the most recent ones, so parsers that seek around
+(pypdf reads the trailer first) only download the parts they touch.
+
+Intermediate artifacts (page text, raw text, chunk objects, the page cache) are gzip compressed
+by S3ArtifactWriter and put_artifact, with ContentEncoding gzip and unchanged keys. Readers
+(open_artifact, read_artifact, artifact_body) detect the gzip magic bytes and decompress while
+the body streams, so objects written before compression, or with ARTIFACT_COMPRESSION=none,
+are read as they are.
+
+Configuration (environment variables):
+ARTIFACT_COMPRESSION: gzip (default) or none
+ARTIFACT_COMPRESSION_LEVEL: gzip level (default 6)
+"""
+
+import gzip
+import io
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_COMPRESSION = os.environ.get('ARTIFACT_COMPRESSION', 'gzip').lower()
+ARTIFACT_COMPRESSION_LEVEL = int(os.environ.get('ARTIFACT_COMPRESSION_LEVEL', 6))
+GZIP_MAGIC = b'\x1f\x8b'
+READ_BUFFER_SIZE = 1024 * 1024
+
+# S3 minimum part size is 5 MiB (except the last part)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """
+    File like writer that streams to an S3 object.
+
+    Args:
+        s3: boto3 S3 client
+        bucket (str): target bucket
+        key (str): target key
+        part_size (int): bytes per part, at least 5 MiB
+        content_type (str): optional ContentType of the object
+        content_encoding (str): optional ContentEncoding of the object
+    """
+
+    def __init__(self, s3, bucket, key, part_size=DEFAULT_PART_SIZE, content_type=None, content_encoding=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(MIN_PART_SIZE, int(part_size))
+        self.extra = {'ContentType': content_type} if content_type else {}
+        if content_encoding:
+            self.extra['ContentEncoding'] = content_encoding
+        self.buffer = []
+        self.buffered = 0
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError(f"Write to closed S3MultipartWriter s3://{self.bucket}/{self.key}")
+        if not data:
+            return 0
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.bytes_written += len(data)
+        if self.buffered >= self.part_size:
+            self._upload_part(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        return len(data)
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra)['UploadId']
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=number, Body=body)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        """Upload the remaining data and complete the object"""
+        if self.closed:
+            return
+        body = b''.join(self.buffer)
+        self.buffer = []
+        if self.upload_id is None:
+            # small object, one request
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=body, **self.extra)
+        else:
+            if body:
+                self._upload_part(body)
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        self.closed = True
+
+    def abort(self):
+        """Discard the upload, the parts already uploaded are deleted"""
+        self.closed = True
+        self.buffer = []
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.warning(f"Could not abort multipart upload {self.upload_id} of {self.key}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_CACHED_BLOCKS = 16
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable reader of an S3 object backed by ranged GETs.
+
+    Args:
+        s3: boto3 S3 client
+        bucket (str): source bucket
+        key (str): source key
+        size (int): object size, read with HeadObject when not given
+        block_size (int): bytes per ranged GET
+        cached_blocks (int): blocks kept in memory
+    """
+
+    def __init__(self, s3, bucket, key, size=None, block_size=DEFAULT_BLOCK_SIZE, cached_blocks=DEFAULT_CACHED_BLOCKS):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.block_size = int(block_size)
+        self.cached_blocks = max(1, int(cached_blocks))
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def _block(self, index):
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        start = index * self.block_size
+        end = min(self.size, start + self.block_size) - 1
+        data = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")['Body'].read()
+        self.requests += 1
+        self.blocks[index] = data
+        if len(self.blocks) > self.cached_blocks:
+            self.blocks.popitem(last=False)
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.block_size)
+            data = self._block(index)[offset:offset + len(view) - written]
+            view[written:written + len(data)] = data
+            written += len(data)
+            self.position += len(data)
+        return written
+
+
+def compress_artifacts(compress=None):
+    """Whether an artifact is written compressed: `compress` when given, else the configuration"""
+    return ARTIFACT_COMPRESSION == 'gzip' if compress is None else compress
+
+
+def content_encoding(key, compressed):
+    # .gz keys are gzip files, ContentEncoding would make HTTP clients decompress them
+    return 'gzip' if compressed and not key.endswith('.gz') else None
+
+
+class S3ArtifactWriter:
+    """
+    S3MultipartWriter that gzip compresses the data written to it (see compress_artifacts),
+    bytes_written counts the uncompressed bytes and bytes_stored the object size.
+
+    Args:
+        s3: boto3 S3 client
+        bucket (str): target bucket
+        key (str): target key
+        content_type (str): optional ContentType of the object
+        compress (bool): override ARTIFACT_COMPRESSION
+        part_size (int): bytes per part, at least 5 MiB
+    """
+
+    def __init__(self, s3, bucket, key, content_type=None, compress=None, part_size=DEFAULT_PART_SIZE):
+        self.compressed = compress_artifacts(compress)
+        self.raw = S3MultipartWriter(s3, bucket, key, part_size=part_size, content_type=content_type,
+                                     content_encoding=content_encoding(key, self.compressed))
+        self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=ARTIFACT_COMPRESSION_LEVEL,
+                                    mtime=0) if self.compressed else None
+        self.bytes_written = 0
+
+    @property
+    def bytes_stored(self):
+        return self.raw.bytes_written
+
+    def write(self, data):
+        if not data:
+            return 0
+        if self.stream is not None:
+            self.stream.write(data)
+        else:
+            self.raw.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        # closing the GzipFile writes the trailer, it leaves the multipart writer open
+        if self.stream is not None:
+            self.stream.close()
+        self.raw.close()
+
+    def abort(self):
+        self.raw.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def put_artifact(s3, bucket, key, body, content_type=None, compress=None, **extra):
+    """
+    PutObject of a small artifact, gzip compressed (see compress_artifacts).
+    `extra` is passed to PutObject (Metadata...).
+
+    Returns:
+        int: bytes stored
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    compressed = compress_artifacts(compress)
+    if compressed:
+        body = gzip.compress(body, compresslevel=ARTIFACT_COMPRESSION_LEVEL, mtime=0)
+        encoding = content_encoding(key, compressed)
+        if encoding:
+            extra['ContentEncoding'] = encoding
+    if content_type:
+        extra['ContentType'] = content_type
+    s3.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+    return len(body)
+
+
+class _StreamingBodyIO(io.RawIOBase):
+    """Raw stream over a botocore StreamingBody (or any object with read(n))"""
+
+    def __init__(self, body):
+        super().__init__()
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.body.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        super().close()
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    """GzipFile that closes its source stream with it"""
+
+    def close(self):
+        source = self.fileobj
+        super().close()
+        if source is not None:
+            source.close()
+
+
+def artifact_body(body):
+    """
+    Readable binary stream of an object body, decompressed while it streams when the content
+    starts with the gzip magic bytes, returned as is otherwise
+    """
+    stream = io.BufferedReader(_StreamingBodyIO(body), buffer_size=READ_BUFFER_SIZE)
+    if stream.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return _ClosingGzipFile(fileobj=stream, mode='rb')
+    return stream
+
+
+def open_artifact(s3, bucket, key, **kwargs):
+    """Decompressing stream of an artifact, `kwargs` are passed to GetObject"""
+    return artifact_body(s3.get_object(Bucket=bucket, Key=key, **kwargs)['Body'])
+
+
+def read_artifact(s3, bucket, key, **kwargs):
+    """Content of an artifact, decompressed"""
+    with open_artifact(s3, bucket, key, **kwargs) as stream:
+        return stream.read()
@@ -0,0 +1,181 @@
+"""
+BULK_DELETE function:
+Invoked by the delete state machine (AIbotSMDeletion) to remove everything the ingestion
+created for one document, in bulk:
+- S3: every object under {folder}/{group}/{uuid}_ for the derived folders (pages, pages_processed,
+  raw_json, raw_text, rag) and the upload raw_docs/{group}/{filename}. Keys are paged with
+  list_objects_v2 and each page (up to 1000 keys) is removed with one DeleteObjects request
+- DynamoDB: the chunk items of the document (partition key {group}-{uuid}) of every chunk table,
+  queried page by page projecting only the keys and removed with BatchWriteItem (25 keys per
+  request) from a thread pool. The workers share a low level client, clients are thread safe
+  while the boto3 resource used by the main thread is not. The global secondary indexes of the
+  tables follow the base items
+
+Near duplicate chunks (common/near_duplicates.py) are released first: the references of the
+document decrement the count of their canonical chunk, and a canonical chunk of the document
+still referenced by other documents is promoted to one of its references.
+
+Uploads deduplicated by read_docs share the uuid of the document holding their content. When
+another document of the group still uses the uuid (content index of the documents table), only
+the upload is removed and the derived objects and chunk items are kept for it.
+
+Deleting an object or item that no longer exists is not an error, so a retried invocation
+finishes the work of a failed one.
+
+Configuration (environment variables):
+MAX_WORKERS: concurrent DeleteObjects / BatchWriteItem requests (default 8)
+CONTENT_INDEX: content index of the documents table (default content_sha256)
+NEAR_DUP_TABLE: signature table of the near duplicate index, the bands of promoted chunks are rewritten
+
+Input:
+{
+    "Bucket": bucket,
+    "Group": group,
+    "Uuid": document uuid,
+    "Filename": upload file name,
+    "Tables": [chunk table names],
+    "DocumentTable": documents table name
+}
+
+Output:
+{
+    'statusCode': 200,
+    'objects_deleted': {folder: count},
+    'items_deleted': {table: count},
+    'shared': True when the uuid is still used by another document
+}
+"""
+
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from near_duplicates import release_chunks
+
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 8))
+CONTENT_INDEX = os.environ.get('CONTENT_INDEX', 'content_sha256')
+NEAR_DUP_TABLE = os.environ.get('NEAR_DUP_TABLE', None)
+DOCUMENT_FOLDERS = ('pages', 'pages_processed', 'raw_json', 'raw_text', 'rag')
+S3_BATCH_SIZE = 1000
+DYNAMO_BATCH_SIZE = 25
+DYNAMO_MAX_ATTEMPTS = 8
+
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS + 2))
+dynamodb = boto3.resource('dynamodb')
+# BatchWriteItem runs on the worker threads
+dynamodb_client = boto3.client('dynamodb', config=Config(max_pool_connections=MAX_WORKERS + 2))
+serializer = TypeSerializer()
+
+
+def delete_objects(bucket, keys):
+    """Delete up to 1000 keys with one DeleteObjects request, returns the number of keys"""
+    response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    errors = response.get('Errors', [])
+    if errors:
+        raise RuntimeError(f"DeleteObjects failed for {len(errors)} keys, first: {errors[0]}")
+    return len(keys)
+
+
+def delete_prefix(executor, bucket, prefix):
+    """Delete every object under `prefix`, one DeleteObjects request per listed page"""
+    futures = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': S3_BATCH_SIZE}):
+        keys = [obj['Key'] for obj in page.get('Contents', [])]
+        if keys:
+            futures.append(executor.submit(delete_objects, bucket, keys))
+    return sum(future.result() for future in futures)
+
+
+def send_batch(table_name, requests):
+    request_items = {table_name: requests}
+    attempt = 0
+    while request_items:
+        response = dynamodb_client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if request_items:
+            attempt += 1
+            if attempt >= DYNAMO_MAX_ATTEMPTS:
+                raise RuntimeError(f"BatchWriteItem left unprocessed items after {attempt} attempts")
+            time.sleep(random.uniform(0, min(10, 0.1 * (2 ** attempt))))
+
+
+def delete_batch(table_name, keys):
+    """Delete up to 25 items by key with BatchWriteItem"""
+    send_batch(table_name, [{'DeleteRequest': {'Key': {name: serializer.serialize(value) for name, value in key.items()}}}
+                            for key in keys])
+    return len(keys)
+
+
+def delete_chunk_items(executor, table_name, item_id):
+    """Delete the items of partition `item_id`, each queried page is deleted while the next one is read"""
+    table = dynamodb.Table(table_name)
+    query = {
+        'KeyConditionExpression': Key('id').eq(item_id),
+        'ProjectionExpression': 'id, filename, canonical_id, canonical_filename, ref_count'
+    }
+    futures = []
+    while True:
+        response = table.query(**query)
+        items = response['Items']
+        release_chunks(dynamodb, table_name, [item for item in items if 'canonical_id' in item or item.get('ref_count')],
+                       deleted=lambda key, item_id=item_id: key['id'] == item_id, signature_table=NEAR_DUP_TABLE)
+        keys = [{'id': item['id'], 'filename': item['filename']} for item in items]
+        for i in range(0, len(keys), DYNAMO_BATCH_SIZE):
+            futures.append(executor.submit(delete_batch, table_name, keys[i:i + DYNAMO_BATCH_SIZE]))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return sum(future.result() for future in futures)
+
+
+def is_shared(document_table, group, filename, _uuid):
+    """True when another document of the group links to `_uuid` (deduplicated upload)"""
+    if not document_table:
+        return False
+    table = dynamodb.Table(document_table)
+    item = table.get_item(Key={'group': group, 'filename': filename}).get('Item') or {}
+    if not item.get('content_sha256'):
+        return False
+    response = table.query(
+        IndexName=CONTENT_INDEX,
+        KeyConditionExpression=Key('content_sha256').eq(item['content_sha256']) & Key('group').eq(group)
+    )
+    return any(other['filename'] != filename and other.get('uuid') == _uuid for other in response['Items'])
+
+
+def handler(event, context):
+    print("Event", event)
+    bucket = event['Bucket']
+    group = event['Group']
+    _uuid = event['Uuid']
+    tables = [table for table in event.get('Tables', []) if table]
+
+    objects_deleted, items_deleted = {}, {}
+    shared = is_shared(event.get('DocumentTable'), group, event['Filename'], _uuid)
+    if shared:
+        print(f"{group}/{_uuid} is shared with another document, only the upload is deleted")
+    else:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            objects_deleted = {
+                folder: delete_prefix(executor, bucket, f"{folder}/{group}/{_uuid}_")
+                for folder in DOCUMENT_FOLDERS
+            }
+            items_deleted = {
+                table: delete_chunk_items(executor, table, f"{group}-{_uuid}")
+                for table in tables
+            }
+    # the upload itself, DeleteObject succeeds when it is already gone
+    s3.delete_object(Bucket=bucket, Key=f"raw_docs/{group}/{event['Filename']}")
+    print(f"Deleted objects {objects_deleted} and chunk items {items_deleted} of {group}/{_uuid}")
+    return {
+        'statusCode': 200,
+        'objects_deleted': objects_deleted,
+        'items_deleted': items_deleted,
+        'shared': shared
+    }
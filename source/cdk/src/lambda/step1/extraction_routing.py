@@ -0,0 +1,97 @@
+"""
+EXTRACTION_ROUTING module:
+Decides which extraction pipeline processes an upload, so a document is only OCR'd and
+embedded by the pipelines whose chunk table is queried:
+textract: Textract job -> SNS -> AIbotSM -> textract chunk table
+llm: page split -> LLM extraction state machine -> llm chunk table
+both: the two pipelines (original behaviour)
+
+Configuration (environment variable EXTRACTION_ROUTING), JSON:
+{
+    "default": "both",
+    "groups": {"group1": "textract"},
+    "prefixes": {"raw_docs/group2/scans/": "llm"},
+    "auto": {"max_llm_pages": 30, "digital": "llm", "scanned": "textract",
+             "sample_pages": 5, "min_text_chars": 100}
+}
+The longest matching upload prefix wins, then the group of the upload, then the default.
+A route of "auto" looks at the document: PDFs with more than max_llm_pages pages go to
+Textract, otherwise the route depends on whether the sampled pages have a text layer.
+"""
+
+import json
+import os
+
+ROUTES = ('textract', 'llm', 'both')
+DEFAULT_AUTO = {
+    'max_llm_pages': 30,
+    'digital': 'llm',
+    'scanned': 'textract',
+    'sample_pages': 5,
+    'min_text_chars': 100
+}
+
+
+def load_policy():
+    policy = json.loads(os.environ.get('EXTRACTION_ROUTING') or '{}')
+    policy.setdefault('default', 'both')
+    policy.setdefault('groups', {})
+    policy.setdefault('prefixes', {})
+    policy['auto'] = {**DEFAULT_AUTO, **policy.get('auto', {})}
+    return policy
+
+
+def configured_route(key, policy):
+    """Route configured for the upload `key` (raw_docs/{group}/{file}), may be "auto" """
+    prefixes = [prefix for prefix in policy['prefixes'] if key.startswith(prefix)]
+    if prefixes:
+        return policy['prefixes'][max(prefixes, key=len)]
+    group = key.split('/')[-2]
+    return policy['groups'].get(group, policy['default'])
+
+
+def has_text_layer(pdf_reader, sample_pages, min_text_chars):
+    """True when most of the sampled pages (spread over the document) carry extractable text"""
+    total = len(pdf_reader.pages)
+    if total == 0:
+        return False
+    step = max(1, total // sample_pages)
+    sampled = list(range(0, total, step))[:sample_pages]
+    with_text = 0
+    for page_num in sampled:
+        try:
+            text = pdf_reader.pages[page_num].extract_text() or ''
+        except Exception:
+            text = ''
+        if len(text.strip()) >= min_text_chars:
+            with_text += 1
+    return with_text * 2 > len(sampled)
+
+
+def auto_route(pdf_reader, auto):
+    if len(pdf_reader.pages) > auto['max_llm_pages']:
+        return 'textract'
+    if has_text_layer(pdf_reader, auto['sample_pages'], auto['min_text_chars']):
+        return auto['digital']
+    return auto['scanned']
+
+
+def resolve_route(key, open_reader, policy=None):
+    """
+    Pipeline(s) that process the upload `key`.
+
+    Args:
+        key (str): upload key, raw_docs/{group}/{file}
+        open_reader (callable): returns a pypdf reader of the document, only called for "auto"
+        policy (dict): routing policy, read from EXTRACTION_ROUTING when not given
+
+    Returns:
+        str: "textract", "llm" or "both"
+    """
+    policy = policy or load_policy()
+    route = configured_route(key, policy)
+    if route == 'auto':
+        route = auto_route(open_reader(), policy['auto'])
+    if route not in ROUTES:
+        raise ValueError(f"Unknown extraction route {route} for {key}, expected one of {ROUTES} or auto")
+    return route
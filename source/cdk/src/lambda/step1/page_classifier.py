@@ -0,0 +1,78 @@
+"""
+PAGE_CLASSIFIER module:
+Measures the embedded text layer of every PDF page so born-digital pages are extracted
+locally with pypdf and only scanned or image heavy pages are sent to Textract or the LLM.
+
+A page is digital when:
+- its text layer has at least MIN_TEXT_CHARS non blank characters (default 200)
+- the glyph coverage, the share of those characters that map to real Unicode text (not
+  U+FFFD, private use or control characters left by fonts without a ToUnicode map), is at
+  least MIN_GLYPH_COVERAGE (default 0.95)
+- when the page also draws images, it has at least MIN_TEXT_CHARS_WITH_IMAGES characters
+  (default 800), so figures and scanned inserts with a short caption still get OCR
+"""
+
+import logging
+import os
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+MIN_TEXT_CHARS = int(os.environ.get('MIN_TEXT_CHARS', 200))
+MIN_GLYPH_COVERAGE = float(os.environ.get('MIN_GLYPH_COVERAGE', 0.95))
+MIN_TEXT_CHARS_WITH_IMAGES = int(os.environ.get('MIN_TEXT_CHARS_WITH_IMAGES', 800))
+
+DIGITAL = 'digital'
+SCANNED = 'scanned'
+INVALID_CATEGORIES = {'Co', 'Cn', 'Cs', 'Cc'}
+
+
+def glyph_coverage(text):
+    """Share of the non blank characters that decode to real Unicode text"""
+    characters = [character for character in text if not character.isspace()]
+    if not characters:
+        return 0.0
+    valid = sum(1 for character in characters
+                if character != '�' and unicodedata.category(character) not in INVALID_CATEGORIES)
+    return valid / len(characters)
+
+
+def has_images(page):
+    """True when the page resources hold at least one image XObject"""
+    try:
+        resources = page.get('/Resources')
+        xobjects = resources.get_object().get('/XObject') if resources else None
+        if not xobjects:
+            return False
+        for xobject in xobjects.get_object().values():
+            if xobject.get_object().get('/Subtype') == '/Image':
+                return True
+    except Exception as e:
+        logger.warning(f"Could not inspect the page images: {e}")
+        return True
+    return False
+
+
+def classify_page(page):
+    """
+    Classify one pypdf page.
+
+    Returns:
+        tuple: ("digital", text) or ("scanned", None)
+    """
+    try:
+        text = page.extract_text() or ''
+    except Exception as e:
+        logger.warning(f"Could not extract the text layer: {e}")
+        return SCANNED, None
+    characters = sum(1 for character in text if not character.isspace())
+    if characters < MIN_TEXT_CHARS or glyph_coverage(text) < MIN_GLYPH_COVERAGE:
+        return SCANNED, None
+    if characters < MIN_TEXT_CHARS_WITH_IMAGES and has_images(page):
+        return SCANNED, None
+    return DIGITAL, text
+
+
+def classify_pages(pdf_reader):
+    """Classify every page of the document, a list of (kind, text) in page order"""
+    return [classify_page(page) for page in pdf_reader.pages]
@@ -8,6 +8,50 @@ Within the same bucket, in the raw_json folder
 Important Note:
 Textract jobs may take long time. Set timeout as long as feasible
 
+Ingestion mode (environment variable INGESTION_MODE):
+full: every upload gets a new uuid, the chunks of a previous upload are left to the delete flow
+incremental (default): a re-upload of (group, filename) keeps the uuid of the document and
+    increments its revision in one atomic update of the documents table. The pages of the
+    previous revision are removed, and store_chunk_dynamo only embeds the chunks whose content
+    changed and deletes the ones that are gone
+
+Page split (environment variables):
+SPLIT_MODE: memory (default) serializes the pages to in-memory buffers uploaded by a bounded
+    thread pool, the PDF is read from S3 directly (ranged GETs above RANGE_READ_THRESHOLD_MB,
+    default 64); disk writes the pages to /tmp like the original implementation
+PAGES_PER_OBJECT: pages stored in each pages/ object (default 1), objects holding several
+    pages are named ..._page_{first}-{last}.pdf
+SPLIT_WORKERS: concurrent page uploads (default 8)
+
+Extraction routing (environment variable EXTRACTION_ROUTING, see extraction_routing.py):
+every upload is routed to textract, llm or both, per group, per upload prefix or
+automatically from the page count and text layer of the PDF. The Textract job is only
+started and the pages are only split for the selected pipelines. When a revision is routed
+away from a pipeline, the objects and chunk items that pipeline produced for the previous
+revision are removed (tables of CHUNK_PROFILES, near duplicate references released through
+NEAR_DUP_TABLE), otherwise retrieval would keep returning them.
+
+Text layer fast path (environment variable TEXT_LAYER_FAST_PATH, default true, see
+page_classifier.py): every page is classified from its embedded text layer. Digital pages
+are extracted locally with pypdf:
+llm: their text is written to pages_processed/ directly (gzip compressed, see
+    common/s3_io.py), only the scanned pages are split to pages/ for the LLM extraction
+textract: when every page is digital, no Textract job is started, the text layer is written
+    as Textract shaped JSON Lines to raw_json/ (gzip compressed as .jsonl.gz unless
+    TEXTRACT_OUTPUT_COMPRESS is false, like the Textract results) and the Textract state
+    machine is started.
+    Textract jobs cover whole documents, so a document with any scanned page is still sent
+    to Textract in full
+
+Content deduplication (environment variable DEDUP_UPLOADS, default true): the sha256 of the
+upload is recorded in the documents table (content_sha256, indexed by CONTENT_INDEX). Before
+any extraction starts:
+- a re-upload of (group, filename) with the same content whose chunks exist is skipped
+- a new filename whose content was already ingested in the group is linked to that document,
+    its item shares the uuid, and therefore the chunks, of the original (duplicate_of)
+The pipeline stops after this task for both (run_llm false, no Textract job). A document whose
+uuid is shared with a linked copy gets a new uuid when its content changes.
+
 Input:
 Standard S3 put event JSON
 
@@ -57,27 +101,58 @@ Textract: StartDocumentTextDetection, GetDocumentTextDetection
         }
     ]
 }
+Step Functions: StartExecution on the Textract state machine (TEXTRACT_STATE_MACHINE), used
+when the text layer replaces the Textract job
+DynamoDB: read and write on the chunk tables (DYNAMO_TABLE_TEXTRACT, DYNAMO_TABLE_LLM) and the
+signature table (NEAR_DUP_TABLE), used when a revision changes route
 
 """
 
 
+import base64
 import boto3
+import hashlib
+import io
 import json
+import shutil
 import time
 import os
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from pathlib import Path
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 import pypdf
+from s3_io import S3ArtifactWriter, S3RangeReader, put_artifact
+from chunk_profiles import SOURCES, profiles_for_source
+from near_duplicates import release_chunks
+from extraction_routing import resolve_route
+from page_classifier import DIGITAL, classify_pages
+
 
+SPLIT_MODE = os.environ.get("SPLIT_MODE", "memory")
+PAGES_PER_OBJECT = max(1, int(os.environ.get("PAGES_PER_OBJECT", 1)))
+SPLIT_WORKERS = int(os.environ.get("SPLIT_WORKERS", 8))
+RANGE_READ_THRESHOLD = int(os.environ.get("RANGE_READ_THRESHOLD_MB", 64)) * 1024 * 1024
+TEXT_LAYER_FAST_PATH = os.environ.get("TEXT_LAYER_FAST_PATH", "true").lower() == "true"
+DEDUP_UPLOADS = os.environ.get("DEDUP_UPLOADS", "true").lower() == "true"
+TEXTRACT_OUTPUT_COMPRESS = os.environ.get("TEXTRACT_OUTPUT_COMPRESS", "true").lower() == "true"
+CONTENT_INDEX = os.environ.get("CONTENT_INDEX", "content_sha256")
+HASH_BLOCK_SIZE = 1024 * 1024
+NEAR_DUP_TABLE = os.environ.get("NEAR_DUP_TABLE", None)
 
 # Initialize S3 and Textract clients
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(max_pool_connections=SPLIT_WORKERS + 2))
 textract = boto3.client('textract')
 dynamodb = boto3.resource('dynamodb')
+sfn = boto3.client('stepfunctions')
 #upload the same file to bucket in folder raw_json
 s3_resource = boto3.resource('s3')
 sns_topic = os.environ.get("SNS_TOPIC", None)
 sns_role = os.environ.get("TEXTRACT_ROLE", None)
+textract_state_machine = os.environ.get("TEXTRACT_STATE_MACHINE", None)
+INGESTION_MODE = os.environ.get("INGESTION_MODE", "incremental")
 def copy_to_s3(bucket_source, bucket_target, key_source, key_target):
     #Creating S3 Resource From the Session.
     #create a source dictionary that specifies bucket name and key name of the object to be copied
@@ -87,7 +162,21 @@ def copy_to_s3(bucket_source, bucket_target, key_source, key_target):
     }
     s3_resource.meta.client.copy(copy_source, bucket_target, key_target)
 
-def create_document_dynamodb(key, bucket):
+def documents_table():
+    return dynamodb.Table(os.environ.get("DOCUMENT_TABLE", "aibot-documents"))
+
+def create_document_dynamodb(key, bucket, extraction="both", content_hash=None, new_uuid=False):
+    """
+    Create or revise the document item of (group, filename) with a single atomic update.
+    In incremental mode the uuid of an existing document is kept, so the pipeline overwrites
+    its objects and chunks instead of creating a second copy, unless `new_uuid` is set because
+    a linked copy still uses the chunks of that uuid.
+    `extraction` records the pipeline(s) the document was routed to, `content_hash` the sha256
+    of the upload.
+
+    Returns:
+        tuple: (uuid, revision)
+    """
     head_object = s3.head_object(Bucket=bucket, Key=key)
     print(head_object)
     size = head_object['ContentLength']
@@ -95,15 +184,164 @@ def create_document_dynamodb(key, bucket):
     size = str(size / 1024)
     # generate a UUID
     _uuid = str(uuid.uuid4())
-    dynamodb.Table(os.environ.get("DOCUMENT_TABLE", "aibot-documents")).put_item(
-        Item={
+    keep_uuid = INGESTION_MODE == "incremental" and not new_uuid
+    uuid_expression = "if_not_exists(#uuid, :uuid)" if keep_uuid else ":uuid"
+    set_expression = f"#uuid = {uuid_expression}, #size = :size, extraction = :extraction, updated_at = :now"
+    values = {
+        ':uuid': _uuid,
+        ':size': size,
+        ':extraction': extraction,
+        ':now': datetime.now(timezone.utc).isoformat(),
+        ':one': 1
+    }
+    if content_hash:
+        set_expression += ", content_sha256 = :hash"
+        values[':hash'] = content_hash
+    response = documents_table().update_item(
+        Key={
             'group': key.split('/')[-2],
-            'filename': key.split('/')[-1],
-            'uuid': _uuid,
-            'size': size
-        }
+            'filename': key.split('/')[-1]
+        },
+        # the item is an ingestion of its own from now on, not a linked copy
+        UpdateExpression=f"SET {set_expression} ADD revision :one REMOVE duplicate_of",
+        ExpressionAttributeNames={'#uuid': 'uuid', '#size': 'size'},
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_NEW'
     )
-    return _uuid
+    return response['Attributes']['uuid'], int(response['Attributes']['revision'])
+
+def content_sha256(bucket, key):
+    """
+    Hex sha256 of the object. The full object checksum stored by S3 is used when the upload
+    sent one, otherwise the object is streamed through the hash in HASH_BLOCK_SIZE blocks.
+    """
+    head_object = s3.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    checksum = head_object.get('ChecksumSHA256')
+    # multipart uploads store a checksum of the part checksums, not of the content
+    if checksum and head_object.get('ChecksumType', 'FULL_OBJECT') == 'FULL_OBJECT' and '-' not in checksum:
+        return base64.b64decode(checksum).hex()
+    digest = hashlib.sha256()
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    for block in iter(lambda: body.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+def documents_with_content(group, content_hash):
+    """Document items of the group holding the same content"""
+    response = documents_table().query(
+        IndexName=CONTENT_INDEX,
+        KeyConditionExpression=Key('content_sha256').eq(content_hash) & Key('group').eq(group)
+    )
+    return response['Items']
+
+def is_ingested(bucket, group, _uuid):
+    """True when the chunks of the uuid were written, its ingestion went through"""
+    response = s3.list_objects_v2(Bucket=bucket, Prefix=f"rag/{group}/{_uuid}_", MaxKeys=1)
+    return response.get('KeyCount', 0) > 0
+
+def find_duplicate(bucket, key, content_hash, current):
+    """
+    The ingested document of the group with the same content as the upload: the current item
+    of (group, filename) when the re-upload is unchanged, else, for a new filename only, any
+    other document (a revised filename goes through the pipeline, its chunks are replaced).
+
+    Returns:
+        dict: the document item, None when the content has to be ingested
+    """
+    group = key.split('/')[-2]
+    filename = key.split('/')[-1]
+    if current:
+        if current.get('content_sha256') == content_hash and is_ingested(bucket, group, current['uuid']):
+            return current
+        return None
+    for item in documents_with_content(group, content_hash):
+        if item['filename'] != filename and is_ingested(bucket, group, item['uuid']):
+            return item
+    return None
+
+def is_shared(current):
+    """True when another document of the group links to the uuid of `current`"""
+    if current.get('duplicate_of'):
+        return True
+    if not current.get('content_sha256'):
+        return False
+    return any(item['filename'] != current['filename'] and item.get('uuid') == current['uuid']
+               for item in documents_with_content(current['group'], current['content_sha256']))
+
+def link_document(key, bucket, original, content_hash):
+    """Record the upload as a copy of `original`, it shares the uuid and the chunks of the original"""
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    documents_table().put_item(Item={
+        'group': key.split('/')[-2],
+        'filename': key.split('/')[-1],
+        'uuid': original['uuid'],
+        'size': str(size / 1024),
+        'extraction': original.get('extraction', 'both'),
+        'content_sha256': content_hash,
+        'duplicate_of': original.get('duplicate_of', original['filename']),
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+        'revision': 1
+    })
+
+def delete_prefix(bucket, prefix):
+    """Delete every object under `prefix`, 1000 keys per DeleteObjects request"""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+def route_sources(route):
+    """Extraction pipelines a route runs"""
+    return [source for source in SOURCES if route in (source, "both")]
+
+def delete_chunk_items(table_name, item_id, prefix):
+    """Delete the chunk items of partition `item_id` under `prefix`, releasing their near duplicate references"""
+    table = dynamodb.Table(table_name)
+    query = {
+        'KeyConditionExpression': Key('id').eq(item_id) & Key('filename').begins_with(prefix),
+        'ProjectionExpression': 'id, filename, canonical_id, canonical_filename, ref_count'
+    }
+    while True:
+        response = table.query(**query)
+        items = response['Items']
+        if NEAR_DUP_TABLE:
+            release_chunks(dynamodb, table_name, [item for item in items if 'canonical_id' in item or item.get('ref_count')],
+                           deleted=lambda key, item_id=item_id, prefix=prefix: key['id'] == item_id and key['filename'].startswith(prefix),
+                           signature_table=NEAR_DUP_TABLE)
+        with table.batch_writer() as batch:
+            for item in items:
+                batch.delete_item(Key={'id': item['id'], 'filename': item['filename']})
+        if 'LastEvaluatedKey' not in response:
+            return
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def remove_pipeline_output(bucket, group, _uuid, original_filename, source):
+    """
+    Objects and chunk items one extraction pipeline wrote for the document:
+    textract: raw_json/..._textract.jsonl(.gz), raw_text/..._raw.txt, rag/..._raw/
+    llm: raw_text/..._raw_llm.txt, rag/..._raw_llm/ (its pages are removed on every revision)
+    """
+    raw_name = f"{_uuid}_{original_filename}_raw" + ("_llm" if source == "llm" else "")
+    if source == "textract":
+        delete_prefix(bucket, f"raw_json/{group}/{_uuid}_{original_filename}_textract.")
+    delete_prefix(bucket, f"raw_text/{group}/{raw_name}.")
+    delete_prefix(bucket, f"rag/{group}/{raw_name}/")
+    for profile in profiles_for_source(source):
+        table_name = os.environ.get(profile.table)
+        if table_name:
+            delete_chunk_items(table_name, f"{group}-{_uuid}", f"{raw_name}/")
+
+def remove_previous_revision(bucket, group, _uuid, original_filename, route):
+    """
+    Pages of the previous revision would be picked up again by the page listing of the LLM flow,
+    and the output of a pipeline the new route no longer runs would never be replaced
+    """
+    for folder in ('pages', 'pages_processed'):
+        delete_prefix(bucket, f"{folder}/{group}/{_uuid}_")
+    for source in SOURCES:
+        if source not in route_sources(route):
+            remove_pipeline_output(bucket, group, _uuid, original_filename, source)
 
 def split_pdf(pdf_path: str, output_dir: str = "split_pages") -> list[str]:
     """
@@ -152,13 +390,153 @@ def split_pdf(pdf_path: str, output_dir: str = "split_pages") -> list[str]:
     except Exception as e:
         raise RuntimeError(f"Failed to split PDF: {str(e)}") from e
 
+def open_pdf_source(bucket, key):
+    """Seekable source of the PDF: one GET into memory, or ranged GETs for large objects"""
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if size > RANGE_READ_THRESHOLD:
+        return S3RangeReader(s3, bucket, key, size=size)
+    return io.BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+def page_object_name(first, last):
+    return f"page_{first}.pdf" if first == last else f"page_{first}-{last}.pdf"
+
+def page_runs(page_numbers, pages_per_object):
+    """Group 0 based page numbers into runs of consecutive pages of at most `pages_per_object`"""
+    run = []
+    for page_num in page_numbers:
+        if run and (page_num != run[-1] + 1 or len(run) == pages_per_object):
+            yield run
+            run = []
+        run.append(page_num)
+    if run:
+        yield run
+
+def iter_page_objects(pdf_reader, pages_per_object, page_numbers=None):
+    """
+    Yield (first page, last page, PDF bytes) for every group of `pages_per_object` consecutive
+    pages, 1 based. `page_numbers` (0 based) restricts the split to some pages, all by default.
+    """
+    if page_numbers is None:
+        page_numbers = range(len(pdf_reader.pages))
+    for run in page_runs(page_numbers, pages_per_object):
+        pdf_writer = pypdf.PdfWriter()
+        for page_num in run:
+            pdf_writer.add_page(pdf_reader.pages[page_num])
+        buffer = io.BytesIO()
+        pdf_writer.write(buffer)
+        yield run[0] + 1, run[-1] + 1, buffer.getvalue()
+
+def split_pdf_to_s3(bucket, key, key_filename_prefix, pdf_reader=None, page_numbers=None):
+    """
+    Split the PDF into page objects without touching the disk. Pages are serialized in this
+    thread (pypdf readers are not thread safe) while a bounded pool uploads them.
+    `page_numbers` (0 based) restricts the split to some pages, all by default.
+
+    Returns:
+        list[str]: keys of the page objects
+    """
+    if pdf_reader is None:
+        pdf_reader = pypdf.PdfReader(open_pdf_source(bucket, key))
+    keys = []
+    pending = set()
+    with ThreadPoolExecutor(max_workers=SPLIT_WORKERS) as executor:
+        for first, last, body in iter_page_objects(pdf_reader, PAGES_PER_OBJECT, page_numbers):
+            page_key = f"{key_filename_prefix}_{page_object_name(first, last)}"
+            pending.add(executor.submit(s3.put_object, Bucket=bucket, Key=page_key, Body=body,
+                                        ContentType='application/pdf'))
+            keys.append(page_key)
+            # at most two uploads queued per worker, bounds the page buffers held in memory
+            if len(pending) >= SPLIT_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        for future in pending:
+            future.result()
+    return keys
+
+def split_pdf_on_disk(bucket, key, key_filename_prefix):
+    """Original split through /tmp, the files are removed afterwards so warm invocations do not fill it"""
+    local_file_name = f"/tmp/{key.split('/')[-1]}"
+    output_dir = "/tmp/split_pages"
+    s3.download_file(bucket, key, local_file_name)
+    keys = []
+    try:
+        for file in split_pdf(local_file_name, output_dir):
+            key_filename = f"{key_filename_prefix}_{file.split('/')[-1]}"
+            s3.upload_file(file, bucket, key_filename)
+            keys.append(key_filename)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if os.path.exists(local_file_name):
+            os.remove(local_file_name)
+    return keys
+
+def write_text_pages(bucket, key_filename_prefix, pages):
+    """
+    Write the text layer of digital pages next to the LLM output, {prefix}_page_{n}.txt, so the
+    consolidation joins them with the extracted scanned pages.
+
+    Args:
+        pages (list): (1 based page number, text) tuples
+
+    Returns:
+        int: number of pages written
+    """
+    with ThreadPoolExecutor(max_workers=SPLIT_WORKERS) as executor:
+        futures = [executor.submit(put_artifact, s3, bucket, f"{key_filename_prefix}_page_{page}.txt", text,
+                                   content_type='text/plain', Metadata={'extraction': 'text-layer'})
+                   for page, text in pages]
+        for future in futures:
+            future.result()
+    return len(futures)
+
+def write_text_layer_json(bucket, json_key, texts):
+    """
+    Write the text layer of the pages as Textract shaped JSON Lines (one line per page, one LINE
+    block per text line), the input store_raw_docs expects from the Textract job.
+    """
+    with S3ArtifactWriter(s3, bucket, json_key, content_type='application/x-ndjson',
+                          compress=json_key.endswith('.gz')) as writer:
+        for page, text in enumerate(texts, start=1):
+            blocks = [{'BlockType': 'LINE', 'Text': line.strip(), 'Page': page}
+                      for line in text.splitlines() if line.strip()]
+            writer.write(json.dumps({'Blocks': blocks}, separators=(',', ':')).encode('utf-8') + b'\n')
+
+def start_text_layer_pipeline(bucket, json_key):
+    """Start the Textract state machine on the text layer, as the SNS function does when a job ends"""
+    sfn.start_execution(
+        stateMachineArn=textract_state_machine,
+        input=json.dumps({
+            "Payload": {
+                "Output": f"s3://{bucket}/{json_key}",
+                "statusCode": 200
+            }
+        })
+    )
+
+def start_textract(bucket, key, _uuid, revision):
+    """Start the asynchronous text detection, its completion is notified to the SNS topic"""
+    response = textract.start_document_text_detection(
+        DocumentLocation={
+            'S3Object': {
+                'Bucket': bucket,
+                'Name': key
+            }
+        },
+        NotificationChannel={
+            'SNSTopicArn': sns_topic,
+            'RoleArn': sns_role
+        },
+        # a revision of the same document is a new job, not a retry of the previous one
+        ClientRequestToken=f"{_uuid}-{revision}"
+    )
+    return response['JobId']
+
 def handler(event, context):
     # print("Event",event)
     # Get bucket and object information from the event
     bucket = event['detail']['bucket']['name']
     key = event['detail']['object']['key']
-    # get cognito group from the key of the bucket
-    _uuid = create_document_dynamodb(key, bucket)
     #review file extension
     file_extension = key.split('.')[-1].lower()
     key_name_with_extension = key.split('/')[-1]
@@ -166,42 +544,92 @@ def handler(event, context):
     #if file extension is .txt just copy_to_s3 and return success
     # TODO test this properly
     if file_extension == 'txt':
+        create_document_dynamodb(key, bucket, "textract")
         key_txt = f"raw_json/{key_name_with_extension}"
         print(key_txt)
         copy_to_s3(bucket, bucket, key, key_txt)
         return { 'statusCode': 200,
             'JobID': 'txt, no textract job needed',
+            'route': 'textract',
+            'run_llm': False,
             'Output': f"s3://{bucket}/{key_txt}"} 
-    response = textract.start_document_text_detection(
-        DocumentLocation={
-            'S3Object': {
-                'Bucket': bucket,
-                'Name': key
-            }
-        },
-        NotificationChannel={
-            'SNSTopicArn': sns_topic,
-            'RoleArn': sns_role
-        },
-        ClientRequestToken=_uuid
-    )
-    # Split the doc into pages
-    # download the pdf from s3
-    local_file_name = key.split('/')[-1]
-    # download has to be in the tmp dir
-    local_file_name = f"/tmp/{local_file_name}"
-    output_dir = "/tmp/split_pages"
-    s3.download_file(bucket, key, local_file_name)
-    # upload to s3
+
+    # the PDF is only opened here when the route is decided from its content, and reused by the split
+    pdf = {}
+    def open_reader():
+        if 'reader' not in pdf:
+            pdf['reader'] = pypdf.PdfReader(open_pdf_source(bucket, key))
+        return pdf['reader']
+
+    # skip the pipeline when the content of the upload is already ingested in the group
+    content_hash, new_uuid = None, False
+    if DEDUP_UPLOADS:
+        content_hash = content_sha256(bucket, key)
+        current = documents_table().get_item(
+            Key={'group': key.split('/')[-2], 'filename': key_name_with_extension}).get('Item')
+        duplicate = find_duplicate(bucket, key, content_hash, current)
+        if duplicate:
+            if duplicate is not current:
+                link_document(key, bucket, duplicate, content_hash)
+            print(f"{key} has the content of {duplicate['filename']}, ingestion skipped")
+            return {'statusCode': 200,
+                'JobID': 'duplicate, no textract job needed',
+                'route': duplicate.get('extraction', 'both'),
+                'run_llm': False,
+                'duplicate_of': duplicate.get('duplicate_of', duplicate['filename'])}
+        new_uuid = bool(current) and is_shared(current)
+
+    route = resolve_route(key, open_reader)
+    print(f"Extraction route of {key}: {route}")
+
+    # get cognito group from the key of the bucket
+    _uuid, revision = create_document_dynamodb(key, bucket, route, content_hash, new_uuid)
     original_filename = key.split('/')[-1].split('.')[0]
     group = key.split('/')[-2]
+    if INGESTION_MODE == "incremental" and revision > 1:
+        remove_previous_revision(bucket, group, _uuid, original_filename, route)
+    output = {
+        'statusCode': 200,
+        'JobID': None,
+        'revision': revision,
+        'route': route,
+        'run_llm': route in ("llm", "both")
+    }
+
+    # classify the pages from their text layer, digital pages are not OCR'd
+    pages = None
+    if TEXT_LAYER_FAST_PATH and (route in ("textract", "both") or SPLIT_MODE == "memory"):
+        pages = classify_pages(open_reader())
+        output['text_layer_pages'] = sum(1 for kind, _ in pages if kind == DIGITAL)
+        print(f"{output['text_layer_pages']}/{len(pages)} pages of {key} have a usable text layer")
+
+    if route in ("textract", "both"):
+        if pages and output['text_layer_pages'] == len(pages):
+            suffix = '.jsonl.gz' if TEXTRACT_OUTPUT_COMPRESS else '.jsonl'
+            json_key = f"raw_json/{group}/{_uuid}_{original_filename}_textract{suffix}"
+            write_text_layer_json(bucket, json_key, [text for _, text in pages])
+            start_text_layer_pipeline(bucket, json_key)
+            output['JobID'] = 'text layer, no textract job needed'
+            output['Output'] = f"s3://{bucket}/{json_key}"
+        else:
+            output['JobID'] = start_textract(bucket, key, _uuid, revision)
+    if not output['run_llm']:
+        return output
+
+    # Split the doc into pages and upload them to s3
     key_filename_prefix = f"pages/{group}/{_uuid}_{original_filename}"
-    for file in split_pdf(local_file_name, output_dir):
-        key_filename = f"{key_filename_prefix}_{file.split('/')[-1]}"
-        s3.upload_file(file, bucket, key_filename)
+    if SPLIT_MODE == "memory":
+        scanned_pages = None
+        if pages is not None:
+            write_text_pages(bucket, f"pages_processed/{group}/{_uuid}_{original_filename}",
+                             [(page_num + 1, text) for page_num, (kind, text) in enumerate(pages) if kind == DIGITAL])
+            scanned_pages = [page_num for page_num, (kind, _) in enumerate(pages) if kind != DIGITAL]
+        page_keys = split_pdf_to_s3(bucket, key, key_filename_prefix, pdf.get('reader'), scanned_pages)
+    else:
+        page_keys = split_pdf_on_disk(bucket, key, key_filename_prefix)
+    print(f"{len(page_keys)} page objects written to {key_filename_prefix}_")
     # return the job id and the path of the key_filename_prefix
-    return {
-        'statusCode': 200,
-        'JobID': response['JobId'],
-        'pages_prefix': f"{key_filename_prefix}"
-    }
\ No newline at end of file
+    output['pages_prefix'] = f"{key_filename_prefix}"
+    # no page object left when every page was extracted from its text layer
+    output['page_objects'] = len(page_keys)
+    return output
@@ -4,6 +4,14 @@ This function is responsible for reading the textract originated JSON
 It parses the file and builds a raw text file from the text contents of the JSON
 It then writes the output to the raw_text folder in the upload bucket
 
+The conversion streams: the JSON is parsed incrementally (ijson) while the LINE blocks are
+written to a multipart upload (common/s3_io.py), so memory stays bounded for documents of
+hundreds of pages. Two input forms are accepted:
+- the combined document {"JobId", "Status", "Pages": [GetDocumentTextDetection responses]}
+- JSON Lines (.jsonl), one GetDocumentTextDetection response per line
+Both can be gzip compressed (.gz), the input is decompressed while it streams. The raw text is
+written gzip compressed unless ARTIFACT_COMPRESSION=none (see common/s3_io.py).
+
 Input:
 {
     'statusCode': 200,
@@ -44,14 +52,48 @@ S3: GET, PUT, LISTBUCKET permission, in the upload_bucket
 """
 
 import boto3
-import json
+import ijson
+from s3_io import S3ArtifactWriter, open_artifact, put_artifact
 
 # Initialize S3 client
 s3 = boto3.client('s3')
 #upload the same file to bucket in folder raw_json
 def upload_to_s3(bucket, key, content):
-    s3.put_object(Bucket=bucket, Key=key, Body=content)
+    put_artifact(s3, bucket, key, content, content_type='text/plain; charset=utf-8')
+
+
+def iter_line_blocks(stream, block_prefix, multiple_values=False):
+    """
+    Yield the text of the LINE blocks found at `block_prefix`, parsing the stream incrementally.
+    Only BlockType and Text are kept, the geometry is never materialized.
+    """
+    block_type = text = None
+    for prefix, event, value in ijson.parse(stream, multiple_values=multiple_values):
+        if prefix == block_prefix:
+            if event == 'start_map':
+                block_type = text = None
+            elif event == 'end_map' and block_type == 'LINE' and text is not None:
+                yield text
+        elif prefix == f'{block_prefix}.BlockType':
+            block_type = value
+        elif prefix == f'{block_prefix}.Text':
+            text = value
 
+def iter_lines(bucket, key):
+    """Text of the LINE blocks of a Textract output object, in document order"""
+    with open_artifact(s3, bucket, key) as stream:
+        if key.removesuffix('.gz').endswith('.jsonl'):
+            # one GetDocumentTextDetection response per line
+            yield from iter_line_blocks(stream, 'Blocks.item', multiple_values=True)
+        else:
+            yield from iter_line_blocks(stream, 'Pages.item.Blocks.item')
+
+def write_raw_text(bucket, key, lines):
+    """Stream lines to the raw text object, returns the size in bytes before compression"""
+    with S3ArtifactWriter(s3, bucket, key, content_type='text/plain; charset=utf-8') as writer:
+        for line in lines:
+            writer.write(line.encode('utf-8') + b'\n')
+    return writer.bytes_written
 
 def handler(event, context):
 
@@ -80,17 +122,6 @@ def handler(event, context):
         return { 'statusCode': 200,
             'Output': f"s3://{bucket}/{key_txt}"} 
 
-    # Read the JSON file from S3
-    response = s3.get_object(Bucket=bucket, Key=key)
-    json_content = json.loads(response['Body'].read().decode('utf-8'))
-    
-    # Extract raw text from the JSON
-    raw_text = ""
-    for page in json_content['Pages']:
-        for block in page['Blocks']:
-            if block['BlockType'] == 'LINE':
-                raw_text += block['Text'] + "\n"
-    
     # Create a filename for the text output
     # Remove the existing aws_request_id and add the new one
     filename_parts = key.split('/')[-1].split('_')
@@ -102,12 +133,8 @@ def handler(event, context):
     group = key.split('/')[-2]
     txt_filename = f"raw_text/{group}/{original_filename}_raw.txt"
     
-    # Upload the text file to S3
-    s3.put_object(
-        Bucket=bucket,
-        Key=txt_filename,
-        Body=raw_text.encode('utf-8')
-    )
+    # Extract raw text from the JSON while it is uploaded to S3
+    write_raw_text(bucket, txt_filename, iter_lines(bucket, key))
     
     # print(f"Raw text extracted and saved to {txt_filename}")
     
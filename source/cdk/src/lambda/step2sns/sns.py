@@ -1,12 +1,30 @@
+"""
+SNS_PROCESS function:
+Triggered by the Textract completion notification (SNS). For every record of the batch it
+collects the paginated GetDocumentTextDetection results of the job, writes them to
+raw_json/{group}/{uuid}_{file}_textract.jsonl[.gz] and starts the processing state machine.
+
+Each page of results is written as one JSON line as soon as it arrives, through a multipart
+upload (common/s3_io.py), so memory is bounded by one page of results whatever the job size.
+
+Configuration (environment variables):
+TEXTRACT_OUTPUT_COMPRESS: gzip the JSON Lines output (default true)
+TEXTRACT_KEEP_GEOMETRY: keep the Geometry of the blocks (default false), the raw text
+    step only reads BlockType and Text
+"""
+
 import boto3
 import json
 import os
+from s3_io import S3ArtifactWriter
 textract = boto3.client('textract')
 dynamodb = boto3.resource('dynamodb')
 sfn = boto3.client('stepfunctions')
 table_name = os.environ.get('DOCUMENTS_TABLE_NAME', None)
 bucket_name = os.environ.get('DOCUMENTS_BUCKET_NAME', None)
 state_machine = os.environ.get('SATE_MACHINE', None)
+TEXTRACT_OUTPUT_COMPRESS = os.environ.get('TEXTRACT_OUTPUT_COMPRESS', 'true').lower() == 'true'
+TEXTRACT_KEEP_GEOMETRY = os.environ.get('TEXTRACT_KEEP_GEOMETRY', 'false').lower() == 'true'
 s3 = boto3.client('s3')
 def get_uuid_dynamo(key):
     # key : "raw_docs/group1/test.pdf"
@@ -22,75 +40,89 @@ def get_uuid_dynamo(key):
     return response['Item']['uuid']
 
 
-def handler(event, context):
-    print("Event:", event)
-    job_id = None
-    status = None
-    bucket = None
-    key = None
-    for record in event['Records']:
-        message = json.loads(record['Sns']['Message'])
-        print("Message:", message)
-        job_id = message['JobId']
-        status = message['Status']
-        bucket = message['DocumentLocation']['S3Bucket']
-        key = message['DocumentLocation']['S3ObjectName']
-        _uuid = get_uuid_dynamo(key)
-        print(f"Textract job {job_id} completed with status {status} UUID:{_uuid}")
-
-    response = textract.get_document_text_detection(JobId=job_id)
-    
-    if status == 'SUCCEEDED':
-        # Collect all pages
-        pages = []
-        pages.append(response)
-        response = textract.get_document_text_detection(JobId=job_id)
+def iter_result_pages(job_id):
+    """Yield the GetDocumentTextDetection responses of a job, one per result page"""
+    request = {'JobId': job_id, 'MaxResults': 1000}
+    while True:
+        response = textract.get_document_text_detection(**request)
+        response.pop('ResponseMetadata', None)
+        if not TEXTRACT_KEEP_GEOMETRY:
+            for block in response.get('Blocks', []):
+                block.pop('Geometry', None)
+        yield response
         next_token = response.get('NextToken')
-        
-        while next_token:
-            response = textract.get_document_text_detection(JobId=job_id, NextToken=next_token)
-            pages.append(response)
-            next_token = response.get('NextToken')
-        
-        # Combine all pages into a single JSON
-        full_response = {
-            'JobId': job_id,
-            'Status': status,
-            'Pages': pages
-        }
-        
-        # Create a filename for the JSON output, including the aws_request_id
-        original_filename = key.split('/')[-1].split('.')[0]
-        group = key.split('/')[-2]
-        json_filename = f"raw_json/{group}/{_uuid}_{original_filename}_textract.json"
-        
-        # Upload the JSON to S3
-        s3.put_object(
-            Bucket=bucket,
-            Key=json_filename,
-            Body=json.dumps(full_response)
-        )
-        
-        # print(f"Textract job completed. Output saved to {json_filename}")
-        # Trigger state Machine
-        sfn.start_execution(
-            stateMachineArn=state_machine,
-            input=json.dumps({
-                "Payload": {
-                    "Output": f"s3://{bucket}/{json_filename}",
-                    "statusCode": 200
-                }
-            })
-        )
-        return {
-            'statusCode': 200,
-            'JobID': job_id,
-            'Output': f"s3://{bucket}/{json_filename}"
-        }
-    else:
+        if not next_token:
+            return
+        request['NextToken'] = next_token
+
+
+def collect_results(job_id, bucket, json_filename):
+    """
+    Stream the results of a job to `json_filename`, one JSON line per result page.
+
+    Returns:
+        int: number of result pages written
+    """
+    count = 0
+    with S3ArtifactWriter(s3, bucket, json_filename, content_type='application/x-ndjson',
+                          compress=json_filename.endswith('.gz')) as writer:
+        for response in iter_result_pages(job_id):
+            writer.write(json.dumps(response, separators=(',', ':')).encode('utf-8') + b'\n')
+            count += 1
+    return count
+
+
+def process_record(record):
+    message = json.loads(record['Sns']['Message'])
+    print("Message:", message)
+    job_id = message['JobId']
+    status = message['Status']
+    bucket = message['DocumentLocation']['S3Bucket']
+    key = message['DocumentLocation']['S3ObjectName']
+    _uuid = get_uuid_dynamo(key)
+    print(f"Textract job {job_id} completed with status {status} UUID:{_uuid}")
+
+    if status != 'SUCCEEDED':
         # print(f"Textract job failed for {key}")
         return {
             'statusCode': 500,
             'JobID': job_id,
             'Output': None
-        }
\ No newline at end of file
+        }
+
+    # Create a filename for the JSON Lines output
+    original_filename = key.split('/')[-1].split('.')[0]
+    group = key.split('/')[-2]
+    suffix = '.jsonl.gz' if TEXTRACT_OUTPUT_COMPRESS else '.jsonl'
+    json_filename = f"raw_json/{group}/{_uuid}_{original_filename}_textract{suffix}"
+
+    # Upload the results while they are paginated
+    result_pages = collect_results(job_id, bucket, json_filename)
+    print(f"Textract job {job_id}: {result_pages} result pages saved to {json_filename}")
+
+    # Trigger state Machine
+    sfn.start_execution(
+        stateMachineArn=state_machine,
+        input=json.dumps({
+            "Payload": {
+                "Output": f"s3://{bucket}/{json_filename}",
+                "statusCode": 200
+            }
+        })
+    )
+    return {
+        'statusCode': 200,
+        'JobID': job_id,
+        'Output': f"s3://{bucket}/{json_filename}"
+    }
+
+
+def handler(event, context):
+    print("Event:", event)
+    results = [process_record(record) for record in event['Records']]
+    if len(results) == 1:
+        return results[0]
+    return {
+        'statusCode': 200 if all(result['statusCode'] == 200 for result in results) else 500,
+        'Jobs': results
+    }
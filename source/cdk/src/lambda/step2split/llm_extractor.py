@@ -1,20 +1,118 @@
+"""
+LLM_EXTRACTOR function:
+Extracts the text of the page objects written by ReadDocs (pages/{group}/{uuid}_{file}_page_{n}.pdf
+or ..._page_{first}-{last}.pdf) with Claude through the Bedrock converse API, and writes one
+text object per page to pages_processed/, ..._page_{n}.txt.
+
+Adaptive batching: the pages of the input objects are packed into one request while the
+estimated output stays under LLM_BATCH_OUTPUT_TOKENS and the batch under LLM_MAX_PAGES_PER_BATCH
+pages. The estimate comes from the text layer of the page, pages without one count as
+LLM_SCANNED_PAGE_TOKENS. Batched pages are returned between <page number="k"> markers and split
+back per page; pages the model left out are extracted again on their own.
+
+Continuation: a response that stops on max_tokens is continued with the partial output as the
+assistant prefill, up to LLM_MAX_CONTINUATIONS times, so dense pages are not truncated.
+
+Page cache: every page is rendered as a single page PDF, which pypdf serializes identically
+whatever document the page comes from, and its sha256 addresses the extracted text in
+{EXTRACTION_CACHE_PREFIX}/{group}/{version}/{sha256}.txt, the version being a hash of the model
+and the prompt. Cached pages are not sent to Bedrock, extracted pages are added to the cache.
+The pages_processed objects carry the source of their text in the "extraction" metadata (cache
+or llm), the joiner adds them up per document. Page texts and cache entries are written gzip
+compressed (common/s3_io.py), uncompressed cache entries are still read.
+
+Configuration (environment variables):
+LLM_MODEL_ID: model used for the extraction (default Claude 3 Haiku)
+LLM_MAX_TOKENS: maxTokens of each request (default 4096)
+LLM_BATCH_OUTPUT_TOKENS: estimated output tokens packed in one request (default 2500)
+LLM_MAX_PAGES_PER_BATCH: pages packed in one request (default 8)
+LLM_SCANNED_PAGE_TOKENS: output estimate of a page without text layer (default 1200)
+LLM_MAX_CONTINUATIONS: continuation requests after max_tokens (default 4)
+EXTRACTION_CACHE: page cache enabled (default true)
+EXTRACTION_CACHE_PREFIX: S3 prefix of the page cache (default cache/pages)
+
+Input:
+{"Bucket": bucket, "Key": page object key}, or {"Bucket": bucket, "Keys": [page object keys]},
+or the batch of the distributed map item batcher:
+{"Items": [{"Key": page object key}, ...], "BatchInput": {"Bucket": bucket}}
+
+Output:
+{
+    'bucket': bucket,
+    'input_keys': [...],
+    'output_keys': [...],
+    'requests': converse calls made,
+    'cache_hits': pages read from the cache,
+    'cache_misses': pages extracted by the model,
+    'status': 'success'
+}
+"""
+
 import boto3
+import hashlib
+import io
 import json
 import logging
 import os
+import re
+import time
+import pypdf
 from botocore.exceptions import ClientError
+from bedrock_client import get_bedrock_client
+from s3_io import put_artifact, read_artifact
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+MODEL_ID = os.environ.get("LLM_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", 4096))
+BATCH_OUTPUT_TOKENS = int(os.environ.get("LLM_BATCH_OUTPUT_TOKENS", 2500))
+MAX_PAGES_PER_BATCH = max(1, int(os.environ.get("LLM_MAX_PAGES_PER_BATCH", 8)))
+SCANNED_PAGE_TOKENS = int(os.environ.get("LLM_SCANNED_PAGE_TOKENS", 1200))
+MAX_CONTINUATIONS = int(os.environ.get("LLM_MAX_CONTINUATIONS", 4))
+EXTRACTION_CACHE = os.environ.get("EXTRACTION_CACHE", "true").lower() == "true"
+EXTRACTION_CACHE_PREFIX = os.environ.get("EXTRACTION_CACHE_PREFIX", "cache/pages").rstrip('/')
+# markdown output of a text layer is roughly 3.5 characters per token, plus the markup
+CHARS_PER_TOKEN = 3.0
+MIN_PAGE_TOKENS = 200
+
+EXTRACTION_PROMPT = "You are a document text extractor. Your task is to extract text from this PDF maintaining the original format as much as possible. Follow these rules:\n\n1. Extract ALL text from the PDF\n2. Preserve the original layout, including tables and bullet points\n3. Include ALL numbers, dates, and special characters\n4. Maintain text alignment (left, right, center) when evident\n5. Preserve paragraph breaks and spacing\n6. For tables: maintain column alignment and use proper spacing\n7. Include headers, footers, and page numbers if present\n8. Keep any formatting like bullet points or numbered lists\n9. Do not add any explanations or comments\n10. Do not describe the PDF or its contents\n11. Output ONLY the extracted text\n\nExtract the content from an image page and output in Markdown syntax. Enclose the content in the <markdown></markdown> tag and do not use code blocks. If the image is empty then output a <markdown></markdown> without anything in it.\nFollow these steps:\nExamine the provided page carefully.\nIdentify all elements present in the page, including headers, body text, footnotes, tables, images, captions, and page numbers, etc.\nUse markdown syntax to format your output:\nHeadings: # for main, ## for sections, ### for subsections, etc.\nLists: * or - for bulleted, 1. 2. 3. for numbered\nDo not repeat yourself\nIf the element is an image (not table)\nIf the information in the image can be represented by a table, generate the table containing the information of the image\nOtherwise provide a detailed description about the information in image\nClassify the element as one of: Chart, Diagram, Logo, Icon, Natural Image, Screenshot, Other. Enclose the class in <figure_type></figure_type>\nEnclose <figure_type></figure_type>, the table or description, and the figure title or caption (if available), in <figure></figure> tags\nDo not transcribe text in the image after providing the table or description\nIf the element is a table\nCreate a markdown table, ensuring every row has the same number of columns\nMaintain cell alignment as closely as possible\nDo not split a table into multiple tables\nIf a merged cell spans multiple rows or columns, place the text in the top-left cell and output ' ' for other\nUse | for column separators, |-|-| for header row separators\nIf a cell has multiple items, list them in separate rows\nIf the table contains sub-headers, separate the sub-headers from the headers in another row\nIf the element is a paragraph\nTranscribe each text element precisely as it appears\nIf the element is a header, footer, footnote, page number\nTranscribe each text element precisely as it appears"
+BATCH_PROMPT = ("\n\nThe document has {pages} pages. Extract every page in order and enclose the content of "
+                "each page in <page number=\"N\"></page> tags, N being the page number in this document, "
+                "starting at 1. Output all {pages} pages.")
+PAGE_PATTERN = re.compile(r'<page number="(\d+)">(.*?)(?:</page>|(?=<page number="\d+">)|\Z)', re.DOTALL)
+PAGE_OBJECT_PATTERN = re.compile(r'^(?P<base>.*_page)_(?P<first>\d+)(?:-(?P<last>\d+))?\.pdf$')
+# cached texts are only valid for the model and the prompt that produced them
+CACHE_VERSION = hashlib.sha256(f"{MODEL_ID}\n{EXTRACTION_PROMPT}\n{BATCH_PROMPT}".encode()).hexdigest()[:16]
+
+
+def render_page(page):
+    """The page as a single page PDF"""
+    pdf_writer = pypdf.PdfWriter()
+    pdf_writer.add_page(page)
+    buffer = io.BytesIO()
+    pdf_writer.write(buffer)
+    return buffer.getvalue()
+
+
+def split_page_markers(text, pages):
+    """Text of every marked page of a batched response, {page number (1 based): text}"""
+    extracted = {}
+    for match in PAGE_PATTERN.finditer(text):
+        number = int(match.group(1))
+        if 1 <= number <= pages and number not in extracted:
+            extracted[number] = match.group(2).strip()
+    return extracted
+
+
 class PDFProcessor:
     def __init__(self, region="us-east-1"):
         self.s3_client = boto3.client('s3')
-        self.bedrock_runtime = boto3.client(
-            service_name='bedrock-runtime',
-            region_name=region
-        )
-        self.MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+        self.bedrock_runtime = get_bedrock_client()
+        self.MODEL_ID = MODEL_ID
+        self.requests = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def get_processed_key(self, original_key):
         """Convert the original key to the processed key path"""
@@ -25,6 +123,18 @@ class PDFProcessor:
             return new_key
         return original_key
 
+    def get_page_keys(self, original_key, count):
+        """
+        Processed key of every page of a page object, ..._page_{first}-{last}.pdf gives
+        ..._page_{first}.txt to ..._page_{last}.txt. Objects named otherwise keep one output.
+        """
+        match = PAGE_OBJECT_PATTERN.match(original_key)
+        if not match or count == 1:
+            return [self.get_processed_key(original_key)] * count
+        first = int(match.group('first'))
+        base = self.get_processed_key(match.group('base') + '.pdf')[:-len('.txt')]
+        return [f"{base}_{first + index}.txt" for index in range(count)]
+
     def get_pdf_from_s3(self, bucket, key):
         """Download PDF from S3"""
         try:
@@ -36,13 +146,85 @@ class PDFProcessor:
             logger.error(f"Error downloading PDF: {str(e)}")
             raise
 
-    def process_pdf_with_claude(self, bucket, key):
-        """Process PDF directly with Claude 3 using converse API"""
+    def estimate_output_tokens(self, page):
+        """Output tokens expected for a page, from its text layer"""
         try:
-            # Need to download the PDF as bytes since 'uri' is not supported
-            logger.info(f"Downloading PDF from S3: {bucket}/{key}")
-            pdf_bytes = self.get_pdf_from_s3(bucket, key)
-            
+            characters = len((page.extract_text() or '').strip())
+        except Exception:
+            characters = 0
+        if characters == 0:
+            return SCANNED_PAGE_TOKENS
+        return max(MIN_PAGE_TOKENS, int(characters / CHARS_PER_TOKEN))
+
+    def load_pages(self, bucket, keys):
+        """Pages of the input objects in order, each with its output key and output estimate"""
+        pages = []
+        for key in keys:
+            reader = pypdf.PdfReader(io.BytesIO(self.get_pdf_from_s3(bucket, key)))
+            output_keys = self.get_page_keys(key, len(reader.pages))
+            for page, output_key in zip(reader.pages, output_keys):
+                pages.append({
+                    'key': key,
+                    'output_key': output_key,
+                    'page': page,
+                    'tokens': self.estimate_output_tokens(page),
+                    'sha256': hashlib.sha256(render_page(page)).hexdigest() if EXTRACTION_CACHE else None
+                })
+        return pages
+
+    def get_cache_key(self, page):
+        group = page['key'].split('/')[-2]
+        return f"{EXTRACTION_CACHE_PREFIX}/{group}/{CACHE_VERSION}/{page['sha256']}.txt"
+
+    def get_cached_text(self, bucket, page):
+        """Cached text of the page, None on a miss"""
+        try:
+            return read_artifact(self.s3_client, bucket, self.get_cache_key(page)).decode('utf-8')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def put_cached_text(self, bucket, page, text):
+        put_artifact(self.s3_client, bucket, self.get_cache_key(page), text, content_type='text/plain')
+
+    def plan_batches(self, pages):
+        """Pack consecutive pages while the estimated output fits one request"""
+        batches = []
+        batch, tokens = [], 0
+        for page in pages:
+            if batch and (len(batch) >= MAX_PAGES_PER_BATCH or tokens + page['tokens'] > BATCH_OUTPUT_TOKENS):
+                batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(page)
+            tokens += page['tokens']
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def converse(self, messages):
+        """One converse call, returns (text, stop reason)"""
+        response = self.bedrock_runtime.converse(
+            modelId=self.MODEL_ID,
+            messages=messages,
+            inferenceConfig={
+                "maxTokens": MAX_TOKENS,
+                "temperature": 0
+            }
+        )
+        self.requests += 1
+        token_usage = response['usage']
+        logger.info(f"Input tokens: {token_usage['inputTokens']} Output tokens: {token_usage['outputTokens']} "
+                    f"Stop reason: {response['stopReason']}")
+        return response['output']['message']['content'][0]['text'], response['stopReason']
+
+    def process_pdf_with_claude(self, pdf_bytes, pages=1):
+        """
+        Process the PDF directly with Claude using the converse API, the output is continued
+        while the model stops on max_tokens
+        """
+        try:
+            prompt = EXTRACTION_PROMPT + (BATCH_PROMPT.format(pages=pages) if pages > 1 else '')
             doc_message = {
                 "role": "user",
                 "content": [
@@ -56,39 +238,25 @@ class PDFProcessor:
                         }
                     },
                     {
-                        "text": "You are a document text extractor. Your task is to extract text from this PDF maintaining the original format as much as possible. Follow these rules:\n\n1. Extract ALL text from the PDF\n2. Preserve the original layout, including tables and bullet points\n3. Include ALL numbers, dates, and special characters\n4. Maintain text alignment (left, right, center) when evident\n5. Preserve paragraph breaks and spacing\n6. For tables: maintain column alignment and use proper spacing\n7. Include headers, footers, and page numbers if present\n8. Keep any formatting like bullet points or numbered lists\n9. Do not add any explanations or comments\n10. Do not describe the PDF or its contents\n11. Output ONLY the extracted text\n\nExtract the content from an image page and output in Markdown syntax. Enclose the content in the <markdown></markdown> tag and do not use code blocks. If the image is empty then output a <markdown></markdown> without anything in it.\nFollow these steps:\nExamine the provided page carefully.\nIdentify all elements present in the page, including headers, body text, footnotes, tables, images, captions, and page numbers, etc.\nUse markdown syntax to format your output:\nHeadings: # for main, ## for sections, ### for subsections, etc.\nLists: * or - for bulleted, 1. 2. 3. for numbered\nDo not repeat yourself\nIf the element is an image (not table)\nIf the information in the image can be represented by a table, generate the table containing the information of the image\nOtherwise provide a detailed description about the information in image\nClassify the element as one of: Chart, Diagram, Logo, Icon, Natural Image, Screenshot, Other. Enclose the class in <figure_type></figure_type>\nEnclose <figure_type></figure_type>, the table or description, and the figure title or caption (if available), in <figure></figure> tags\nDo not transcribe text in the image after providing the table or description\nIf the element is a table\nCreate a markdown table, ensuring every row has the same number of columns\nMaintain cell alignment as closely as possible\nDo not split a table into multiple tables\nIf a merged cell spans multiple rows or columns, place the text in the top-left cell and output ' ' for other\nUse | for column separators, |-|-| for header row separators\nIf a cell has multiple items, list them in separate rows\nIf the table contains sub-headers, separate the sub-headers from the headers in another row\nIf the element is a paragraph\nTranscribe each text element precisely as it appears\nIf the element is a header, footer, footnote, page number\nTranscribe each text element precisely as it appears"
+                        "text": prompt
                     }
                 ]
             }
 
-            logger.info("Sending PDF to Claude for processing...")
-            response = self.bedrock_runtime.converse(
-                modelId=self.MODEL_ID,
-                messages=[doc_message],
-                inferenceConfig={
-                    "maxTokens": 4096,
-                    "temperature": 0
-                }
-            )
-
-            extracted_text = response['output']['message']['content'][0]['text']
-
-            # Log token usage
-            token_usage = response['usage']
-            logger.info(f"Input tokens: {token_usage['inputTokens']}")
-            logger.info(f"Output tokens: {token_usage['outputTokens']}")
-            logger.info(f"Total tokens: {token_usage['totalTokens']}")
-            logger.info(f"Stop reason: {response['stopReason']}")
-
-            # Print raw output for debugging
-            logger.info("Raw output from Claude (first 500 chars):")
-            logger.info("-" * 50)
-            logger.info(extracted_text[:500] + "..." if len(extracted_text) > 500 else extracted_text)
-            logger.info("-" * 50)
-
-            # Clean up memory
-            del pdf_bytes
-            
+            logger.info(f"Sending {pages} page(s) to Claude for processing...")
+            extracted_text, stop_reason = self.converse([doc_message])
+            continuations = 0
+            while stop_reason == 'max_tokens' and continuations < MAX_CONTINUATIONS:
+                # the prefill can not end with white space, the continuation starts where it stops
+                extracted_text = extracted_text.rstrip()
+                continuation, stop_reason = self.converse([
+                    doc_message,
+                    {"role": "assistant", "content": [{"text": extracted_text}]}
+                ])
+                extracted_text += continuation
+                continuations += 1
+            if stop_reason == 'max_tokens':
+                logger.warning(f"Output still truncated after {continuations} continuations")
             return extracted_text
 
         except ClientError as e:
@@ -99,35 +267,84 @@ class PDFProcessor:
             logger.error(f"Unexpected error in process_pdf_with_claude: {str(e)}")
             raise
 
+    def extract_batch(self, batch):
+        """Text of every page of the batch, in order"""
+        pdf_writer = pypdf.PdfWriter()
+        for page in batch:
+            pdf_writer.add_page(page['page'])
+        buffer = io.BytesIO()
+        pdf_writer.write(buffer)
+        extracted_text = self.process_pdf_with_claude(buffer.getvalue(), len(batch))
+        if len(batch) == 1:
+            return [extracted_text]
+        extracted = split_page_markers(extracted_text, len(batch))
+        missing = [number for number in range(1, len(batch) + 1) if number not in extracted]
+        if missing:
+            logger.warning(f"Pages {missing} missing from the batched output, extracting them one by one")
+            for number in missing:
+                extracted[number] = self.extract_batch([batch[number - 1]])[0]
+        return [extracted[number] for number in range(1, len(batch) + 1)]
+
     def process_document(self, input_data):
-        """Process PDF document with the new input structure"""
+        """Process the page objects of the input, one output object per page"""
         try:
-            # Extract bucket and key from input
-            bucket = input_data['Bucket']
-            key = input_data['Key']
-            
-            logger.info(f"Processing document from bucket: {bucket}, key: {key}")
-
-            # Process PDF directly from S3
-            extracted_text = self.process_pdf_with_claude(bucket, key)
-
-            # Generate output key
-            output_key = self.get_processed_key(key)
-            
-            # Save processed text to S3
-            self.s3_client.put_object(
-                Bucket=bucket,
-                Key=output_key,
-                Body=extracted_text.encode('utf-8'),
-                ContentType='text/plain'
-            )
-
-            logger.info(f"Successfully processed and saved to: {bucket}/{output_key}")
+            # Extract bucket and keys from input
+            if 'Items' in input_data:
+                bucket = input_data['BatchInput']['Bucket']
+                keys = [item['Key'] for item in input_data['Items']]
+            else:
+                bucket = input_data['Bucket']
+                keys = input_data.get('Keys') or [input_data['Key']]
+
+            logger.info(f"Processing {len(keys)} page objects from bucket: {bucket}")
+            pages = self.load_pages(bucket, keys)
+            texts = {}
+            if EXTRACTION_CACHE:
+                for index, page in enumerate(pages):
+                    cached = self.get_cached_text(bucket, page)
+                    if cached is not None:
+                        texts[index] = cached
+            self.cache_hits = len(texts)
+            misses = [index for index in range(len(pages)) if index not in texts]
+            self.cache_misses = len(misses)
+            batches = self.plan_batches([pages[index] for index in misses])
+            logger.info(f"{len(pages)} pages, {self.cache_hits} from the cache, "
+                        f"{len(misses)} packed in {len(batches)} requests")
+
+            extracted = iter(misses)
+            for batch in batches:
+                for page, text in zip(batch, self.extract_batch(batch)):
+                    texts[next(extracted)] = text
+                    if EXTRACTION_CACHE:
+                        self.put_cached_text(bucket, page, text)
+
+            outputs = {}
+            for index, page in enumerate(pages):
+                # objects that are not named per page keep one output with all their pages
+                output = outputs.setdefault(page['output_key'], {'texts': [], 'source': 'cache'})
+                output['texts'].append(texts[index])
+                if index in misses:
+                    output['source'] = 'llm'
+
+            for output_key, output in outputs.items():
+                # Save processed text to S3
+                put_artifact(
+                    self.s3_client,
+                    bucket,
+                    output_key,
+                    '\n\n'.join(output['texts']),
+                    content_type='text/plain',
+                    Metadata={'extraction': output['source']}
+                )
+            logger.info(f"Successfully processed and saved {len(outputs)} pages to: {bucket}")
 
             return {
                 'bucket': bucket,
-                'input_key': key,
-                'output_key': output_key,
+                'input_keys': keys,
+                'output_keys': list(outputs),
+                'requests': self.requests,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
                 'status': 'success'
             }
 
@@ -135,8 +352,30 @@ class PDFProcessor:
             logger.error(f"Error processing document: {str(e)}")
             raise
 
+    def emit_cache_metrics(self, namespace='AIbot/Extraction'):
+        """Print the page cache counters in CloudWatch embedded metric format"""
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['ModelId']],
+                    'Metrics': [
+                        {'Name': 'PageCacheHits', 'Unit': 'Count'},
+                        {'Name': 'PageCacheMisses', 'Unit': 'Count'},
+                    ]
+                }]
+            },
+            'ModelId': self.MODEL_ID,
+            'PageCacheHits': self.cache_hits,
+            'PageCacheMisses': self.cache_misses,
+        }))
+
 def handler(event, context):
     logger.info("Received event: " + json.dumps(event, indent=2))
     pdf_processor = PDFProcessor()
     result = pdf_processor.process_document(event)
-    return result
\ No newline at end of file
+    pdf_processor.bedrock_runtime.emit_metrics()
+    if EXTRACTION_CACHE:
+        pdf_processor.emit_cache_metrics()
+    return result
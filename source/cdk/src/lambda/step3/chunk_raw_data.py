@@ -1,6 +1,15 @@
 """
 Lambda function that receives a document from an S3 bucket, processes the document,
-creates chunks of the document, and stores each chunk in a different document in the same S3 bucket.
+creates chunks of the document, and stores them in the same S3 bucket.
+
+Only the chunk sizes subscribed by a chunk table (CHUNK_PROFILES, see common/chunk_profiles.py)
+for the pipeline that produced the document (textract or llm) are computed.
+
+With CHUNK_LAYOUT=manifest (default) the chunks of every chunk size are written as a single
+JSON Lines object, rag/{group}/{file}/chunks{size}.jsonl.gz (see common/chunk_manifest.py).
+With CHUNK_LAYOUT=objects every chunk is stored in a different object, rag/{group}/{file}/chunks{size}/chunk{n},
+gzip compressed unless ARTIFACT_COMPRESSION=none (see common/s3_io.py). The raw text input is
+decompressed while it is downloaded, compressed or not.
 
 Execution role permission: The Lambda function needs permission to read and write to the specified S3 bucket.
 
@@ -15,52 +24,87 @@ JSON OUTPUT:
     'statusCode': 200,
     'body': 'Success',
     'Output': "s3://bucket_name/rag/key_input/",
-    'chunk_Size': "[1000, 2000]",
-    'amount_chunks': "[75, 33]"
+    'chunk_Size': "[1000]",
+    'chunk_overlap': "[200]",
+    'chunk_unit': "['chars']",
+    'amount_chunks': "[75]",
+    'layout': "manifest"
 }
 """
 
 import boto3
 import json
 import os
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import shutil
 from urllib.parse import urlparse
+from chunk_manifest import manifest_key, write_manifest
+from chunk_profiles import distinct_splits, document_source, profiles_for_source, split_label
+from s3_io import READ_BUFFER_SIZE, open_artifact, put_artifact
+from text_chunker import iter_chunks
 
 s3 = boto3.client('s3')
 DEFAULT_TMP = os.environ.get('DEFAULT_TMP')
-def get_chunks(document, chunk_size, overlap):
+CHUNK_LAYOUT = os.environ.get('CHUNK_LAYOUT', 'manifest')
+def get_chunks(document, chunk_size, overlap, unit='chars'):
     """
     Function to split the document into chunks based on the provided chunk_size and overlap.
+    The chunks are identical to the ones of LangChain's RecursiveCharacterTextSplitter
+    (see text_chunker.py) but are generated lazily with their offsets.
 
     Args:
         document (str): The input document to be split into chunks.
         chunk_size (int): The maximum size of each chunk.
-        overlap (int): The number of characters to overlap between consecutive chunks.
+        overlap (int): The size to overlap between consecutive chunks.
+        unit (str): Length unit of chunk_size and overlap, "chars" or "tokens".
 
     Returns:
-        tuple: A tuple containing two elements:
-            - A list of `Document` objects representing the chunks.
-            - The number of chunks created.
+        generator: (start, end, text) of every chunk, in document order.
     """
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap, length_function=len)
-    docs = text_splitter.create_documents([document])
-    return docs, len(docs)
+    return iter_chunks(document, chunk_size, overlap, unit)
 
 def save_chunks_in_s3(chunks, bucket, key_prefix, chunk_size, file_name):
     """
     Function to save the document chunks to an S3 bucket.
 
     Args:
-        chunks (list): A list of `Document` objects representing the chunks.
+        chunks (iterable): (start, end, text) of the chunks.
         bucket (str): The name of the S3 bucket.
         key_prefix (str): The prefix for the S3 object keys.
         chunk_size (int): The size of the chunks.
         file_name (str): The name of the input file.
+
+    Returns:
+        int: The number of chunks saved.
     """
-    for i, doc in enumerate(chunks, start=1):
-        key = f'{key_prefix}/chunks{chunk_size}/chunk{i}'
-        # print(f"Saving chunk {i} to {key}")
-        s3.put_object(Body=doc.page_content, Bucket=bucket, Key=key)
+    # chunks of a previous revision of the document beyond the new chunk count are removed
+    paginator = s3.get_paginator('list_objects_v2')
+    previous = {obj['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=f'{key_prefix}/chunks{chunk_size}/')
+                for obj in page.get('Contents', [])}
+    count = 0
+    for count, (_, _, text) in enumerate(chunks, start=1):
+        key = f'{key_prefix}/chunks{chunk_size}/chunk{count}'
+        # print(f"Saving chunk {count} to {key}")
+        put_artifact(s3, bucket, key, text)
+        previous.discard(key)
+    stale = sorted(previous)
+    for i in range(0, len(stale), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in stale[i:i + 1000]], 'Quiet': True})
+    return count
+
+def save_chunks_manifest(chunks, bucket, key_prefix, chunk_size):
+    """
+    Function to save the document chunks as a single JSON Lines manifest.
+
+    Args:
+        chunks (iterable): (start, end, text) of the chunks.
+        bucket (str): The name of the S3 bucket.
+        key_prefix (str): The prefix for the S3 object keys.
+        chunk_size (int): The size of the chunks.
+
+    Returns:
+        int: The number of chunks saved.
+    """
+    return write_manifest(s3, bucket, manifest_key(key_prefix, chunk_size), chunks)
 
 def handler(event, context):
     """
@@ -86,10 +130,10 @@ def handler(event, context):
     key = parsed_url.path.lstrip('/')
     file_name = os.path.splitext(os.path.basename(key))[0]
     try:
-        # Download the input file from S3 to a temporary file
+        # Download the input file from S3 to a temporary file, decompressed
         file_path = f'{DEFAULT_TMP}/{file_name}'
-        with open(file_path, 'wb') as f:
-            s3.download_fileobj(bucket, key, f)
+        with open(file_path, 'wb') as f, open_artifact(s3, bucket, key) as body:
+            shutil.copyfileobj(body, f, READ_BUFFER_SIZE)
 
         # Read the downloaded file content
         with open(file_path, 'r') as f:
@@ -99,26 +143,33 @@ def handler(event, context):
         # Return an error response if an exception occurs during file download or reading
         return {'statusCode': 500, 'body': json.dumps(f'Error: {e}')}
 
-    # Define a list of chunk sizes to be used for splitting the document
-    chunk_sizes = [1000, 2000]
+    # Only the chunk sizes a table consumes for this document source are computed
+    splits = distinct_splits(profiles_for_source(document_source(file_name)))
+    chunk_sizes = [size for size, _, _ in splits]
     amount_chunks = []
-
-    # Iterate over the chunk sizes
-    for chunk_size in chunk_sizes:
-        # Split the document into chunks based on the current chunk size and overlap
-        chunks, num_chunks = get_chunks(document, chunk_size, 200)
+    group = key.split('/')[-2]
+    key_prefix = f'rag/{group}/{file_name}'
+
+    # Iterate over the subscribed chunk sizes
+    for chunk_size, overlap, unit in splits:
+        # Split the document into chunks based on the current chunk size and overlap,
+        # the chunks are streamed to S3 as they are produced
+        chunks = get_chunks(document, chunk_size, overlap, unit)
+        label = split_label(chunk_size, overlap, unit)
+        if CHUNK_LAYOUT == 'manifest':
+            num_chunks = save_chunks_manifest(chunks, bucket, key_prefix, label)
+        else:
+            num_chunks = save_chunks_in_s3(chunks, bucket, key_prefix, label, file_name)
         amount_chunks.append(num_chunks)
 
-        # Save the chunks to the S3 bucket
-        group = key.split('/')[-2]
-        key_prefix = f'rag/{group}/{file_name}'
-        save_chunks_in_s3(chunks, bucket, key_prefix, chunk_size, file_name)
-
     # Return a success response with the chunk sizes, number of chunks, and output S3 prefix
     return {
         'statusCode': str(200),
         'body': "Success",
         'chunk_Size': str(chunk_sizes),
+        'chunk_overlap': str([overlap for _, overlap, _ in splits]),
+        'chunk_unit': str([unit for _, _, unit in splits]),
         'amount_chunks': str(amount_chunks),
+        'layout': CHUNK_LAYOUT,
         'Output': f's3://{bucket}/{key_prefix}/',
     }
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""
+TEXT_CHUNKER module:
+Streaming replacement of LangChain's RecursiveCharacterTextSplitter (default separators,
+keep_separator=True, strip_whitespace=True).
+
+The splitter works on (start, end) offsets into the source text instead of copies of it:
+- Separators are located with str.find, pieces are never materialized until a chunk is emitted
+- Runs without any separator are cut in closed form instead of character by character
+- The merge window is a deque with a running length, so dropping the overlap is O(1) per piece
+- Chunks are yielded as (start, end, text) as soon as they are complete, start/end are the
+  exact offsets of the (stripped) chunk in the source text
+
+For the same chunk_size, chunk_overlap and length unit the chunk texts are identical to
+    RecursiveCharacterTextSplitter(chunk_size, chunk_overlap).split_text(text)            unit="chars"
+    RecursiveCharacterTextSplitter.from_tiktoken_encoder(encoding_name, chunk_size,
+                                                         chunk_overlap).split_text(text)  unit="tokens"
+which keeps already stored chunks and embeddings valid.
+
+Length units:
+chars: len() of the piece (default)
+tokens: number of tiktoken tokens of the piece (TIKTOKEN_ENCODING, cl100k_base by default), so
+    chunk sizes can be declared against the token limit of the embedding model. tiktoken is only
+    imported when it is used.
+"""
+
+import os
+from collections import deque
+
+DEFAULT_SEPARATORS = ("\n\n", "\n", " ", "")
+UNITS = ('chars', 'tokens')
+TIKTOKEN_ENCODING = os.environ.get('TIKTOKEN_ENCODING', 'cl100k_base')
+
+_encodings = {}
+
+
+def token_counter(encoding_name=TIKTOKEN_ENCODING):
+    """Length function counting the tiktoken tokens of a string"""
+    if encoding_name not in _encodings:
+        try:
+            import tiktoken
+        except ImportError as e:
+            raise ImportError("Token based chunking requires the tiktoken package") from e
+        _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    encoding = _encodings[encoding_name]
+    # special tokens are counted as plain text instead of raising
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class TextChunker:
+    """
+    Recursive separator based chunker.
+
+    Args:
+        chunk_size (int): Maximum length of a chunk, in `unit`
+        chunk_overlap (int): Length carried over from the previous chunk
+        unit (str): "chars" or "tokens"
+        separators (tuple): Separators tried in order, "" splits into characters
+    """
+
+    def __init__(self, chunk_size, chunk_overlap, unit='chars', separators=DEFAULT_SEPARATORS):
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"Chunk overlap ({chunk_overlap}) is larger than the chunk size ({chunk_size})")
+        if unit not in UNITS:
+            raise ValueError(f"Unknown length unit {unit}, expected one of {UNITS}")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.unit = unit
+        self.separators = tuple(separators)
+        self._count = token_counter() if unit == 'tokens' else None
+
+    def chunks(self, text):
+        """Yield the (start, end, text) chunks of `text` in document order"""
+        yield from self._split(text, 0, len(text), self.separators)
+
+    def _length(self, text, start, end):
+        if self._count is None:
+            return end - start
+        return self._count(text[start:end])
+
+    def _split(self, text, start, end, separators):
+        separator = separators[-1]
+        remaining = ()
+        for i, candidate in enumerate(separators):
+            if not candidate:
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                remaining = separators[i + 1:]
+                break
+
+        if not separator and self._count is None and self.chunk_size > 1:
+            yield from self._split_characters(text, start, end)
+            return
+
+        # (start, end, length) of the pieces of the chunk being built
+        window = deque()
+        total = 0
+        for piece_start, piece_end in self._pieces(text, start, end, separator):
+            length = self._length(text, piece_start, piece_end)
+            if length < self.chunk_size:
+                if window and total + length > self.chunk_size:
+                    chunk = self._join(text, window[0][0], window[-1][1])
+                    if chunk:
+                        yield chunk
+                    # keep the tail of the chunk that fits in the overlap
+                    while window and (total > self.chunk_overlap or total + length > self.chunk_size):
+                        total -= window.popleft()[2]
+                window.append((piece_start, piece_end, length))
+                total += length
+                continue
+            # a piece too long for a chunk closes the current one and is split with the next separator
+            if window:
+                chunk = self._join(text, window[0][0], window[-1][1])
+                if chunk:
+                    yield chunk
+                window.clear()
+                total = 0
+            if not remaining:
+                # unsplittable piece, emitted as is (not stripped), like the LangChain splitter
+                yield piece_start, piece_end, text[piece_start:piece_end]
+            else:
+                yield from self._split(text, piece_start, piece_end, remaining)
+        if window:
+            chunk = self._join(text, window[0][0], window[-1][1])
+            if chunk:
+                yield chunk
+
+    def _split_characters(self, text, start, end):
+        """
+        Character level split measured in characters, in closed form: every chunk is a window of
+        chunk_size characters and the next one starts min(overlap, chunk_size - 1) characters before its end
+        """
+        step = self.chunk_size - min(self.chunk_overlap, self.chunk_size - 1)
+        window_start = start
+        while end - window_start > self.chunk_size:
+            chunk = self._join(text, window_start, window_start + self.chunk_size)
+            if chunk:
+                yield chunk
+            window_start += step
+        chunk = self._join(text, window_start, end)
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _pieces(text, start, end, separator):
+        """Offsets of the pieces of text[start:end], every piece but the first starts with the separator"""
+        if not separator:
+            for position in range(start, end):
+                yield position, position + 1
+            return
+        piece_start = start
+        position = text.find(separator, start, end)
+        while position != -1:
+            if position > piece_start:
+                yield piece_start, position
+            piece_start = position
+            position = text.find(separator, position + len(separator), end)
+        if end > piece_start:
+            yield piece_start, end
+
+    @staticmethod
+    def _join(text, start, end):
+        """Stripped chunk text[start:end] with its offsets, None when only whitespace"""
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start == end:
+            return None
+        return start, end, text[start:end]
+
+
+def iter_chunks(text, chunk_size, chunk_overlap, unit='chars'):
+    """Yield the (start, end, text) chunks of `text`"""
+    return TextChunker(chunk_size, chunk_overlap, unit).chunks(text)
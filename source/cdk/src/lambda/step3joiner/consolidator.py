@@ -1,12 +1,46 @@
+"""
+RAW_DATA_JOINER function:
+Joins the pages extracted by the LLM (pages_processed/{group}/{uuid}_{file}_page_{n}.txt) into
+raw_text/{group}/{uuid}_{file}_raw_llm.txt, the input of the chunking step.
+
+Pages are ordered by their page number (page_10 after page_2) and fetched concurrently by a
+bounded pool (CONSOLIDATE_WORKERS, default 16). The fetches are consumed in page order from a
+window of at most twice the workers, so the output is streamed to a multipart upload
+(common/s3_io.py) in order while memory holds only the pages of the window.
+
+The "extraction" metadata of the pages (text-layer, cache or llm, written by ReadDocs and
+PagesProcess) is counted per document in page_sources, the page cache hit metrics.
+
+Pages are decompressed as they are read, compressed or not, and the raw text is written gzip
+compressed unless ARTIFACT_COMPRESSION=none (common/s3_io.py).
+"""
+
 import boto3
 import logging
 import json
 import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from s3_io import S3ArtifactWriter, artifact_body
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
-s3Client = boto3.client('s3')
+CONSOLIDATE_WORKERS = int(os.environ.get('CONSOLIDATE_WORKERS', 16))
+PAGE_SEPARATOR = b'\n\n'
+PAGE_NUMBER_PATTERN = re.compile(r'_page_(\d+)(?:-\d+)?\.txt$')
+s3Client = boto3.client('s3', config=Config(max_pool_connections=CONSOLIDATE_WORKERS + 2))
+
+
+def page_sort_key(key):
+    """Numeric page order, keys without a page number keep their lexical order at the end"""
+    match = PAGE_NUMBER_PATTERN.search(key)
+    if match:
+        return (0, int(match.group(1)), key)
+    return (1, 0, key)
+
 class TextConsolidator:
     def __init__(self, region="us-east-1"):
         self.s3_client = s3Client
@@ -41,7 +75,7 @@ class TextConsolidator:
                         if obj['Key'].endswith('.txt'):
                             matching_files.append(obj['Key'])
             
-            matching_files.sort()  # Sort to maintain page order
+            matching_files.sort(key=page_sort_key)  # Sort to maintain page order
             logger.info(f"Found {len(matching_files)} matching files")
             return matching_files
             
@@ -49,6 +83,42 @@ class TextConsolidator:
             logger.error(f"Error listing files: {str(e)}")
             raise
 
+    def get_page(self, bucket, key):
+        """Content of the page and the source of its text"""
+        response = self.s3_client.get_object(Bucket=bucket, Key=key)
+        with artifact_body(response['Body']) as body:
+            return body.read(), response.get('Metadata', {}).get('extraction', 'unknown')
+
+    def stream_pages(self, bucket, keys, writer):
+        """
+        Fetch the pages concurrently and write them in order, separated by a blank line.
+        The futures are kept in page order, at most 2 per worker ahead of the writer.
+
+        Returns:
+            Counter: pages per source of their text
+        """
+        sources = Counter()
+        window = max(1, CONSOLIDATE_WORKERS * 2)
+        with ThreadPoolExecutor(max_workers=CONSOLIDATE_WORKERS) as executor:
+            pending = deque()
+            remaining = iter(keys)
+            for key in remaining:
+                pending.append(executor.submit(self.get_page, bucket, key))
+                if len(pending) >= window:
+                    break
+            first = True
+            while pending:
+                content, source = pending.popleft().result()
+                next_key = next(remaining, None)
+                if next_key is not None:
+                    pending.append(executor.submit(self.get_page, bucket, next_key))
+                if not first:
+                    writer.write(PAGE_SEPARATOR)
+                writer.write(content)
+                sources[source] += 1
+                first = False
+        return sources
+
     def consolidate_files(self, input_data):
         """Consolidate multiple text files into a single raw text file"""
         try:
@@ -66,36 +136,24 @@ class TextConsolidator:
             if not matching_files:
                 raise ValueError(f"No matching files found for prefix: {prefix}")
 
-            # Consolidate content from all files
-            consolidated_text = []
-            for file_key in matching_files:
-                logger.info(f"Reading file: {file_key}")
-                response = self.s3_client.get_object(Bucket=bucket, Key=file_key)
-                content = response['Body'].read().decode('utf-8')
-                consolidated_text.append(content)
-                logger.info(f"Added content from: {file_key}")
-
-            # Join all text with double newlines
-            final_text = '\n\n'.join(consolidated_text)
-
             # Generate output key
             output_key = self.get_raw_text_key(prefix)
-            
-            # Save consolidated text to S3
-            self.s3_client.put_object(
-                Bucket=bucket,
-                Key=output_key,
-                Body=final_text.encode('utf-8'),
-                ContentType='text/plain'
-            )
+
+            # Join all pages with double newlines while they are uploaded to S3
+            with S3ArtifactWriter(self.s3_client, bucket, output_key, content_type='text/plain') as writer:
+                page_sources = self.stream_pages(bucket, matching_files, writer)
 
             logger.info(f"Successfully consolidated and saved to: {bucket}/{output_key}")
+            logger.info(f"Page sources of {output_key}: {dict(page_sources)}")
 
             return {
                 'bucket': bucket,
                 'input_prefix': prefix,
                 'output_key': output_key,
                 'files_processed': len(matching_files),
+                'bytes_written': writer.bytes_written,
+                'bytes_stored': writer.bytes_stored,
+                'page_sources': dict(page_sources),
                 'status': 'success'
             }
 
@@ -1,12 +1,38 @@
 """
 STORE_CHUNK_DYNAMO function:
 This function gets triggered when the process of chunking finishes.
-This function will scan two folders (chunks1000 and chunks2000)
-It will take all the files inside those folders, calculate the vector embedding with bedrock embeddings v2
-And write the chunks with the vectors in the respective dynamodb table
+For every chunk table subscribed to the document source (CHUNK_PROFILES, see common/chunk_profiles.py)
+this function will read the chunks of the profile, either from the chunks{size}.jsonl.gz manifest
+written by chunk_raw_data or, for the per object layout, from all the files inside the chunks{size} folder
+(decompressed when they were written gzip compressed, see common/s3_io.py)
+It will calculate the vector embedding with bedrock embeddings v2
+And write the chunks with the vectors in the subscribed dynamodb table
+
+The work runs as a bounded thread pool pipeline: chunks are fetched from S3 concurrently,
+looked up in the embedding cache, the misses are embedded in parallel (the shared bedrock
+client caps the in flight calls per model) and everything is written with BatchWriteItem
+in groups of 25, retrying unprocessed items.
+
+Incremental ingestion:
+Chunk items are keyed by the hash of their text ({file}/chunks{size}/{sha256 prefix}), so a revised
+document (same uuid, see read_docs INGESTION_MODE) is diffed against the items already stored:
+only the new chunks are embedded and written, and the chunks that are gone are batch deleted.
+
+Embedding cache:
+When EMBEDDING_CACHE_TABLE is set, embeddings are content addressed by
+sha256(model id + dimensions + text) and read in bulk with BatchGetItem before calling
+Bedrock, so re-uploaded documents and repeated boilerplate are not embedded again.
+
+Near duplicate suppression:
+When NEAR_DUP_TABLE is set, the new chunks are compared per group and per table with MinHash
+and LSH (common/near_duplicates.py, threshold NEAR_DUP_THRESHOLD). A chunk that is a near
+duplicate of a stored chunk, or of an earlier chunk of the document, is not embedded: a
+reference item without vector points to the canonical chunk, which counts its references in
+ref_count. Removing a canonical chunk promotes one of its references.
 
 Important Note:
 DynamoDB writes may take long time. Set timeout as long as feasible
+MAX_WORKERS controls the size of the thread pool (default 16)
 
 Input:
 {
@@ -21,8 +47,15 @@ Output:
 If the job is ended correctly, it will return the following JSON
 {
   "statusCode": "200",
-  "chunks_small_written": "x",
-  "chunks_big_written": "y"
+  "chunks_1000_written": "x",
+  "chunks_1000_unchanged": "u",
+  "chunks_1000_deleted": "d",
+  "chunks_1000_suppressed": "s",
+  "table": "table_name[,table_name]",
+  "embedding_cache_hits": "h",
+  "embedding_cache_misses": "m",
+  "embedding_cache_hit_ratio": "0.75",
+  "near_duplicates_suppressed": "s"
 }
 If the job fails, it will return the following JSON
 {
@@ -33,22 +66,39 @@ If the job fails, it will return the following JSON
 
 import json
 import boto3
+import hashlib
 import os
-from decimal import Decimal
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from bedrock_client import get_bedrock_client
+from chunk_manifest import find_manifest, read_manifest
+from chunk_profiles import document_source, profiles_for_source
+from near_duplicates import NearDuplicateIndex, add_reference, minhash, reference_item, release_chunks
+from s3_io import read_artifact
+
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 16))
+DYNAMO_BATCH_SIZE = 25
+DYNAMO_BATCH_GET_SIZE = 100
+DYNAMO_MAX_ATTEMPTS = 8
 
 # Initialize AWS clients
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS))
 dynamodb = boto3.resource('dynamodb')
-bedrock_runtime = boto3.client('bedrock-runtime')
+bedrock_runtime = get_bedrock_client()
 
-# DynamoDB table names from environment variables
-DYNAMODB_TABLE_TEXTRACT = os.environ['DYNAMO_TABLE_TEXTRACT']
-DYNAMODB_TABLE_LLM = os.environ['DYNAMO_TABLE_LLM']
-CHUNK_SIZE = os.environ.get('CHUNK_SIZE', '1000')
+EMBEDDING_MODEL_ID = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+# Titan v2 default output size, part of the cache key so a change invalidates the cache
+EMBEDDING_DIMENSIONS = os.environ.get('EMBEDDING_DIMENSIONS', '1024')
+EMBEDDING_CACHE_TABLE = os.environ.get('EMBEDDING_CACHE_TABLE', None)
+EMBEDDING_CACHE_TTL_DAYS = int(os.environ.get('EMBEDDING_CACHE_TTL_DAYS', 180))
+NEAR_DUP_TABLE = os.environ.get('NEAR_DUP_TABLE', None)
 
 def get_embedding(text: str) -> list:
     response = bedrock_runtime.invoke_model(
-        modelId='amazon.titan-embed-text-v2:0',
+        modelId=EMBEDDING_MODEL_ID,
         contentType='application/json',
         accept='application/json',
         body=json.dumps({'inputText': text})
@@ -56,58 +106,247 @@ def get_embedding(text: str) -> list:
     embedding = json.loads(response['body'].read())['embedding']
     return embedding
 
-def store_in_dynamodb(table_name: str, text_chunk: str, embedding: list, filename: str, group, _uuid):
+def build_chunk_item(text_chunk: str, embedding: list, filename: str, group, _uuid, ref_count=0):
     # TODO the item structure needs to change, we are going to use hash compession for faster query
     # key will be a vector hash prefix, and the sortKey will be a full hash
     # other indexes will help getting the file_path + chunks that should be unique
     # another hash will be the congnito group that it belongs to.
     # this will require an entire DynamoDb Vector managment lib that we will implement soon
-    table = dynamodb.Table(table_name)
     decimal_embedding = json.dumps([value for value in embedding])
-    table.put_item(
-        Item={
-            'id': f'{group}-{_uuid}',
-            'filename': filename,
-            'group': group,
-            'vector': decimal_embedding,
-            'text': text_chunk
-        }
-    )
+    item = {
+        'id': f'{group}-{_uuid}',
+        'filename': filename,
+        'group': group,
+        'vector': decimal_embedding,
+        'text': text_chunk
+    }
+    if ref_count:
+        item['ref_count'] = ref_count
+    return item
+
+def write_batch(table_name: str, items: list):
+    """
+    Write up to 25 items with BatchWriteItem, retrying the unprocessed items
+    with jittered exponential backoff.
+    """
+    send_batch(table_name, [{'PutRequest': {'Item': item}} for item in items])
+
+def delete_batch(table_name: str, keys: list):
+    """Delete up to 25 items by key with BatchWriteItem"""
+    send_batch(table_name, [{'DeleteRequest': {'Key': key}} for key in keys])
+
+def send_batch(table_name: str, requests: list):
+    request_items = {table_name: requests}
+    attempt = 0
+    while request_items:
+        response = dynamodb.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if request_items:
+            attempt += 1
+            if attempt >= DYNAMO_MAX_ATTEMPTS:
+                raise RuntimeError(f"BatchWriteItem left unprocessed items after {attempt} attempts")
+            time.sleep(random.uniform(0, min(10, 0.1 * (2 ** attempt))))
+
+class BatchWriteBuffer:
+    """Accumulates items and flushes them with write_batch every 25 items"""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.pending = []
+        self.written = 0
+
+    def add(self, item):
+        self.pending.append(item)
+        if len(self.pending) == DYNAMO_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            write_batch(self.table_name, self.pending)
+            self.written += len(self.pending)
+            self.pending = []
+
+def embedding_cache_key(text: str) -> str:
+    return hashlib.sha256(f"{EMBEDDING_MODEL_ID}\n{EMBEDDING_DIMENSIONS}\n{text}".encode('utf-8')).hexdigest()
+
+def get_cached_embeddings(cache_keys) -> dict:
+    """
+    Bulk lookup of the embedding cache with BatchGetItem (100 keys per request).
+
+    Returns:
+        dict: cache key -> embedding serialized as a JSON string, only for the hits
+    """
+    if not EMBEDDING_CACHE_TABLE:
+        return {}
+    cache_keys = list(cache_keys)
+    found = {}
+    for i in range(0, len(cache_keys), DYNAMO_BATCH_GET_SIZE):
+        request_items = {EMBEDDING_CACHE_TABLE: {
+            'Keys': [{'content_hash': key} for key in cache_keys[i:i + DYNAMO_BATCH_GET_SIZE]],
+            'ProjectionExpression': 'content_hash, vector'
+        }}
+        attempt = 0
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(EMBEDDING_CACHE_TABLE, []):
+                found[item['content_hash']] = item['vector']
+            request_items = response.get('UnprocessedKeys') or {}
+            if request_items:
+                attempt += 1
+                if attempt >= DYNAMO_MAX_ATTEMPTS:
+                    raise RuntimeError(f"BatchGetItem left unprocessed keys after {attempt} attempts")
+                time.sleep(random.uniform(0, min(10, 0.1 * (2 ** attempt))))
+    return found
+
+def chunk_item_names(origin_filename, label, contents):
+    """
+    Content addressed sort keys of the chunks, {origin}/chunks{label}/{hash}.
+    A text repeated inside the document gets a -{n} suffix for its n-th repetition.
+    """
+    seen = {}
+    names = []
+    for content in contents:
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+        repeat = seen.get(digest, 0)
+        seen[digest] = repeat + 1
+        names.append(f"{origin_filename}/chunks{label}/{digest}" + (f"-{repeat}" if repeat else ""))
+    return names
+
+def list_stored_chunks(table_name, item_id, prefix):
+    """
+    Items of the document already in the table, for the chunks under `prefix`, by sort key.
+    Only the keys and the near duplicate references are read.
+    """
+    table = dynamodb.Table(table_name)
+    query = {
+        'KeyConditionExpression': Key('id').eq(item_id) & Key('filename').begins_with(prefix),
+        'ProjectionExpression': 'id, filename, canonical_id, canonical_filename, ref_count'
+    }
+    items = {}
+    while True:
+        response = table.query(**query)
+        items.update((item['filename'], item) for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def delete_chunks(table_name, item_id, names):
+    names = sorted(names)
+    for i in range(0, len(names), DYNAMO_BATCH_SIZE):
+        delete_batch(table_name, [{'id': item_id, 'filename': name} for name in names[i:i + DYNAMO_BATCH_SIZE]])
+    return len(names)
 
 def extract_filename_from_s3_path(s3_path):
     return s3_path.split('/')[-2]  # Get the second to last element after splitting
 
-def process_file(bucket, key, table_name, origin_filename, base_prefix):
-    response = s3.get_object(Bucket=bucket, Key=key)
-    content = response['Body'].read().decode('utf-8')
-    
-    embedding = get_embedding(content)
-    
-    # Construct the full filename including the origin filename and internal path
-    relative_path = key[len(base_prefix):]
-    full_filename = f"{origin_filename}/{relative_path.lstrip('/')}"
+def list_chunk_keys(bucket, prefix):
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return keys
+
+def fetch_chunk(bucket, key):
+    return read_artifact(s3, bucket, key).decode('utf-8')
+
+def load_chunk_objects(bucket, prefix):
+    """Fetch the per object chunks under `prefix` concurrently"""
+    keys = list_chunk_keys(bucket, prefix)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(lambda key: fetch_chunk(bucket, key), keys))
+
+def load_chunk_manifest(bucket, key):
+    """Stream the chunk texts of a manifest"""
+    return [record['text'] for record in read_manifest(s3, bucket, key)]
+
+def document_item_id(base_prefix):
+    """Partition key of the chunks of a document, {group}-{uuid}"""
     group = base_prefix.split('/')[1]
     _uuid = base_prefix.split('/')[2].split('_')[0]
-    
-    store_in_dynamodb(table_name, content, embedding, full_filename,group,_uuid)
+    return f"{group}-{_uuid}"
 
-def process_folder(bucket, prefix, table_name, origin_filename, base_prefix):
-    processed_files = 0
-    next_token = None
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    while True:
-        if response.get('IsTruncated', False): next_token = response['NextContinuationToken']
-        else: next_token = None
-        for obj in response.get('Contents', []):
-            key = obj['Key']
-            process_file(bucket, key, table_name, origin_filename, base_prefix)
-            processed_files += 1
-        # get next page
-        if next_token:
-            response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, ContinuationToken=next_token)
-        else:
-            break
-    return processed_files
+def suppress_near_duplicates(contents, filenames, table_name, group, item_id):
+    """
+    Split the new chunks into the canonical ones, which are embedded, and the near duplicates
+    of a stored chunk of the group or of an earlier chunk of the document.
+
+    The references to a stored chunk are written and counted here (add_reference), the
+    references to a chunk of this document are returned to be written after it.
+
+    Returns:
+        tuple: (canonical contents, canonical filenames, {filename: references} of the canonical
+        chunks of this document, reference items to write, suppressed chunks, index holding the
+        bands to write)
+    """
+    index = NearDuplicateIndex(dynamodb, NEAR_DUP_TABLE, table_name, group)
+    signatures = [minhash(content) for content in contents]
+    index.prefetch(signatures)
+    kept_contents, kept_filenames, ref_counts, references, suppressed = [], [], {}, [], 0
+    for content, filename, signature in zip(contents, filenames, signatures):
+        match = index.match(signature)
+        while match and match[2] and not add_reference(dynamodb, table_name, match[0],
+                                                       reference_item(item_id, filename, match[0])):
+            # the stored canonical chunk was deleted since its bands were written
+            index.forget(match[0])
+            match = index.match(signature)
+        if match:
+            canonical = match[0]
+            suppressed += 1
+            if not match[2]:
+                ref_counts[canonical['filename']] = ref_counts.get(canonical['filename'], 0) + 1
+                references.append(reference_item(item_id, filename, canonical))
+            continue
+        index.register(signature, {'id': item_id, 'filename': filename})
+        kept_contents.append(content)
+        kept_filenames.append(filename)
+    return kept_contents, kept_filenames, ref_counts, references, suppressed, index
+
+def process_chunks(contents, filenames, table_name, base_prefix, ref_counts=None):
+    """
+    Embed and store the chunks of a document.
+
+    Returns:
+        tuple: (chunks written, chunks served from the embedding cache)
+    """
+    group = base_prefix.split('/')[1]
+    _uuid = base_prefix.split('/')[2].split('_')[0]
+    ref_counts = ref_counts or {}
+    writer = BatchWriteBuffer(table_name)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        cache_keys = [embedding_cache_key(content) for content in contents]
+        vectors = get_cached_embeddings(set(cache_keys))
+        cache_hits = sum(1 for cache_key in cache_keys if cache_key in vectors)
+
+        # chunks whose embedding is cached are written right away
+        waiting = {}
+        for content, filename, cache_key in zip(contents, filenames, cache_keys):
+            if cache_key in vectors:
+                writer.add(build_chunk_item(content, json.loads(vectors[cache_key]), filename, group, _uuid,
+                                            ref_counts.get(filename, 0)))
+            else:
+                waiting.setdefault(cache_key, []).append((content, filename))
+
+        # the misses are embedded once per distinct text, the writes stay in this thread
+        # since boto3 resources are not thread safe
+        cache_writer = BatchWriteBuffer(EMBEDDING_CACHE_TABLE) if EMBEDDING_CACHE_TABLE else None
+        expiration_time = int(time.time()) + EMBEDDING_CACHE_TTL_DAYS * 86400
+        futures = {executor.submit(get_embedding, chunks[0][0]): cache_key for cache_key, chunks in waiting.items()}
+        for future in as_completed(futures):
+            cache_key = futures[future]
+            embedding = future.result()
+            for content, filename in waiting[cache_key]:
+                writer.add(build_chunk_item(content, embedding, filename, group, _uuid, ref_counts.get(filename, 0)))
+            if cache_writer:
+                cache_writer.add({
+                    'content_hash': cache_key,
+                    'vector': json.dumps(embedding),
+                    'model_id': EMBEDDING_MODEL_ID,
+                    'expiration_time': expiration_time
+                })
+    writer.flush()
+    if cache_writer:
+        cache_writer.flush()
+    return writer.written, cache_hits
 
 def handler(event, context):
     s3_path = event["Payload"]['Output']
@@ -119,21 +358,62 @@ def handler(event, context):
     parts = s3_path.replace("s3://", "").split("/")
     bucket = parts[0]
     base_prefix = "/".join(parts[1:])
-    # if the s3path has _raw_llm use DYNAMODB_TABLE_LLM else DYNAMODB_TABLE_TEXTRACT
-    if parts[-2].endswith("_llm"):
-        DYNAMODB_TABLE = DYNAMODB_TABLE_LLM
-    else:
-        DYNAMODB_TABLE = DYNAMODB_TABLE_TEXTRACT
-    # Process chunks1000 folder
-    chunks_prefix = os.path.join(base_prefix, f"chunks{CHUNK_SIZE}/")
-    processed_files = process_folder(bucket, chunks_prefix, DYNAMODB_TABLE, origin_filename, base_prefix)
-    
-    # Process chunks2000 folder
-    # chunks2000_prefix = os.path.join(base_prefix, f"chunks{CHUNK_SIZE}/")
-    # processed_files_2000 = process_folder(bucket, chunks2000_prefix, DYNAMODB_TABLE_LLM, origin_filename, base_prefix)
-    
-    return {
-        "statusCode": "200",
-        f"chunks_{CHUNK_SIZE}_written": str(processed_files),
-        "table": DYNAMODB_TABLE
-    }
\ No newline at end of file
+    # _raw_llm documents feed the llm subscriptions, everything else the textract ones
+    profiles = profiles_for_source(document_source(parts[-2]))
+    output = {"statusCode": "200"}
+    tables = []
+    processed_files = 0
+    cache_hits = 0
+    suppressed_total = 0
+    for profile in profiles:
+        table_name = os.environ[profile.table]
+        # Read the chunks of the profile, from the manifest when chunk_raw_data wrote one
+        manifest = find_manifest(s3, bucket, base_prefix, profile.label)
+        if manifest:
+            contents = load_chunk_manifest(bucket, manifest)
+        else:
+            contents = load_chunk_objects(bucket, os.path.join(base_prefix, f"chunks{profile.label}/"))
+        filenames = chunk_item_names(origin_filename, profile.label, contents)
+
+        # Diff against the chunks stored by a previous revision of the document
+        item_id = document_item_id(base_prefix)
+        stored = list_stored_chunks(table_name, item_id, f"{origin_filename}/chunks{profile.label}/")
+        new = [(content, filename) for content, filename in zip(contents, filenames) if filename not in stored]
+        removed = set(stored).difference(filenames)
+        if NEAR_DUP_TABLE and removed:
+            release_chunks(dynamodb, table_name, [stored[name] for name in removed],
+                           deleted=lambda key, item_id=item_id, removed=removed: key['id'] == item_id and key['filename'] in removed,
+                           signature_table=NEAR_DUP_TABLE)
+        deleted = delete_chunks(table_name, item_id, removed)
+        new_contents = [content for content, _ in new]
+        new_filenames = [filename for _, filename in new]
+        ref_counts, references, suppressed, index = {}, [], 0, None
+        if NEAR_DUP_TABLE and new:
+            new_contents, new_filenames, ref_counts, references, suppressed, index = suppress_near_duplicates(
+                new_contents, new_filenames, table_name, base_prefix.split('/')[1], item_id)
+        written, hits = process_chunks(new_contents, new_filenames, table_name, base_prefix, ref_counts)
+        if index:
+            # the references and the bands only point to chunk items that are written
+            reference_writer = BatchWriteBuffer(table_name)
+            for reference in references:
+                reference_writer.add(reference)
+            reference_writer.flush()
+            index.flush()
+        output[f"chunks_{profile.label}_written"] = str(written)
+        output[f"chunks_{profile.label}_unchanged"] = str(len(filenames) - len(new))
+        output[f"chunks_{profile.label}_deleted"] = str(deleted)
+        output[f"chunks_{profile.label}_suppressed"] = str(suppressed)
+        tables.append(table_name)
+        processed_files += written
+        cache_hits += hits
+        suppressed_total += suppressed
+
+    bedrock_runtime.emit_metrics()
+    output.update({
+        "table": ",".join(tables),
+        "embedding_cache_hits": str(cache_hits),
+        "embedding_cache_misses": str(processed_files - cache_hits),
+        "embedding_cache_hit_ratio": str(round(cache_hits / processed_files, 4) if processed_files else 0),
+        "near_duplicates_suppressed": str(suppressed_total)
+    })
+    return output
\ No newline at end of file
@@ -1,4 +1,8 @@
 $(document).ready(function () {
+    const MULTIPART_THRESHOLD = 1024 * 1024 * 10; // 10 MB, larger files are uploaded in parts
+    const MULTIPART_CONCURRENCY = 4;
+    const MULTIPART_RETRIES = 3;
+    const SHA256_CHUNK = 1024 * 1024 * 4; // large files are hashed 4 MB at a time instead of loaded whole
     let fileinput = $("#file-upload");
     const $fileList = $('.file-list');
     let displayDocuments = $("#display-docs");
@@ -214,12 +218,12 @@ $(document).ready(function () {
     
     // Check file size and type
     function validateFile(file) {
-        const maxSizeInBytes = 1024 * 1024 * 10; // 10 MB
+        const maxSizeInBytes = 1024 * 1024 * 500; // 500 MB, the Textract limit
         const allowedTypes = ['.pdf'];
         
         // Check file size
         if (file.size > maxSizeInBytes) {
-            showWarningNotification(`"${file.name}" exceeds the 10MB size limit.`, 5000);
+            showWarningNotification(`"${file.name}" exceeds the 500MB size limit.`, 5000);
             return false;
         }
         
@@ -260,6 +264,122 @@ $(document).ready(function () {
         }
     }
     
+    // Upload a large file as a multipart upload, MULTIPART_CONCURRENCY parts at a time.
+    // After every round the parts S3 is missing are asked again, so failed parts are resumed
+    // instead of restarting the whole file. Resolves with the name of the existing document
+    // when the content is a duplicate.
+    function uploadMultipart(apiendpoint, file, fileId) {
+        const endpoint = apiendpoint + "/multipart";
+        return sha256Hex(file)
+            .then(hash => post({ file_name: file.name, file_size: file.size, sha256: hash }, endpoint))
+            .then(upload => {
+                if (upload["duplicate"]) {
+                    return upload["filename"];
+                }
+                const etags = {};
+                let uploadedBytes = 0;
+                updateProgress(fileId, 20);
+
+                function uploadParts(urls) {
+                    let next = 0;
+                    function worker() {
+                        if (next >= urls.length) {
+                            return Promise.resolve();
+                        }
+                        const part = urls[next++];
+                        const start = (part.part_number - 1) * upload.part_size;
+                        const blob = file.slice(start, Math.min(start + upload.part_size, file.size));
+                        return putPart(part.url, blob).then(etag => {
+                            etags[part.part_number] = etag;
+                            uploadedBytes += blob.size;
+                            updateProgress(fileId, 20 + Math.min(75, Math.round(75 * uploadedBytes / file.size)));
+                            return worker();
+                        });
+                    }
+                    const workers = [];
+                    for (let w = 0; w < MULTIPART_CONCURRENCY; w++) {
+                        workers.push(worker());
+                    }
+                    return Promise.all(workers);
+                }
+
+                function run(urls, retries) {
+                    return Promise.resolve(uploadParts(urls))
+                        .then(() => retries, error => {
+                            if (retries === 0) {
+                                throw error;
+                            }
+                            return retries - 1;
+                        })
+                        .then(left => get(endpoint + "?file_name=" + encodeURIComponent(file.name)
+                                + "&upload_id=" + encodeURIComponent(upload.upload_id)
+                                + "&parts_total=" + upload.parts_total)
+                            .then(state => {
+                                state.uploaded.forEach(part => { etags[part.part_number] = part.etag; });
+                                return state.urls.length > 0 ? run(state.urls, left) : null;
+                            }));
+                }
+
+                return run(upload.urls, MULTIPART_RETRIES)
+                    .then(() => post({
+                        file_name: file.name,
+                        upload_id: upload.upload_id,
+                        parts: Object.keys(etags).map(number => ({ part_number: Number(number), etag: etags[number] }))
+                    }, endpoint + "/complete"))
+                    .then(() => null)
+                    .catch(error => {
+                        post({ file_name: file.name, upload_id: upload.upload_id }, endpoint + "/abort");
+                        throw error;
+                    });
+            });
+    }
+
+    // SHA-256 of a file read SHA256_CHUNK bytes at a time, crypto.subtle only digests whole
+    // buffers so large files go through the incremental hasher of hash-wasm (see index.html)
+    function sha256Stream(file) {
+        return hashwasm.createSHA256().then(hasher => {
+            hasher.init();
+            function step(offset) {
+                if (offset >= file.size) {
+                    return hasher.digest('hex');
+                }
+                const end = Math.min(offset + SHA256_CHUNK, file.size);
+                return file.slice(offset, end).arrayBuffer().then(buffer => {
+                    hasher.update(new Uint8Array(buffer));
+                    return step(end);
+                });
+            }
+            return step(0);
+        });
+    }
+
+    // Hex SHA-256 of the file, the API skips uploads whose content is already in the group.
+    // Files uploaded in parts are hashed in chunks so they are never held in memory whole.
+    function sha256Hex(file) {
+        if (file.size > MULTIPART_THRESHOLD) {
+            return sha256Stream(file);
+        }
+        return file.arrayBuffer()
+            .then(buffer => crypto.subtle.digest('SHA-256', buffer))
+            .then(digest => Array.from(new Uint8Array(digest))
+                .map(byte => byte.toString(16).padStart(2, '0')).join(''));
+    }
+
+    // Single presigned PUT, resolves with the name of the existing document when the content is a duplicate
+    function uploadSingle(apiendpoint, file, fileId) {
+        return sha256Hex(file)
+            .then(hash => get(apiendpoint + "?file_name=" + encodeURIComponent(file.name) + "&sha256=" + hash))
+            .then(response => {
+                if (response["duplicate"]) {
+                    return response["filename"];
+                }
+                updateProgress(fileId, 20);
+                // Upload to presigned URL, S3 verifies the declared checksum
+                return put(response["url"], file, {"x-amz-checksum-sha256": response["checksum_sha256"]})
+                    .then(() => null);
+            });
+    }
+
     // Upload files
     function uploadFiles() {
         let files = $("#file-upload")[0].files;
@@ -287,42 +407,42 @@ $(document).ready(function () {
             validFilesCount++;
             const { fileItem, fileId } = UIuploadFile(files[i]);
             
-            // Get presigned URL
-            get(apiendpoint + "?file_name=" + files[i].name)
-                .then(response => {
-                    updateProgress(fileId, 20);
+            // Large files are uploaded in parallel parts, the others with a single presigned PUT
+            const upload = files[i].size > MULTIPART_THRESHOLD
+                ? uploadMultipart(apiendpoint, files[i], fileId)
+                : uploadSingle(apiendpoint, files[i], fileId);
+            upload
+                .then(duplicate => {
+                    if (duplicate) {
+                        showInfoNotification(`${files[i].name} has the same content as ${duplicate}, upload skipped`, 3000);
+                    }
+                    updateProgress(fileId, 100);
+                    successfulUploads++;
                     
-                    // Upload to presigned URL
-                    return put(response["url"], files[i])
-                        .then(() => {
-                            updateProgress(fileId, 100);
-                            successfulUploads++;
-                            
-                            // Show notification if all uploads are complete
-                            if (successfulUploads + failedUploads === validFilesCount) {
-                                if (failedUploads === 0) {
-                                    showSuccessNotification(`${successfulUploads} file(s) uploaded successfully`, 3000);
-                                } else {
-                                    showWarningNotification(`${successfulUploads} file(s) uploaded, ${failedUploads} failed`, 3000);
-                                }
-                                
-                                // Reset file input
-                                $("#file-upload").val('');
-                                
-                                // Reset file input label
-                                const fileInputLabel = document.querySelector('.file-input-label');
-                                fileInputLabel.innerHTML = '';
-                                
-                                const icon = document.createElement('i');
-                                icon.className = 'fas fa-file-pdf';
-                                fileInputLabel.appendChild(icon);
-                                
-                                fileInputLabel.appendChild(document.createTextNode(' Choose PDF files'));
-                                
-                                // Refresh document list
-                                setTimeout(getDocuments, 1000);
-                            }
-                        });
+                    // Show notification if all uploads are complete
+                    if (successfulUploads + failedUploads === validFilesCount) {
+                        if (failedUploads === 0) {
+                            showSuccessNotification(`${successfulUploads} file(s) uploaded successfully`, 3000);
+                        } else {
+                            showWarningNotification(`${successfulUploads} file(s) uploaded, ${failedUploads} failed`, 3000);
+                        }
+                        
+                        // Reset file input
+                        $("#file-upload").val('');
+                        
+                        // Reset file input label
+                        const fileInputLabel = document.querySelector('.file-input-label');
+                        fileInputLabel.innerHTML = '';
+                        
+                        const icon = document.createElement('i');
+                        icon.className = 'fas fa-file-pdf';
+                        fileInputLabel.appendChild(icon);
+                        
+                        fileInputLabel.appendChild(document.createTextNode(' Choose PDF files'));
+                        
+                        // Refresh document list
+                        setTimeout(getDocuments, 1000);
+                    }
                 })
                 .catch(error => {
                     console.error('Error uploading file:', error);
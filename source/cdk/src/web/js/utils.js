@@ -47,16 +47,29 @@ function post(data, url, headers = {}) {
       headers: headers
   });
 }
-function put(url,data) {
+function put(url, data, headers = {}) {
   // make a request to the signed url
   return $.ajax({
       contentType: 'binary/octet-stream',
       url: url,
       type: 'PUT',
       data: data,
+      headers: headers,
       processData: false
   });
 }
+// Upload one part of a multipart upload, resolves with the ETag S3 returns for it
+function putPart(url, data) {
+  return $.ajax({
+      url: url,
+      type: 'PUT',
+      data: data,
+      processData: false,
+      contentType: false
+  }).then(function (body, status, xhr) {
+      return xhr.getResponseHeader('ETag');
+  });
+}
 // Delete that has the same behavvior as post
 function del(url, data, headers = {}) {
   if (JSON.stringify(headers) == "{}") {